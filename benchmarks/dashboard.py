@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""Time the dashboard tables with the keyspace scans they used to make and
+with the paged list views over maintained indexes they use now.
+
+Redis is filled with `jobs` finished or running job entries, of which
+`active` are still submitted or running, spread over a few queues with a
+few workers each. Each table is timed and its round trips to Redis are
+counted. The tables used to run `KEYS` over the whole keyspace and send one
+command per key; those versions are reproduced in `legacy_*` for comparison.
+The dashboard now loads the first `PAGE_SIZE` rows of each table from
+`list_jobs`, `list_queues` and `list_workers`.
+
+A local Redis server is used when `--redis host:port` is given, otherwise
+the benchmark runs against fakeredis.
+
+Usage:
+    python benchmarks/dashboard.py [--jobs 100000] [--active 1000] [--redis localhost:6379]
+"""
+
+import time
+from argparse import ArgumentParser
+from flexes_build.server import utils
+from redis import ConnectionPool, StrictRedis
+
+QUEUES = ['docker', 'gpu', 'native']
+WORKERS_PER_QUEUE = 4
+config = utils.config
+
+
+class CountingRedis(StrictRedis):
+    """Redis client counting the round trips it makes"""
+    round_trips = 0
+
+    def execute_command(self, *args, **options):
+        CountingRedis.round_trips += 1
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super().pipeline(transaction, shard_hint)
+        execute = pipe.execute
+        def counted_execute(*args, **kwargs):
+            CountingRedis.round_trips += 1
+            return execute(*args, **kwargs)
+        pipe.execute = counted_execute
+        return pipe
+
+
+def legacy_parse_hashmap(db, name, keys):
+    return dict(zip(keys, db.hmget(name, keys)))
+
+
+def legacy_all_running_jobs(db):
+    return [legacy_parse_hashmap(db, job, ['job_id', 'status', 'queue'])
+            for job in db.keys(pattern='{}*'.format(config['JOB_PREFIX']))]
+
+
+def legacy_all_queues(db):
+    return [{'name': queue.replace(config['QUEUE_PREFIX'], ''), 'jobs': db.scard(queue)}
+            for queue in db.keys(pattern='{}*'.format(config['QUEUE_PREFIX']))]
+
+
+def legacy_all_workers(db):
+    workers = []
+    for worker in db.keys(pattern='{}*'.format(config['WORKER_PREFIX'])):
+        worker_id = worker.replace(config['WORKER_PREFIX'], '')
+        workers.append({**{'id': worker_id}, **legacy_parse_hashmap(db, worker, ['status', 'queue'])})
+    return workers
+
+
+def connect(redis):
+    if redis is None:
+        import fakeredis
+        pool = ConnectionPool(connection_class=fakeredis.FakeConnection, 
+                              server=fakeredis.FakeServer(), decode_responses=True)
+        return CountingRedis(connection_pool=pool)
+    host, port = redis.split(':')
+    return CountingRedis(host, int(port), decode_responses=True)
+
+
+def populate(db, jobs, active):
+    db.flushdb()
+    pipe = db.pipeline(transaction=False)
+    for i in range(jobs):
+        queue = QUEUES[i % len(QUEUES)]
+        job_id = 'job-{}'.format(i)
+        status = 'running' if i < active else 'complete'
+        pipe.hset(config['JOB_PREFIX'] + job_id, mapping={'job_id': job_id, 'status': status, 'queue': queue, 
+                                                          'service': queue, 'submitted_at': i})
+        pipe.zadd(config['JOBS_INDEX'], {job_id: i})
+        if i < active:
+            pipe.sadd('{}:jobs'.format(queue), job_id)
+        if i % 10000 == 9999:
+            pipe.execute()
+    for queue in QUEUES:
+        pipe.sadd(config['QUEUES_KEY'], queue)
+        for i in range(WORKERS_PER_QUEUE):
+            worker_id = '{}-{}'.format(queue, i)
+            pipe.hset(config['WORKER_PREFIX'] + worker_id, mapping={'status': 'idle', 'queue': queue})
+            pipe.sadd('{}:workers'.format(queue), worker_id)
+    pipe.execute()
+
+
+def first_page(view, key):
+    def page(db):
+        return view(db, limit=config['PAGE_SIZE'])[key]
+    return page
+
+
+def measure(view, db):
+    CountingRedis.round_trips = 0
+    start = time.perf_counter()
+    result = view(db)
+    return len(result), time.perf_counter() - start, CountingRedis.round_trips
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--jobs', default=100000, type=int, help='number of job entries in Redis')
+    parser.add_argument('--active', default=1000, type=int, help='number of submitted or running jobs')
+    parser.add_argument('--redis', default=None, help='host:port of a Redis server to use instead of fakeredis')
+    args = parser.parse_args()
+
+    db = connect(args.redis)
+    populate(db, args.jobs, args.active)
+    print('{} jobs, {} active, {} keys'.format(args.jobs, args.active, db.dbsize()))
+    views = [('jobs', legacy_all_running_jobs, first_page(utils.list_jobs, 'jobs')),
+             ('queues', legacy_all_queues, first_page(utils.list_queues, 'queues')),
+             ('workers', legacy_all_workers, first_page(utils.list_workers, 'workers'))]
+    for name, before, after in views:
+        for label, view in [('before', before), ('after', after)]:
+            rows, seconds, round_trips = measure(view, db)
+            print('{:8} {:6}: {:8.3f} s, {:7} round trips, {:6} rows'.format(
+                  name, label, seconds, round_trips, rows))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""Compare requests per second and latency of the Flask and async servers.
+
+Each target gets the same workload for `--seconds`: `--clients` concurrent
+clients that each submit a job and then poll its status `--polls` times,
+like API clients waiting on a result. Requests per second and the 50th and
+99th percentile latencies are reported per target.
+
+Start both servers against the same Redis before running, e.g.:
+
+    gunicorn flexes_build.server.app:app -b :8000 --worker-class gthread --threads 32
+    gunicorn flexes_build.server.async_app:app -b :8001 --worker-class aiohttp.GunicornWebWorker
+
+Usage:
+    python benchmarks/load_test.py [--flask http://localhost:8000] [--async http://localhost:8001]
+                                   [--clients 200] [--seconds 30] [--polls 5]
+"""
+
+import asyncio
+import time
+from aiohttp import ClientSession, TCPConnector
+from argparse import ArgumentParser
+
+MESSAGE = {'service': 'load-test', 'queue': 'load-test', 'command': {'arguments': []}}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+async def client(session, url, deadline, polls, latencies, errors):
+    async def timed(method, path, **kwargs):
+        start = time.perf_counter()
+        async with session.request(method, url + path, **kwargs) as response:
+            body = await response.json(content_type=None)
+            if response.status >= 400:
+                errors.append(response.status)
+        latencies.append(time.perf_counter() - start)
+        return body
+
+    while time.time() < deadline:
+        job = await timed('POST', '/', json=MESSAGE)
+        for _ in range(polls):
+            if time.time() >= deadline:
+                break
+            await timed('GET', '/jobs/{}/status'.format(job['job_id']))
+
+
+async def run(url, clients, seconds, polls):
+    latencies = []
+    errors = []
+    connector = TCPConnector(limit=clients)
+    async with ClientSession(connector=connector) as session:
+        deadline = time.time() + seconds
+        start = time.perf_counter()
+        await asyncio.gather(*[client(session, url, deadline, polls, latencies, errors)
+                               for _ in range(clients)])
+        elapsed = time.perf_counter() - start
+    return len(latencies) / elapsed, percentile(latencies, 50), percentile(latencies, 99), len(errors)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--flask', default='http://localhost:8000', help='URL of the Flask server')
+    parser.add_argument('--async', dest='async_url', default='http://localhost:8001',
+                        help='URL of the async server')
+    parser.add_argument('--clients', default=200, type=int, help='number of concurrent clients')
+    parser.add_argument('--seconds', default=30, type=float, help='duration of each run')
+    parser.add_argument('--polls', default=5, type=int, help='status polls per submitted job')
+    args = parser.parse_args()
+
+    for name, url in [('flask', args.flask), ('async', args.async_url)]:
+        rps, p50, p99, errors = asyncio.run(run(url, args.clients, args.seconds, args.polls))
+        print('{:6}: {:8.1f} req/s, p50 {:7.1f} ms, p99 {:7.1f} ms, {} errors'.format(
+              name, rps, p50 * 1000, p99 * 1000, errors))
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""Count the Redis round trips APIWorker makes to dispatch and finish one job.
+
+The worker is run against a recording stand-in for Redis so no server is
+needed. Every command sent directly on the connection is one round trip and
+every pipeline is one round trip when it is executed. The job status updates
+made before pipelining are reproduced in `legacy_update_job` for comparison.
+
+Usage:
+    python benchmarks/update_job_round_trips.py
+"""
+
+import json
+import mock
+import types
+from redis.exceptions import DataError
+from flexes_build.worker.api_worker import APIWorker
+
+MESSAGE = {'job_id': 'benchmark', 'service': 'test', 'command': {'arguments': []}}
+
+
+class RecordingPipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append(name)
+            return self
+        return command
+
+    def hmset(self, name, mapping):
+        # Reject None like redis-py does
+        if any(value is None for value in mapping.values()):
+            raise DataError('Invalid input of type: NoneType')
+        self.commands.append('hmset')
+        return self
+
+    def execute(self):
+        self.redis.round_trips.append('pipeline({})'.format(', '.join(self.commands)))
+        return [None] * len(self.commands)
+
+
+class RecordingRedis(object):
+    def __init__(self):
+        self.round_trips = []
+
+    def pipeline(self, transaction=True):
+        return RecordingPipeline(self)
+
+    def brpop(self, key, timeout=0):
+        self.round_trips.append('brpop')
+        return key, json.dumps(MESSAGE)
+
+    def hget(self, name, key):
+        self.round_trips.append('hget')
+        return 'docker'
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.round_trips.append(name)
+        return command
+
+
+def legacy_update_job(self, job_id, status, result=None, stdout_data=None, stderr_data=None):
+    job = self.config['JOB_PREFIX'] + job_id
+    queue = self.db.hget(job, 'queue')
+    self.db.hmset(job, {'status': status, 'result': result,
+                        'stdout': stdout_data, 'stderr': stderr_data})
+    if status == self.config['STATUS_RUNNING']:
+        self.db.sadd('{}:jobs:running'.format(queue), job_id)
+    elif status in [self.config['STATUS_COMPLETE'], self.config['STATUS_FAIL']]:
+        self.db.expire(job, 60)
+        self.db.srem('{}:jobs'.format(queue), job_id)
+        self.db.srem('{}:jobs:running'.format(queue), job_id)
+    elif status == self.config['STATUS_ACTIVE']:
+        self.db.expire(job, 30)
+        self.db.srem('{}:jobs'.format(queue), job_id)
+        self.db.srem('{}:jobs:running'.format(queue), job_id)
+    return status, result
+
+
+def run_job(legacy=False):
+    with mock.patch('flexes_build.worker.api_worker.StrictRedis'), \
+         mock.patch('boto3.resource'):
+        worker = APIWorker(queue='docker')
+    worker.db = RecordingRedis()
+    worker.launch = mock.MagicMock(return_value=(worker.config['STATUS_COMPLETE'], 'done', None, None))
+    if legacy:
+        worker.update_job = types.MethodType(legacy_update_job, worker)
+    message = worker.receive_message()
+    if legacy:
+        # The job was marked running again when processing started
+        worker.update_job(message['job_id'], worker.config['STATUS_RUNNING'])
+    worker.process_message(message)
+    return worker.db.round_trips
+
+
+if __name__ == '__main__':
+    for name, legacy in [('before', True), ('after', False)]:
+        round_trips = run_job(legacy)
+        print('{}: {} round trips per job'.format(name, len(round_trips)))
+        for command in round_trips:
+            print('    {}'.format(command))
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Measure how many messages and S3 URIs are validated per second.
+
+Validation before the change rebuilt a jsonschema validator for every call
+with `jsonschema.validate`. It is compared with the validator compiled once
+from the message schema and the precompiled S3 URI pattern used now.
+
+Usage:
+    python benchmarks/validation.py [seconds]
+"""
+
+import json
+import sys
+import time
+from flexes_build import config
+from flexes_build.worker import utils
+from jsonschema import validate, ValidationError
+from pathlib import Path
+
+COMMANDS = Path(__file__).resolve().parent.parent.joinpath('test', 'test_commands.json')
+URIS = ['s3://bucket/path/to/input.txt', 's3://bucket/path/to/dir/', 
+        '/local/path/to/input.txt', 'arg_val']
+
+
+def legacy_isvalid(obj, schema):
+    try:
+        validate(obj, schema)
+        return True
+    except ValidationError:
+        return False
+
+
+def rate(function, items, seconds):
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for item in items:
+            function(item)
+        count += len(items)
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    schema = config.load_message_schema()
+    with COMMANDS.open() as f:
+        messages = [dict(message, job_id='benchmark') for message in json.load(f).values()]
+
+    cases = [('messages', messages, 
+              lambda message: legacy_isvalid(message, schema), 
+              utils.is_valid_message),
+             ('S3 URIs', URIS, 
+              lambda uri: legacy_isvalid(uri, schema['definitions']['s3_uri']), 
+              utils.is_s3_uri)]
+    for name, items, before, after in cases:
+        assert([before(item) for item in items] == [after(item) for item in items])
+        before_rate = rate(before, items, seconds)
+        after_rate = rate(after, items, seconds)
+        print('{}: {:,.0f}/s before, {:,.0f}/s after ({:.1f}x)'.format(
+              name, before_rate, after_rate, after_rate / before_rate))
@@ -1,4 +1,5 @@
 import json
+from jsonschema.validators import validator_for
 from pathlib import Path
 
 PACKAGE_DIR = Path(__file__).resolve().parent
@@ -24,3 +25,11 @@ def load_message_schema(message_schema_path=None):
     with message_schema.open() as f:
         schema = json.load(f)
     return schema
+
+
+def load_message_validator(message_schema_path=None):
+    # Compiling the schema once avoids rebuilding a validator on every call
+    schema = load_message_schema(message_schema_path)
+    validator = validator_for(schema)
+    validator.check_schema(schema)
+    return validator(schema)
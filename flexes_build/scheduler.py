@@ -0,0 +1,295 @@
+import json
+import time
+from . import config as configure
+
+config = configure.load_config()
+
+# Jobs one priority level apart are this many seconds apart in their
+# tenant's sorted set, so priority always outranks submission time
+PRIORITY_SPAN = 1e10
+# Jobs submitted together are this many seconds apart so they keep their
+# order, well above the resolution of scores (about 2e-5 s)
+SEQUENCE_STEP = 1e-4
+# Pushed onto the queue list for every scheduled job
+TOKEN = json.dumps({'dispatch': True})
+RETRY = object()
+
+def tenants_key(queue):
+    '''Sorted set of the tenants with queued jobs, scored by their pass'''
+    return '{}:tenants'.format(queue)
+
+
+def pass_key(queue):
+    '''Pass of the last tenant a job was dispatched for'''
+    return '{}:pass'.format(queue)
+
+
+def tenant_queue(queue, tenant):
+    '''Sorted set of a tenant's queued jobs'''
+    return '{}:tenant:{}'.format(queue, tenant)
+
+
+def image(message):
+    '''Name of the Docker image a job runs'''
+    return '{}/{}:{}'.format(config['DOCKER_REGISTRY'], message['service'], message.get('tag', 'latest'))
+
+
+def inputs(message):
+    '''S3 URIs a job downloads before it runs'''
+    command = message.get('command')
+    if command is None:
+        # Test messages only check that the service exists
+        return set()
+    uris = list(command.get('input', []))
+    uris.extend(arg['value'] for arg in command['arguments'] if arg['type'] == 'input')
+    if 'stdin' in command and command['stdin']['type'] == 'uri':
+        uris.append(command['stdin']['value'])
+    return set(uri for uri in uris if uri.startswith('s3://'))
+
+
+def weight(tenant):
+    return config['TENANT_WEIGHTS'].get(tenant, 1)
+
+
+def is_token(raw):
+    return raw == TOKEN
+
+
+def schedule(pipe, queue, messages, submitted_at):
+    '''Add the commands that schedule jobs on a queue to a pipeline
+
+    Each tenant's jobs are held in a sorted set ordered by priority, highest
+    first, and then by submission time and order. A dispatch token is pushed onto the
+    queue list for every job, so workers keep blocking on the list and take
+    the next job from the scheduler for each token they receive.
+
+    The pipeline may belong to a synchronous or an asyncio Redis client.
+
+    Args:
+        pipe (redis.client.Pipeline): A Redis pipeline.
+        queue (str): Queue to schedule the jobs on
+        messages (list): Job messages, with optional `tenant` and `priority`
+        submitted_at (float): Submission time as a Unix timestamp
+    '''
+    for i, message in enumerate(messages):
+        tenant = message.get('tenant', config['DEFAULT_TENANT'])
+        score = submitted_at + i * SEQUENCE_STEP - message.get('priority', 0) * PRIORITY_SPAN
+        pipe.zadd(tenant_queue(queue, tenant), {json.dumps(message): score})
+        # New tenants join at the current pass when they are first picked
+        pipe.zadd(tenants_key(queue), {tenant: 0}, nx=True)
+    pipe.lpush(queue, *[TOKEN] * len(messages))
+
+
+def next_tenant(passes, current):
+    '''Pick the tenant to dispatch a job for with stride scheduling
+
+    Tenants whose pass is behind the current pass have been idle and are
+    moved up to it, so they do not get a burst of jobs to make up for the
+    time they had nothing queued.
+
+    Args:
+        passes (list): (tenant, pass) of every tenant with queued jobs
+        current (float): Pass of the last tenant a job was dispatched for
+
+    Returns:
+        tuple: The tenant with the lowest pass and its pass
+    '''
+    tenant_pass, tenant = min((max(tenant_pass, current), tenant) for tenant, tenant_pass in passes)
+    return tenant, tenant_pass
+
+
+def warm_elsewhere(db, queue, worker, now=None):
+    '''Find the images other workers of a queue could start a job on warm
+
+    Only live workers with a free job slot count, since a job held back for
+    a busy worker would wait for it to finish.
+
+    Args:
+        db (redis.StrictRedis): A Redis database connection.
+        queue (str): Queue name
+        worker (str): ID of the worker to leave out
+        now (float, optional): Current time as a Unix timestamp
+
+    Returns:
+        set: Image names
+    '''
+    now = now if now is not None else time.time()
+    workers = [name for name in db.smembers('{}:workers'.format(queue)) if name != worker]
+    pipe = db.pipeline(transaction=False)
+    for name in workers:
+        pipe.hmget(config['WORKER_PREFIX'] + name, 'status', 'heartbeat', 'images')
+    images = set()
+    for status, heartbeat, warm in pipe.execute():
+        if status == 'idle' and heartbeat is not None and warm is not None \
+                and now - float(heartbeat) < config['WORKER_TIMEOUT']:
+            images.update(json.loads(warm))
+    return images
+
+
+def pick(jobs, images, cached, elsewhere, now):
+    '''Pick the job a worker should run from the head of a tenant's queue
+
+    A job is held back from a worker that does not have its image while
+    another idle worker does, until it has waited `AFFINITY_DELAY` seconds.
+    Of the jobs the worker may run, those with the priority of the first one
+    are ranked by whether their image is warm on the worker and then by how
+    many of their inputs it has cached, so affinity never overrides priority.
+
+    Args:
+        jobs (list): (raw message, score) of the first jobs in the queue
+        images (set): Images warm on the worker
+        cached (set): S3 URIs cached on the worker
+        elsewhere (callable): Returns the images warm on other idle workers,
+            only called for a job whose image is not warm on this worker
+        now (float): Current time as a Unix timestamp
+
+    Returns:
+        str: The raw job message, `None` if the worker should run none of them
+    '''
+    best = None
+    for raw, score in jobs:
+        message = json.loads(raw)
+        priority = message.get('priority', 0)
+        waited = now - (score + priority * PRIORITY_SPAN)
+        warm = image(message) in images
+        if not warm and waited < config['AFFINITY_DELAY'] and image(message) in elsewhere():
+            continue
+        if best is not None and priority != best[1]:
+            break
+        rank = (warm, len(inputs(message) & cached))
+        if best is None or rank > best[2]:
+            best = (raw, priority, rank)
+    return best[0] if best is not None else None
+
+
+def dispatch(db, queue, processing=None, worker=None, images=(), cached=(), token=False):
+    '''Take the next job from a queue's scheduler
+
+    Each dispatch goes to the tenant with the lowest pass, which then
+    advances by `1 / weight`. Tenants therefore get a share of the workers
+    in proportion to their weight in `TENANT_WEIGHTS`, however many jobs
+    each of them has queued.
+
+    When a worker is given, the first `AFFINITY_SCAN` jobs of the tenant
+    are considered and one is chosen with `pick`, so jobs go to workers that
+    already hold their image and inputs. If the worker should run none of
+    them, the dispatch token it took goes back on the queue for another
+    worker.
+
+    Args:
+        db (redis.StrictRedis): A Redis database connection.
+        queue (str): Queue to dispatch from
+        processing (str, optional): Processing list of a reliable worker. A
+            dispatch token in it is replaced with the job's message in the
+            same transaction.
+        worker (str, optional): ID of the worker the job is dispatched to
+        images (iterable, optional): Images warm on the worker
+        cached (iterable, optional): S3 URIs cached on the worker
+        token (bool, optional): Whether the worker took a dispatch token from
+            the queue
+
+    Returns:
+        str: The raw job message, `None` if no job is scheduled for the worker
+    '''
+    if worker is not None:
+        images = set(images)
+        cached = set(cached)
+    found = []
+
+    def elsewhere():
+        # Looked up once per dispatch, and only if a job's image is cold here
+        if len(found) == 0:
+            found.append(warm_elsewhere(db, queue, worker))
+        return found[0]
+
+    def take(pipe):
+        passes = pipe.zrange(tenants_key(queue), 0, -1, withscores=True)
+        if len(passes) == 0:
+            if processing is not None:
+                pipe.multi()
+                pipe.lrem(processing, 1, TOKEN)
+            return None
+        tenant, tenant_pass = next_tenant(passes, float(pipe.get(pass_key(queue)) or 0))
+        jobs = tenant_queue(queue, tenant)
+        pipe.watch(jobs)
+        if worker is None:
+            head = pipe.zrange(jobs, 0, 0, withscores=True)
+        else:
+            head = pipe.zrange(jobs, 0, config['AFFINITY_SCAN'] - 1, withscores=True)
+        remaining = pipe.zcard(jobs)
+
+        pipe.multi()
+        if len(head) == 0:
+            pipe.zrem(tenants_key(queue), tenant)
+            return RETRY
+        raw = head[0][0] if worker is None else pick(head, images, cached, elsewhere, time.time())
+        if raw is None:
+            if processing is not None:
+                pipe.lrem(processing, 1, TOKEN)
+            if token:
+                pipe.lpush(queue, TOKEN)
+            return None
+        pipe.zrem(jobs, raw)
+        if remaining > 1:
+            pipe.zadd(tenants_key(queue), {tenant: tenant_pass + 1 / weight(tenant)})
+        else:
+            pipe.zrem(tenants_key(queue), tenant)
+        pipe.set(pass_key(queue), tenant_pass)
+        if processing is not None:
+            pipe.lrem(processing, 1, TOKEN)
+            pipe.lpush(processing, raw)
+        return raw
+
+    while True:
+        raw = db.transaction(take, tenants_key(queue), pass_key(queue), value_from_callable=True)
+        if raw is not RETRY:
+            return raw
+
+
+def tenant_commands(pipe, queue, tenants):
+    '''Add the commands that read the queued jobs of tenants to a pipeline'''
+    for tenant in tenants:
+        pipe.zcard(tenant_queue(queue, tenant))
+        pipe.zrange(tenant_queue(queue, tenant), 0, 0, withscores=True)
+
+
+def summarize_tenants(tenants, results, now=None):
+    '''Describe the queued jobs of each tenant
+
+    Args:
+        tenants (list): (tenant, pass) of every tenant with queued jobs
+        results (list): Results of the commands from `tenant_commands`
+        now (float, optional): Current time as a Unix timestamp
+
+    Returns:
+        list: The name, weight, pass, number of queued jobs and the time the
+            next job has been waiting in seconds of each tenant
+    '''
+    now = now if now is not None else time.time()
+    summary = []
+    for i, (tenant, tenant_pass) in enumerate(tenants):
+        queued, head = results[2 * i:2 * i + 2]
+        wait = None
+        if len(head) > 0:
+            raw, score = head[0]
+            submitted_at = score + json.loads(raw).get('priority', 0) * PRIORITY_SPAN
+            wait = max(now - submitted_at, 0)
+        summary.append({'tenant': tenant, 'weight': weight(tenant), 'pass': tenant_pass,
+                        'queued': queued, 'wait': wait})
+    return summary
+
+
+def tenant_stats(db, queue):
+    '''List the queued jobs of each tenant of a queue
+
+    Args:
+        db (redis.StrictRedis): A Redis database connection.
+        queue (str): Queue name
+
+    Returns:
+        list: See `summarize_tenants`
+    '''
+    tenants = db.zrange(tenants_key(queue), 0, -1, withscores=True)
+    pipe = db.pipeline(transaction=False)
+    tenant_commands(pipe, queue, [tenant for tenant, _ in tenants])
+    return summarize_tenants(tenants, pipe.execute())
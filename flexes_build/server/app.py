@@ -1,25 +1,26 @@
 #!/usr/bin/env python
 
-import boto3
 import json
 import os
 import requests
 from .. import config as configure
+from .. import scheduler
 from botocore.exceptions import ClientError
-from flask import Flask, Markup, abort, \
+from flask import Flask, Markup, Response, abort, \
                   jsonify, render_template, request
 from flask_swagger_ui import get_swaggerui_blueprint
 from flask_redis import FlaskRedis
 from jinja2.exceptions import TemplateNotFound
 from jsonschema import validate, ValidationError
 from .utils import query_job_status, get_job_result, submit_job, \
-        all_running_jobs, all_queues, all_workers, list_services, \
-        stream_from_s3
+        submit_jobs, assign_tenant, batch_status, list_jobs, list_queues, list_workers, list_services, \
+        job_messages, job_events, wait_for_job, get_service_docs, metrics
 
 app = Flask(__name__)
 
 config = configure.load_config()
-message_schema = configure.load_message_schema()
+message_validator = configure.load_message_validator()
+message_schema = message_validator.schema
 
 REDIS_URL = 'redis://{}:{}/0'.format(config['REDIS_HOST'], config['REDIS_PORT'])
 app.config['REDIS_URL'] = REDIS_URL
@@ -45,13 +46,14 @@ def service_response(message):
                     'message': 'no message found in request'}
         response = jsonify(**response)
         response.status_code = 400
-    elif isvalid(message, message_schema) is False:
+    elif message_validator.is_valid(message) is False:
         response = {'job_id': None,
                     'status': 'error',
                     'message': 'not a valid input'}
         response = jsonify(**response)
         response.status_code = 400
     else:
+        assign_tenant([message], request.headers)
         job_id = submit_job(db, message)
         response = {'job_id': job_id, 
                     'status': 'submitted', 
@@ -74,6 +76,57 @@ def index():
         return response
 
 
+def batch_response(messages):
+    if not isinstance(messages, list) or len(messages) == 0:
+        response = {'batch_id': None, 
+                    'status': 'error', 
+                    'message': 'no messages found in request'}
+        response = jsonify(**response)
+        response.status_code = 400
+        return response
+    if len(messages) > config['MAX_BATCH_SIZE']:
+        response = {'batch_id': None, 
+                    'status': 'error', 
+                    'message': 'batches are limited to {} jobs'.format(config['MAX_BATCH_SIZE'])}
+        response = jsonify(**response)
+        response.status_code = 413
+        return response
+    invalid = [i for i, message in enumerate(messages) if not message_validator.is_valid(message)]
+    if len(invalid) > 0:
+        response = {'batch_id': None, 
+                    'status': 'error', 
+                    'message': 'not a valid input',
+                    'invalid': invalid}
+        response = jsonify(**response)
+        response.status_code = 400
+        return response
+
+    assign_tenant(messages, request.headers)
+    batch_id, job_ids = submit_jobs(db, messages)
+    response = {'batch_id': batch_id, 
+                'job_ids': job_ids,
+                'status': 'submitted', 
+                'message': '{} jobs submitted'.format(len(job_ids))}
+    response = jsonify(**response)
+    response.status_code = 202
+    response.headers['Location'] = '{}/jobs/batch/{}'.format(config['API_ENDPOINT'], batch_id)
+    response.autocorrect_location_header = False
+    return response
+
+
+@app.route('/jobs/batch', methods=['POST'])
+def submit_batch():
+    return batch_response(request.get_json())
+
+
+@app.route('/jobs/batch/<batch_id>', methods=['GET'])
+def query_batch(batch_id):
+    status = batch_status(db, batch_id)
+    if status is None:
+        abort(404)
+    return jsonify(**status)
+
+
 @app.route('/services', methods=['GET'])
 def services():
     tags = request.args.get('tags')
@@ -85,26 +138,104 @@ def services():
 @app.route('/services/<service_name>', methods=['GET'])
 def service_info(service_name):
     tag = request.args.get('tag', config['DEFAULT_TAG'])
-    doc_path = 's3://{}/lanlytics-api/docs/{}/{}/service_docs.json'.format(config['DOCS_BUCKET'], service_name, tag)
     try:
-        s3 = boto3.resource('s3')
-        content = stream_from_s3(doc_path, s3=s3, json=True)
-        return jsonify(**content)
+        content, etag = get_service_docs(service_name, tag)
     except ClientError:
         abort(404)
+    response = jsonify(**content)
+    response.set_etag(etag.strip('"'))
+    response.cache_control.public = True
+    response.cache_control.max_age = config['DOCS_MAX_AGE']
+    # Answers 304 Not Modified when the client already has this version
+    return response.make_conditional(request)
 
 
 @app.route('/dashboard', methods=['GET'])
 def dashboard():
-    jobs = all_running_jobs(db)
-    queues = all_queues(db)
-    workers = all_workers(db)
-    return render_template('dashboard.html', jobs=jobs, queues=queues, workers=workers)
+    # The tables are filled page by page from the JSON endpoints
+    return render_template('dashboard.html', page_size=config['PAGE_SIZE'])
+
+
+def error_response(message, status_code=400):
+    response = jsonify(status='error', message=message)
+    response.status_code = status_code
+    return response
+
+
+def list_args(*filters, order='asc'):
+    # Paging, sorting and filter arguments shared by the list endpoints
+    args = {'order': request.args.get('order', order), 
+            'cursor': request.args.get('cursor'), 
+            'limit': int(request.args.get('limit', config['PAGE_SIZE']))}
+    if args['order'] not in ['asc', 'desc']:
+        raise ValueError('order must be asc or desc')
+    if not 0 < args['limit'] <= config['MAX_PAGE_SIZE']:
+        raise ValueError('limit must be between 1 and {}'.format(config['MAX_PAGE_SIZE']))
+    for name in filters:
+        value = request.args.get(name)
+        args[name] = value.split(',') if value is not None else None
+    return args
+
+
+@app.route('/jobs', methods=['GET'])
+def jobs():
+    try:
+        args = list_args('status', 'queue', order='desc')
+        for name in ['since', 'until']:
+            value = request.args.get(name)
+            args[name] = float(value) if value is not None else None
+        return jsonify(**list_jobs(db, **args))
+    except ValueError as e:
+        return error_response(str(e))
+
+
+@app.route('/queues', methods=['GET'])
+def queues():
+    try:
+        return jsonify(**list_queues(db, **list_args()))
+    except ValueError as e:
+        return error_response(str(e))
+
+
+@app.route('/queues/<queue>/tenants', methods=['GET'])
+def queue_tenants(queue):
+    return jsonify(queue=queue, tenants=scheduler.tenant_stats(db, queue))
+
+
+@app.route('/workers', methods=['GET'])
+def workers():
+    try:
+        return jsonify(**list_workers(db, **list_args('status', 'queue', 'worker_type')))
+    except ValueError as e:
+        return error_response(str(e))
 
 
 @app.route('/jobs/<job_id>/status', methods=['GET'])
 def query_job(job_id):
-    return jsonify(**get_job_status(db, job_id))
+    wait = request.args.get('wait')
+    if wait is None:
+        return jsonify(**query_job_status(db, job_id))
+    try:
+        wait = min(float(wait), config['MAX_WAIT'])
+    except ValueError:
+        return error_response('wait must be a number of seconds')
+    return jsonify(**wait_for_job(db, job_id, wait))
+
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_event_stream(job_id):
+    def stream():
+        # Each stream holds a server thread, so it is closed after MAX_WAIT and 
+        # EventSource clients reconnect to keep following the job
+        for event in job_events(db, job_id, timeout=config['MAX_WAIT'], 
+                                keepalive=config['EVENTS_KEEPALIVE']):
+            if event is None:
+                yield ': keepalive\n\n'
+            else:
+                yield 'event: {}\ndata: {}\n\n'.format(event['event'], json.dumps(event))
+    # Buffering is turned off so nginx forwards each event as it is sent
+    return Response(stream(), mimetype='text/event-stream', 
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/jobs/<job_id>', methods=['GET'])
@@ -114,7 +245,13 @@ def job_result(job_id):
 
 @app.route('/jobs/<job_id>/messages', methods=['GET'])
 def get_job_messages(job_id):
-    return jsonify(**job_messages(db, job_id))
+    return jsonify(job_id=job_id, messages=job_messages(db, job_id))
+
+
+@app.route('/metrics', methods=['GET'])
+def server_metrics():
+    # Counters are kept per server process
+    return Response(metrics(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/deploy', methods=['GET'])
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+
+import flask_swagger_ui
+import jinja2
+import json
+import os
+import redis.asyncio as aioredis
+from .. import config as configure
+from aiohttp import web
+from botocore.exceptions import ClientError
+from .async_utils import query_job_status, get_job_result, submit_job, \
+        submit_jobs, batch_status, list_jobs, list_queues, list_workers, list_services, \
+        job_messages, job_events, wait_for_job, get_service_docs, tenant_stats, JobEvents
+from .utils import assign_tenant, metrics
+
+# Async variant of app.py with the same routes, responses and swagger contract.
+# Run it with:
+#   gunicorn flexes_build.server.async_app:app --worker-class aiohttp.GunicornWebWorker
+
+config = configure.load_config()
+message_validator = configure.load_message_validator()
+
+REDIS_URL = 'redis://{}:{}/0'.format(config['REDIS_HOST'], config['REDIS_PORT'])
+SERVER_DIR = os.path.dirname(os.path.realpath(__file__))
+STATIC_DIR = os.path.join(SERVER_DIR, 'static')
+SWAGGER_URL = '/docs'
+SWAGGER_PATH = '../static/docs/swagger.yml'
+SWAGGER_DIR = os.path.dirname(flask_swagger_ui.__file__)
+
+routes = web.RouteTableDef()
+
+def url_for(endpoint, filename=None, **params):
+    if endpoint == 'static':
+        return '/static/{}'.format(filename)
+    return str(app.router[endpoint].url_for(**params))
+
+
+templates = jinja2.Environment(loader=jinja2.FileSystemLoader([os.path.join(SERVER_DIR, 'templates'),
+                                                               os.path.join(SWAGGER_DIR, 'templates')]),
+                               autoescape=True)
+templates.globals['url_for'] = url_for
+
+
+def render_template(name, status_code=200, **context):
+    return web.Response(text=templates.get_template(name).render(**context),
+                        status=status_code, content_type='text/html')
+
+
+def jsonify(data, status_code=200, headers=None):
+    # DynamoDB items hold Decimals, which are sent as strings like Flask does
+    return web.json_response(data, status=status_code, headers=headers,
+                             dumps=lambda obj: json.dumps(obj, default=str))
+
+
+def error_response(message, status_code=400):
+    return jsonify({'status': 'error', 'message': message}, status_code)
+
+
+async def get_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+async def service_response(db, message, headers):
+    if message is None:
+        response = {'job_id': None,
+                    'status': 'error',
+                    'message': 'no message found in request'}
+        return jsonify(response, 400)
+    elif message_validator.is_valid(message) is False:
+        response = {'job_id': None,
+                    'status': 'error',
+                    'message': 'not a valid input'}
+        return jsonify(response, 400)
+    else:
+        assign_tenant([message], headers)
+        job_id = await submit_job(db, message)
+        response = {'job_id': job_id,
+                    'status': 'submitted',
+                    'message': 'job submitted'}
+        location = '{}/jobs/{}'.format(config['API_ENDPOINT'], job_id)
+        return jsonify(response, 202, headers={'Location': location})
+
+
+@routes.get('/', name='index')
+async def index(request):
+    return render_template('index.html')
+
+
+@routes.post('/')
+async def index_post(request):
+    return await service_response(request.app['db'], await get_json(request), request.headers)
+
+
+async def batch_response(db, messages, headers):
+    if not isinstance(messages, list) or len(messages) == 0:
+        response = {'batch_id': None,
+                    'status': 'error',
+                    'message': 'no messages found in request'}
+        return jsonify(response, 400)
+    if len(messages) > config['MAX_BATCH_SIZE']:
+        response = {'batch_id': None,
+                    'status': 'error',
+                    'message': 'batches are limited to {} jobs'.format(config['MAX_BATCH_SIZE'])}
+        return jsonify(response, 413)
+    invalid = [i for i, message in enumerate(messages) if not message_validator.is_valid(message)]
+    if len(invalid) > 0:
+        response = {'batch_id': None,
+                    'status': 'error',
+                    'message': 'not a valid input',
+                    'invalid': invalid}
+        return jsonify(response, 400)
+
+    assign_tenant(messages, headers)
+    batch_id, job_ids = await submit_jobs(db, messages)
+    response = {'batch_id': batch_id,
+                'job_ids': job_ids,
+                'status': 'submitted',
+                'message': '{} jobs submitted'.format(len(job_ids))}
+    location = '{}/jobs/batch/{}'.format(config['API_ENDPOINT'], batch_id)
+    return jsonify(response, 202, headers={'Location': location})
+
+
+@routes.post('/jobs/batch', name='submit_batch')
+async def submit_batch(request):
+    return await batch_response(request.app['db'], await get_json(request), request.headers)
+
+
+@routes.get('/jobs/batch/{batch_id}', name='query_batch')
+async def query_batch(request):
+    status = await batch_status(request.app['db'], request.match_info['batch_id'])
+    if status is None:
+        raise web.HTTPNotFound()
+    return jsonify(status)
+
+
+@routes.get('/services', name='services')
+async def services(request):
+    tags = request.query.get('tags')
+    tags = tags.split(',') if tags is not None else tags
+    return jsonify(await list_services(tags=tags))
+
+
+@routes.get('/services/{service_name}', name='service_info')
+async def service_info(request):
+    tag = request.query.get('tag', config['DEFAULT_TAG'])
+    try:
+        content, etag = await get_service_docs(request.match_info['service_name'], tag)
+    except ClientError:
+        raise web.HTTPNotFound()
+    headers = {'ETag': etag, 'Cache-Control': 'public, max-age={}'.format(config['DOCS_MAX_AGE'])}
+    if etag in [match.strip() for match in request.headers.get('If-None-Match', '').split(',')]:
+        return web.Response(status=304, headers=headers)
+    return jsonify(content, headers=headers)
+
+
+@routes.get('/dashboard', name='dashboard')
+async def dashboard(request):
+    # The tables are filled page by page from the JSON endpoints
+    return render_template('dashboard.html', page_size=config['PAGE_SIZE'])
+
+
+def list_args(request, *filters, order='asc'):
+    # Paging, sorting and filter arguments shared by the list endpoints
+    args = {'order': request.query.get('order', order),
+            'cursor': request.query.get('cursor'),
+            'limit': int(request.query.get('limit', config['PAGE_SIZE']))}
+    if args['order'] not in ['asc', 'desc']:
+        raise ValueError('order must be asc or desc')
+    if not 0 < args['limit'] <= config['MAX_PAGE_SIZE']:
+        raise ValueError('limit must be between 1 and {}'.format(config['MAX_PAGE_SIZE']))
+    for name in filters:
+        value = request.query.get(name)
+        args[name] = value.split(',') if value is not None else None
+    return args
+
+
+@routes.get('/jobs', name='jobs')
+async def jobs(request):
+    try:
+        args = list_args(request, 'status', 'queue', order='desc')
+        for name in ['since', 'until']:
+            value = request.query.get(name)
+            args[name] = float(value) if value is not None else None
+        return jsonify(await list_jobs(request.app['db'], **args))
+    except ValueError as e:
+        return error_response(str(e))
+
+
+@routes.get('/queues', name='queues')
+async def queues(request):
+    try:
+        return jsonify(await list_queues(request.app['db'], **list_args(request)))
+    except ValueError as e:
+        return error_response(str(e))
+
+
+@routes.get('/queues/{queue}/tenants', name='queue_tenants')
+async def queue_tenants(request):
+    queue = request.match_info['queue']
+    return jsonify({'queue': queue, 'tenants': await tenant_stats(request.app['db'], queue)})
+
+
+@routes.get('/workers', name='workers')
+async def workers(request):
+    try:
+        args = list_args(request, 'status', 'queue', 'worker_type')
+        return jsonify(await list_workers(request.app['db'], **args))
+    except ValueError as e:
+        return error_response(str(e))
+
+
+@routes.get('/jobs/{job_id}/status', name='query_job')
+async def query_job(request):
+    job_id = request.match_info['job_id']
+    wait = request.query.get('wait')
+    if wait is None:
+        return jsonify(await query_job_status(request.app['db'], job_id))
+    try:
+        wait = min(float(wait), config['MAX_WAIT'])
+    except ValueError:
+        return error_response('wait must be a number of seconds')
+    return jsonify(await wait_for_job(request.app['db'], request.app['events'], job_id, wait))
+
+
+@routes.get('/jobs/{job_id}/events', name='job_event_stream')
+async def job_event_stream(request):
+    # Buffering is turned off so nginx forwards each event as it is sent
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream',
+                                           'Cache-Control': 'no-cache',
+                                           'X-Accel-Buffering': 'no'})
+    await response.prepare(request)
+    # Closed after MAX_WAIT like the threaded server, EventSource clients reconnect
+    async for event in job_events(request.app['db'], request.app['events'], request.match_info['job_id'],
+                                  timeout=config['MAX_WAIT'], keepalive=config['EVENTS_KEEPALIVE']):
+        if event is None:
+            await response.write(b': keepalive\n\n')
+        else:
+            await response.write('event: {}\ndata: {}\n\n'.format(event['event'], json.dumps(event)).encode())
+    await response.write_eof()
+    return response
+
+
+@routes.get('/jobs/{job_id}', name='job_result')
+async def job_result(request):
+    return jsonify(await get_job_result(request.app['db'], request.match_info['job_id']))
+
+
+@routes.get('/jobs/{job_id}/messages', name='get_job_messages')
+async def get_job_messages(request):
+    job_id = request.match_info['job_id']
+    return jsonify({'job_id': job_id, 'messages': await job_messages(request.app['db'], job_id)})
+
+
+@routes.get('/metrics', name='server_metrics')
+async def server_metrics(request):
+    # Counters are kept per server process
+    return web.Response(body=metrics().encode(), headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+
+@routes.get('/deploy', name='deploy_app')
+async def deploy_app(request):
+    return jsonify({'message': 'working on it'})
+
+
+@routes.get(SWAGGER_URL)
+async def swagger_redirect(request):
+    raise web.HTTPFound(SWAGGER_URL + '/')
+
+
+@routes.get(SWAGGER_URL + '/{path:.*}', name='swagger_ui')
+async def swagger_ui(request):
+    path = request.match_info['path']
+    if path in ['', 'index.html']:
+        swagger_config = {'dom_id': '#swagger-ui',
+                          'url': SWAGGER_PATH,
+                          'layout': 'StandaloneLayout',
+                          'deepLinking': True,
+                          'oauth2RedirectUrl': str(request.url.with_path(SWAGGER_URL + '/oauth2-redirect.html'))}
+        return render_template('index.template.html', base_url=SWAGGER_URL, app_name='Swagger UI',
+                               config_json=json.dumps(swagger_config))
+    dist = os.path.join(SWAGGER_DIR, 'dist')
+    filename = os.path.realpath(os.path.join(dist, path))
+    if not filename.startswith(dist + os.sep) or not os.path.isfile(filename):
+        raise web.HTTPNotFound()
+    return web.FileResponse(filename)
+
+
+@web.middleware
+async def page_not_found(request, handler):
+    try:
+        return await handler(request)
+    except web.HTTPNotFound:
+        return render_template('404.html', 404)
+
+
+async def connect_redis(app):
+    # One pool per server process, shared by every request it handles
+    pool = aioredis.BlockingConnectionPool.from_url(REDIS_URL, decode_responses=True,
+                                                   max_connections=config['REDIS_MAX_CONNECTIONS'])
+    app['db'] = aioredis.Redis(connection_pool=pool)
+
+
+async def subscribe_events(app):
+    # Waiters share one pubsub connection instead of each holding one from the pool
+    app['events'] = JobEvents(app['db'])
+
+
+async def close_events(app):
+    await app['events'].close()
+
+
+async def close_redis(app):
+    await app['db'].close()
+    await app['db'].connection_pool.disconnect()
+
+
+def create_app(db=None):
+    '''Create the async API server
+
+    Args:
+        db (redis.asyncio.Redis, optional): Redis connection to use instead
+            of connecting to the configured Redis server
+    '''
+    app = web.Application(middlewares=[page_not_found])
+    app.add_routes(routes)
+    app.router.add_static('/static', STATIC_DIR, name='static')
+    if db is None:
+        app.on_startup.append(connect_redis)
+        app.on_cleanup.append(close_redis)
+    else:
+        app['db'] = db
+    app.on_startup.append(subscribe_events)
+    app.on_cleanup.insert(0, close_events)
+    return app
+
+
+app = create_app()
+
+
+if __name__ == '__main__': # pragma: no cover
+    web.run_app(app)
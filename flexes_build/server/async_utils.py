@@ -0,0 +1,449 @@
+import asyncio
+import ujson
+import time
+import weakref
+from . import utils
+from .. import scheduler
+from .utils import config, prepare_jobs, queue_jobs, summarize_batch, \
+        dedupe_key, dedupe_candidate, reusable, status_commands, \
+        hashmap_commands, hashmap_entries, worker_set_commands, worker_set_members, \
+        merge_worker_entries, JobPage, page_items, queue_count_commands, queue_counts, \
+        filter_workers, filter_services, WORKER_KEYS
+from uuid import uuid4
+
+# asyncio counterparts of the Redis helpers in utils.py for the async server.
+# The paging, cursor and filter logic lives in utils.py, only the Redis reads 
+# and writes are repeated here. The registry is read on the event loop, while 
+# DynamoDB and S3 are reached through the blocking boto3 helpers in utils.py, 
+# run on the event loop's default thread pool.
+
+def run_blocking(func, *args):
+    '''Run a blocking function on the default thread pool'''
+    return asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def submit_job(db, message):
+    '''Submit a job to the Redis queue.
+
+    Args:
+        db (redis.asyncio.Redis): A Redis database connection.
+        message (dict): A message containing execution information.
+            Must conform to message_schema.json
+
+    Returns:
+        str: The unique ID for the submitted job, or for the identical job
+            the message was attached to, see `utils.submit_job`
+    '''
+    (queue, queued), = prepare_jobs([message]).items()
+    if message.get('dedupe') is None:
+        pipe = db.pipeline()
+        queue_jobs(pipe, queue, queued)
+        await pipe.execute()
+        return message['job_id']
+
+    key = dedupe_key(message)
+    async def submit(pipe):
+        job_id = dedupe_candidate(await pipe.get(key), message)
+        if job_id is not None:
+            status = (await query_job_status(db, job_id))['status']
+            if await run_blocking(reusable, status, message):
+                return job_id
+        pipe.multi()
+        queue_jobs(pipe, queue, queued)
+        return message['job_id']
+    return await db.transaction(submit, key, value_from_callable=True)
+
+
+async def submit_jobs(db, messages):
+    '''Submit a batch of jobs to the Redis queues, one transaction per queue
+
+    Args:
+        db (redis.asyncio.Redis): A Redis database connection.
+        messages (list): Messages containing execution information.
+            Each must conform to message_schema.json
+
+    Returns:
+        tuple:
+            str: The unique ID for the batch
+            list: The unique ID for each submitted job, in the order of `messages`
+    '''
+    batch_id = str(uuid4())
+    for queue, queued in prepare_jobs(messages, batch_id).items():
+        pipe = db.pipeline()
+        queue_jobs(pipe, queue, queued, batch_id)
+        await pipe.execute()
+    return batch_id, [message['job_id'] for message in messages]
+
+
+async def batch_status(db, batch_id):
+    '''Query the aggregate status of a batch of jobs
+
+    Args:
+        db (redis.asyncio.Redis): A Redis database connection.
+        batch_id (str): The unique ID for the batch.
+
+    Returns:
+        dict: The batch status as returned by `utils.summarize_batch`,
+            `None` if the batch does not exist
+    '''
+    job_ids = sorted(await db.smembers(config['BATCH_PREFIX'] + batch_id))
+    if len(job_ids) == 0:
+        return None
+
+    pipe = db.pipeline(transaction=False)
+    status_commands(pipe, job_ids)
+    statuses = dict(zip(job_ids, await pipe.execute()))
+
+    archived = [job_id for job_id, status in statuses.items() if status is None]
+    if len(archived) > 0:
+        statuses.update(await run_blocking(utils.archived_statuses, archived))
+    return summarize_batch(batch_id, statuses)
+
+
+async def query_job_status(db, job_id):
+    '''Query the status of a job
+
+    Args:
+        db (redis.asyncio.Redis): A Redis database connection.
+        job_id (str): The unique ID for the submitted job.
+
+    Returns:
+        dict: A dictionary with job information including a "status"
+            key with the current status of the job.
+    '''
+    status = await db.hget(config['JOB_PREFIX'] + job_id, 'status')
+    if status is not None:
+        return {'job_id': job_id, 'status': status}
+    else:
+        return await get_job_result(db, job_id)
+
+
+async def get_job_result(db, job_id):
+    '''Query all information of a job
+
+    Args:
+        db (redis.asyncio.Redis): A Redis database connection.
+        job_id (str): The unique ID for the submitted job.
+
+    Returns:
+        dict: A dictionary with all job information.
+    '''
+    result = await db.hgetall(config['JOB_PREFIX'] + job_id)
+    if result != {}:
+        return result
+    else:
+        return await run_blocking(utils.archived_job, job_id)
+
+
+class JobEvents(object):
+    '''Fan the events of jobs out to their waiters from one subscription
+
+    Every SSE stream and long poll of a server process shares a single 
+    pubsub connection, so waiters never hold connections from the Redis pool 
+    that requests are served from. Each waiter gets its own queue of the 
+    events published for its job.
+    '''
+    def __init__(self, db):
+        self.pubsub = db.pubsub(ignore_subscribe_messages=True)
+        self.waiters = {}
+        self.lock = asyncio.Lock()
+        self.active = asyncio.Event()
+        self.closed = False
+        self.reader = None
+
+    async def subscribe(self, job_id):
+        '''Start receiving the events of a job
+
+        Returns:
+            asyncio.Queue: Queue the job's events are put on
+        '''
+        channel = config['EVENTS_PREFIX'] + job_id
+        queue = asyncio.Queue()
+        async with self.lock:
+            if channel not in self.waiters:
+                await self.pubsub.subscribe(channel)
+                self.waiters[channel] = set()
+            self.waiters[channel].add(queue)
+            self.active.set()
+            if self.reader is None:
+                self.reader = asyncio.ensure_future(self.read())
+        return queue
+
+    async def unsubscribe(self, job_id, queue):
+        '''Stop putting the events of a job on a queue'''
+        channel = config['EVENTS_PREFIX'] + job_id
+        async with self.lock:
+            waiters = self.waiters.get(channel)
+            if waiters is None:
+                return
+            waiters.discard(queue)
+            if len(waiters) == 0:
+                del self.waiters[channel]
+                await self.pubsub.unsubscribe(channel)
+            if len(self.waiters) == 0:
+                self.active.clear()
+
+    async def read(self):
+        '''Deliver published events to the queues of their job's waiters'''
+        while not self.closed:
+            # Reading without a subscription returns at once, so wait for one
+            await self.active.wait()
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+            except Exception as e:
+                # The pubsub reconnects and resubscribes on the next read
+                print('Reading job events failed: {}'.format(e))
+                await asyncio.sleep(1)
+                continue
+            if message is not None:
+                event = ujson.loads(message['data'])
+                for queue in self.waiters.get(message['channel'], ()):
+                    queue.put_nowait(event)
+
+    async def close(self):
+        # The reader also stops by itself in case a read swallows the cancellation
+        self.closed = True
+        self.active.set()
+        if self.reader is not None:
+            self.reader.cancel()
+            try:
+                await self.reader
+            except asyncio.CancelledError:
+                pass
+        await self.pubsub.close()
+
+
+async def job_events(db, events, job_id, timeout=None, keepalive=None):
+    '''Follow the status changes and messages of a job as they happen
+
+    See `utils.job_events`.
+
+    Args:
+        db (redis.asyncio.Redis): A Redis database connection.
+        events (JobEvents): The server process's job event subscription
+        job_id (str): The unique ID for the submitted job.
+        timeout (float, optional): Maximum time to follow the job in seconds,
+            default `None` to follow it until it finishes
+        keepalive (float, optional): Time without events after which `None`
+            is yielded, default `None` to never yield `None`
+
+    Yields:
+        dict: Events published for the job, starting with its current status.
+    '''
+    final = [config['STATUS_COMPLETE'], config['STATUS_FAIL'], config['STATUS_ACTIVE']]
+    queue = await events.subscribe(job_id)
+    try:
+        status = await query_job_status(db, job_id)
+        yield {'event': 'status', 'job_id': job_id, 'status': status.get('status')}
+        if status.get('status') in final:
+            return
+
+        deadline = time.time() + timeout if timeout is not None else None
+        last_event = time.time()
+        while deadline is None or time.time() < deadline:
+            wake = [t for t in [deadline, last_event + keepalive if keepalive is not None else None]
+                    if t is not None]
+            wait = max(min(wake) - time.time(), 0) if len(wake) > 0 else None
+            try:
+                event = await asyncio.wait_for(queue.get(), wait)
+            except asyncio.TimeoutError:
+                if keepalive is not None and time.time() - last_event >= keepalive:
+                    last_event = time.time()
+                    yield None
+                continue
+            last_event = time.time()
+            yield event
+            if event.get('event') == 'status' and event.get('status') in final:
+                return
+    finally:
+        await events.unsubscribe(job_id, queue)
+
+
+async def wait_for_job(db, events, job_id, timeout):
+    '''Wait for a job to finish
+
+    Args:
+        db (redis.asyncio.Redis): A Redis database connection.
+        events (JobEvents): The server process's job event subscription
+        job_id (str): The unique ID for the submitted job.
+        timeout (float): Maximum time to wait in seconds.
+
+    Returns:
+        dict: A dictionary with the job_id and the status of the job when it
+            finished or the wait timed out.
+    '''
+    status = None
+    async for event in job_events(db, events, job_id, timeout=timeout):
+        if event['event'] == 'status':
+            status = event['status']
+    return {'job_id': job_id, 'status': status}
+
+
+async def job_messages(db, job_id):
+    '''Retrieve all of the intermediate messages produced by a job.
+
+    Args:
+        db (redis.asyncio.Redis): A Redis database connection.
+        job_id (str): The unique ID for the submitted job.
+
+    Returns:
+        list: The intermediate messages produced by the job.
+    '''
+    messages = await db.get(config['MESSAGE_PREFIX'] + job_id)
+    return ujson.loads(messages) if messages is not None else []
+
+
+async def hashmaps(db, names, keys):
+    '''Retrieve a set of keys from many Redis hashmaps in one round trip
+
+    Args:
+        db (redis.asyncio.Redis): A Redis database connection.
+        names (list): The keys for the hashmaps in the Redis database.
+        keys (list): A list of keys to retrieve from each hashmap.
+
+    Returns:
+        list: A dictionary with the keys and values of each hashmap, `None`
+            for hashmaps that do not exist
+    '''
+    pipe = db.pipeline(transaction=False)
+    hashmap_commands(pipe, names, keys)
+    return hashmap_entries(keys, await pipe.execute())
+
+
+async def active_queues(db):
+    '''List the names of all queues jobs have been submitted to or workers
+    have registered on'''
+    return sorted(await db.smembers(config['QUEUES_KEY']))
+
+
+async def worker_entries(db, keys):
+    '''Retrieve a set of keys from the entry of every live and dead worker
+
+    Args:
+        db (redis.asyncio.Redis): A Redis database connection.
+        keys (list): A list of keys to retrieve from each worker's hashmap.
+
+    Returns:
+        list: Dictionaries with the id and requested keys of each worker,
+            sorted by id
+    '''
+    pipe = db.pipeline(transaction=False)
+    worker_set_commands(pipe, await active_queues(db))
+    worker_ids, dead = worker_set_members(await pipe.execute())
+    entries = await hashmaps(db, [config['WORKER_PREFIX'] + worker_id for worker_id in worker_ids], keys)
+    workers, expired = merge_worker_entries(worker_ids, dead, entries)
+    if len(expired) > 0:
+        await db.srem('workers:dead', *expired)
+    return workers
+
+
+async def list_jobs(db, status=None, queue=None, since=None, until=None,
+                    order='desc', limit=100, cursor=None):
+    '''List one page of jobs ordered by submission time
+
+    See `utils.list_jobs` for the arguments and result.
+
+    Raises:
+        ValueError: If the cursor is malformed
+    '''
+    page = JobPage(status, queue, since, until, order, limit, cursor)
+    if page.live():
+        sets = page.live_sets(queue if queue is not None else await active_queues(db))
+        job_ids = sorted(await db.sunion(sets)) if len(sets) > 0 else []
+        page.collect(job_ids, await hashmaps(db, page.names(job_ids), page.keys))
+        return page.result()
+
+    fetch = db.zrangebyscore if order == 'asc' else db.zrevrangebyscore
+    for index in page.indexes():
+        part = page.part()
+        while not part.full():
+            entries = await fetch(index, *part.bounds, **part.window())
+            if len(entries) == 0:
+                break
+            entries = part.unseen(entries)
+            part.add(entries, await hashmaps(db, part.names([job_id for job_id, _ in entries]), part.keys))
+        if len(part.expired) > 0:
+            await db.zrem(index, *part.expired)
+        page.merge(part)
+    return page.result()
+
+
+async def list_queues(db, order='asc', limit=100, cursor=None):
+    '''List one page of queues ordered by name with their job and worker counts
+
+    See `utils.list_queues` for the arguments and result.
+    '''
+    page, next_cursor = page_items(await active_queues(db), order, limit, cursor)
+    pipe = db.pipeline(transaction=False)
+    queue_count_commands(pipe, page)
+    return {'queues': queue_counts(page, await pipe.execute()), 'next_cursor': next_cursor}
+
+
+async def tenant_stats(db, queue):
+    '''List the queued jobs of each tenant of a queue, see `scheduler.tenant_stats`'''
+    tenants = await db.zrange(scheduler.tenants_key(queue), 0, -1, withscores=True)
+    pipe = db.pipeline(transaction=False)
+    scheduler.tenant_commands(pipe, queue, [tenant for tenant, _ in tenants])
+    return scheduler.summarize_tenants(tenants, await pipe.execute())
+
+
+async def list_workers(db, status=None, queue=None, worker_type=None,
+                       order='asc', limit=100, cursor=None):
+    '''List one page of workers ordered by ID
+
+    See `utils.list_workers` for the arguments and result.
+    '''
+    workers = filter_workers(await worker_entries(db, WORKER_KEYS), status, queue, worker_type)
+    page, next_cursor = page_items(workers, order, limit, cursor, key=lambda worker: worker['id'])
+    return {'workers': page, 'next_cursor': next_cursor}
+
+
+# Registry refresh of the service catalog running on each event loop
+catalog_refreshes = weakref.WeakKeyDictionary()
+
+def refresh_catalog():
+    '''Start refreshing the shared service catalog on the running event loop, 
+    or return the refresh that is already running
+
+    Returns:
+        asyncio.Task: The refresh
+    '''
+    loop = asyncio.get_running_loop()
+    task = catalog_refreshes.get(loop)
+    if task is None or task.done():
+        task = loop.create_task(update_catalog())
+        task.add_done_callback(report_refresh)
+        catalog_refreshes[loop] = task
+    return task
+
+
+async def update_catalog():
+    catalog = utils.catalog
+    catalog.update(await utils.get_services(catalog.responses))
+
+
+def report_refresh(task):
+    if not task.cancelled() and task.exception() is not None:
+        print('Service catalog refresh failed: {}'.format(task.exception()))
+
+
+async def list_services(tags=None):
+    '''List all available services from the shared service catalog
+
+    The registry is read on the event loop with the same caching as 
+    `utils.ServiceCatalog`: the catalog is only fetched in the request when 
+    it is missing or too stale, and a stale copy is served while a single 
+    refresh runs in the background.
+    '''
+    catalog = utils.catalog
+    if catalog.stale():
+        # Shielded so a cancelled request does not cancel the shared refresh
+        await asyncio.shield(refresh_catalog())
+    elif catalog.expired():
+        refresh_catalog()
+    return filter_services(catalog.snapshot(), tags)
+
+
+async def get_service_docs(service, tag):
+    '''Get the documentation of a service and its ETag from the docs cache'''
+    return await run_blocking(utils.get_service_docs, service, tag)
@@ -0,0 +1,32 @@
+// Fill the dashboard tables one page at a time from the JSON list endpoints
+function loadPage(table, cursor) {
+  var params = {limit: table.data('limit')};
+  if (cursor) {
+    params.cursor = cursor;
+  }
+  $.get(table.data('url'), params, function(response) {
+    var columns = table.data('columns').split(',');
+    var rows = response[table.data('key')];
+    $.each(rows, function(_, item) {
+      var row = $('<tr>');
+      $.each(columns, function(_, column) {
+        row.append($('<td>').text(item[column] === null ? '' : item[column]));
+      });
+      table.find('tbody').append(row);
+    });
+    table.nextAll('.empty-message').first().prop('hidden', table.find('tbody tr').length > 0);
+    table.nextAll('.load-more').first()
+      .prop('hidden', !response.next_cursor)
+      .data('cursor', response.next_cursor);
+  });
+}
+
+$(function () {
+  $('.paged-table').each(function () {
+    loadPage($(this));
+  });
+});
+
+$('body').on('click', '.load-more', function () {
+  loadPage($(this).prevAll('.paged-table').first(), $(this).data('cursor'));
+});
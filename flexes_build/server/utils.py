@@ -1,17 +1,51 @@
 import asyncio
 import boto3
 import botocore
+import copy
+import hashlib
 import ujson
 import sys
+import threading
+import time
 from .. import config as configure
+from .. import scheduler
 from aiohttp import ClientSession
+from boto3.dynamodb.types import TypeDeserializer
+from collections import OrderedDict
 from io import BytesIO
 from uuid import uuid4
 
 config = configure.load_config()
 
+def job_entry(message, **fields):
+    '''Convert a message to the fields of its job entry
+
+    Values other than strings and numbers, such as nested values and 
+    booleans, are stored as JSON because Redis hashes only hold strings and 
+    numbers. Fields set to None are left out.
+
+    Args:
+        message (dict): A message containing execution information.
+        **fields: Additional fields for the job entry
+
+    Returns:
+        dict: Fields for the job's hashmap
+    '''
+    def encode(value):
+        if isinstance(value, (str, int, float)) and not isinstance(value, bool):
+            return value
+        return ujson.dumps(value)
+    return {key: encode(value) for key, value in {**message, **fields}.items() if value is not None}
+
+
 def submit_job(db, message):
     '''Submit a job to the Redis queue.
+
+    A message with `dedupe` set is attached to an identical job submitted 
+    within the last `dedupe` seconds while that job is queued or running, 
+    or has completed and its outputs are still in S3. The check and the 
+    submission run in a transaction on the message's dedupe key, so 
+    identical messages submitted at once become a single job.
     
     Args:
         db (redis.StrictRedis): A Redis database connection.
@@ -19,22 +53,316 @@ def submit_job(db, message):
             Must conform to message_schema.json
 
     Returns:
-        str: The unique ID for the submitted job
+        str: The unique ID for the submitted job, or for the identical job 
+            the message was attached to
     '''
-    job_id = str(uuid4())
-    message['job_id'] = job_id
-    message['status'] = 'submitted'
-    queue = message['queue'] if 'queue' in message.keys() else 'docker'
+    (queue, queued), = prepare_jobs([message]).items()
+    if message.get('dedupe') is None:
+        pipe = db.pipeline()
+        queue_jobs(pipe, queue, queued)
+        pipe.execute()
+        return message['job_id']
 
-    job = config['JOB_PREFIX'] + job_id
-    # Create job db entry
-    db.hmset(job, message)
-    # Push to queue
-    db.lpush(queue, ujson.dumps(message))
-    db.sadd('{}:jobs'.format(queue), job_id)
+    key = dedupe_key(message)
+    def submit(pipe):
+        job_id = dedupe_candidate(pipe.get(key), message)
+        if job_id is not None and reusable(query_job_status(db, job_id)['status'], message):
+            return job_id
+        pipe.multi()
+        queue_jobs(pipe, queue, queued)
+        return message['job_id']
+    return db.transaction(submit, key, value_from_callable=True)
+
+
+def dedupe_key(message):
+    '''Key holding the ID of the last job submitted for identical messages
+
+    Messages are identical when they run the same command with the same 
+    service, tag and queue. The tenant, priority and `dedupe` fields do not 
+    change what a job computes, so they are left out of the hash.
+    '''
+    canonical = {'service': message['service'], 
+                 'tag': message.get('tag', config['DEFAULT_TAG']), 
+                 'queue': message.get('queue', 'docker'), 
+                 'command': message['command']}
+    digest = hashlib.sha256(ujson.dumps(canonical, sort_keys=True).encode()).hexdigest()
+    return config['DEDUPE_PREFIX'] + digest
+
+
+def dedupe_entry(job_id, submitted_at):
+    '''Value of a dedupe key, the submission time and ID of the job'''
+    return '{}:{}'.format(submitted_at, job_id)
+
+
+def dedupe_candidate(entry, message, now=None):
+    '''Find the job a dedupe key points to if it is within a message's window
+
+    The key expires with the window of the message that set it, which may 
+    be longer than the window of the new message, so the submission time 
+    stored with the job ID is checked against the new message's `dedupe`.
+
+    Args:
+        entry (str): Value of the dedupe key, `None` if it is not set
+        message (dict): The new message
+        now (float, optional): Current time as a Unix timestamp
+
+    Returns:
+        str: ID of the earlier job, `None` if there is none within the window
+    '''
+    if entry is None:
+        return None
+    submitted_at, job_id = entry.split(':', 1)
+    now = time.time() if now is None else now
+    if now - float(submitted_at) > message['dedupe']:
+        return None
     return job_id
 
 
+def output_uris(command):
+    '''List the S3 URIs a command writes its outputs to'''
+    uris = list(command.get('output', []))
+    uris.extend(arg['value'] for arg in command['arguments'] if arg['type'] == 'output')
+    uris.extend(command[stream]['value'] for stream in ['stdout', 'stderr'] 
+                if stream in command and command[stream]['type'] == 'uri')
+    return [uri for uri in uris if uri.startswith('s3://')]
+
+
+def outputs_exist(command):
+    '''Check that every output of a command is still in S3
+
+    Outputs may be files or directories, so each is looked up as a prefix.
+    '''
+    for uri in output_uris(command):
+        bucket, key = split_s3_uri(uri)
+        response = get_s3().list_objects_v2(Bucket=bucket, Prefix=key, MaxKeys=1)
+        if response.get('KeyCount', 0) == 0:
+            return False
+    return True
+
+
+def reusable(status, message):
+    '''Decide if a job with a status can stand in for an identical message
+
+    A complete job is only reused if its outputs can still be read, which 
+    rules out jobs that piped STDOUT or STDERR.
+
+    Args:
+        status (str): Status of the earlier job
+        message (dict): The new message
+
+    Returns:
+        bool: Whether the message should be attached to the earlier job
+    '''
+    if status in ['submitted', config['STATUS_RUNNING']]:
+        return True
+    if status == config['STATUS_COMPLETE']:
+        command = message['command']
+        # Piped output is only kept in the job's entry, which expires
+        piped = any(command[stream]['type'] == 'pipe' 
+                    for stream in ['stdout', 'stderr'] if stream in command)
+        return not piped and outputs_exist(command)
+    return False
+
+
+def submit_jobs(db, messages):
+    '''Submit a batch of jobs to the Redis queues.
+
+    The jobs for each queue are submitted in a single transaction, so a 
+    batch takes one round trip per queue instead of three per job.
+
+    Args:
+        db (redis.StrictRedis): A Redis database connection.
+        messages (list): Messages containing execution information.
+            Each must conform to message_schema.json
+
+    Returns:
+        tuple:
+            str: The unique ID for the batch
+            list: The unique ID for each submitted job, in the order of `messages`
+    '''
+    batch_id = str(uuid4())
+    for queue, queued in prepare_jobs(messages, batch_id).items():
+        pipe = db.pipeline()
+        queue_jobs(pipe, queue, queued, batch_id)
+        pipe.execute()
+    return batch_id, [message['job_id'] for message in messages]
+
+
+def prepare_jobs(messages, batch_id=None):
+    '''Assign each message a job ID and group the messages by queue
+
+    Args:
+        messages (list): Messages containing execution information.
+        batch_id (str, optional): The unique ID for the batch of the messages
+
+    Returns:
+        dict: The messages for each queue
+    '''
+    queues = {}
+    for message in messages:
+        message['job_id'] = str(uuid4())
+        message['status'] = 'submitted'
+        if batch_id is not None:
+            message['batch_id'] = batch_id
+        queue = message['queue'] if 'queue' in message.keys() else 'docker'
+        queues.setdefault(queue, []).append(message)
+    return queues
+
+
+def assign_tenant(messages, headers):
+    '''Schedule messages as the tenant an authenticating proxy gave the request
+
+    When `TENANT_HEADER` is configured the tenant is taken from that request 
+    header, replacing any tenant set in the messages, and requests without it 
+    run as `DEFAULT_TENANT`. Otherwise the tenant in each message is trusted, 
+    so fair scheduling between tenants is only advisory.
+
+    Args:
+        messages (list): Valid job messages
+        headers (Mapping): Headers of the request that submitted them
+    '''
+    if config['TENANT_HEADER'] is None:
+        return
+    tenant = headers.get(config['TENANT_HEADER'], config['DEFAULT_TENANT'])
+    for message in messages:
+        message['tenant'] = tenant
+
+
+def queue_jobs(pipe, queue, messages, batch_id=None):
+    '''Add the commands that submit jobs to one queue to a pipeline
+
+    The pipeline may belong to a synchronous or an asyncio Redis client, 
+    since the commands are only buffered until it is executed.
+
+    Args:
+        pipe (redis.client.Pipeline): A Redis pipeline.
+        queue (str): Queue to submit the jobs to
+        messages (list): Messages prepared by `prepare_jobs`
+        batch_id (str, optional): The unique ID for the batch of the messages
+    '''
+    job_ids = [message['job_id'] for message in messages]
+    submitted_at = time.time()
+    # Create job db entries
+    for message in messages:
+        pipe.hmset(config['JOB_PREFIX'] + message['job_id'], 
+                   job_entry(message, queue=queue, submitted_at=submitted_at))
+    # Schedule on the queue's fair share of workers
+    scheduler.schedule(pipe, queue, messages, submitted_at)
+    # Let identical messages attach to these jobs
+    for message in messages:
+        if message.get('dedupe') is not None:
+            pipe.set(dedupe_key(message), dedupe_entry(message['job_id'], submitted_at), 
+                     ex=message['dedupe'])
+    pipe.sadd('{}:jobs'.format(queue), *job_ids)
+    pipe.sadd(config['QUEUES_KEY'], queue)
+    # Entries are otherwise only removed when a listing reaches them
+    for index in [config['JOBS_INDEX'], queue_index(queue)]:
+        pipe.zadd(index, {job_id: submitted_at for job_id in job_ids})
+        pipe.zremrangebyscore(index, '-inf', submitted_at - config['JOBS_INDEX_RETENTION'])
+    if batch_id is not None:
+        batch = config['BATCH_PREFIX'] + batch_id
+        pipe.sadd(batch, *job_ids)
+        pipe.expire(batch, config['BATCH_TTL'])
+
+
+def batch_status(db, batch_id):
+    '''Query the aggregate status of a batch of jobs
+
+    Jobs that have left Redis are looked up in DynamoDB.
+
+    Args:
+        db (redis.StrictRedis): A Redis database connection.
+        batch_id (str): The unique ID for the batch.
+
+    Returns:
+        dict: The number of jobs in the batch, the number of jobs with each 
+            status and the status of the batch as a whole, `None` if the 
+            batch does not exist
+    '''
+    job_ids = sorted(db.smembers(config['BATCH_PREFIX'] + batch_id))
+    if len(job_ids) == 0:
+        return None
+
+    pipe = db.pipeline(transaction=False)
+    status_commands(pipe, job_ids)
+    statuses = dict(zip(job_ids, pipe.execute()))
+
+    archived = [job_id for job_id, status in statuses.items() if status is None]
+    if len(archived) > 0:
+        statuses.update(archived_statuses(archived))
+    return summarize_batch(batch_id, statuses)
+
+
+def status_commands(pipe, job_ids):
+    '''Add the commands that read the status of jobs to a pipeline'''
+    for job_id in job_ids:
+        pipe.hget(config['JOB_PREFIX'] + job_id, 'status')
+
+
+def summarize_batch(batch_id, statuses):
+    '''Aggregate the statuses of the jobs in a batch
+
+    Args:
+        batch_id (str): The unique ID for the batch.
+        statuses (dict): The status of each job in the batch, `None` for 
+            jobs that could not be found
+
+    Returns:
+        dict: The number of jobs in the batch, the number of jobs with each 
+            status and the status of the batch as a whole
+    '''
+    counts = {}
+    for status in statuses.values():
+        status = status if status is not None else 'unknown'
+        counts[status] = counts.get(status, 0) + 1
+
+    finished = counts.get(config['STATUS_COMPLETE'], 0) + counts.get(config['STATUS_FAIL'], 0)
+    if counts.get(config['STATUS_COMPLETE'], 0) == len(statuses):
+        status = config['STATUS_COMPLETE']
+    elif finished == len(statuses):
+        status = config['STATUS_FAIL']
+    elif finished > 0 or config['STATUS_RUNNING'] in counts:
+        status = config['STATUS_RUNNING']
+    else:
+        status = 'submitted'
+    return {'batch_id': batch_id, 'status': status, 'total': len(statuses), 'counts': counts}
+
+
+def archived_statuses(job_ids):
+    '''Look up the status of finished jobs in DynamoDB
+
+    Jobs in the finished job cache are not read again.
+
+    Args:
+        job_ids (list): The unique IDs of the jobs.
+
+    Returns:
+        dict: The status of each job found
+    '''
+    statuses = {}
+    uncached = []
+    for job_id in job_ids:
+        hit, item = job_cache.lookup(job_id)
+        if not hit:
+            uncached.append(job_id)
+        elif item is not None:
+            statuses[job_id] = item.get('status')
+
+    dyn = get_dynamodb()
+    # DynamoDB reads at most 100 keys per batch
+    for i in range(0, len(uncached), 100):
+        request = {config['JOBS_TABLE']: {'Keys': [{'job_id': {'S': job_id}} for job_id in uncached[i:i + 100]],
+                                          'ProjectionExpression': 'job_id, #s',
+                                          'ExpressionAttributeNames': {'#s': 'status'}}}
+        while len(request) > 0:
+            response = dyn.batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(config['JOBS_TABLE'], []):
+                item = deserialize_item(item)
+                statuses[item['job_id']] = item.get('status')
+            request = response.get('UnprocessedKeys', {})
+    return statuses
+
+
 def query_job_status(db, job_id):
     '''Query the status of a job
 
@@ -69,10 +397,174 @@ def get_job_result(db, job_id):
     if result != {}:
         return result
     else:
-        dyn = boto3.resource('dynamodb', endpoint_url=config['DYNAMODB_ENDPOINT'])
-        table = dyn.Table(config['JOBS_TABLE'])
-        response = table.get_item(Key={'job_id': job_id})
-        return response['Item'] if 'Item' in response else {'job_id': job_id, 'status': config['STATUS_FAIL'], 'message': 'Job ID {} does not exist'.format(job_id)}
+        return archived_job(job_id)
+
+
+def archived_job(job_id):
+    '''Look up a finished job in DynamoDB through the finished job cache
+
+    Args:
+        job_id (str): The unique ID for the submitted job.
+
+    Returns:
+        dict: All job information, or a failed status if the job does not exist
+    '''
+    hit, item = job_cache.lookup(job_id)
+    if not hit:
+        response = get_dynamodb().get_item(TableName=config['JOBS_TABLE'], 
+                                           Key={'job_id': {'S': job_id}})
+        item = deserialize_item(response['Item']) if 'Item' in response else None
+        job_cache.put(job_id, item)
+    return dict(item) if item is not None else {'job_id': job_id, 'status': config['STATUS_FAIL'], 'message': 'Job ID {} does not exist'.format(job_id)}
+
+
+class JobCache(object):
+    '''LRU cache of the records of finished jobs read from DynamoDB
+
+    Finished jobs never change, so their records are kept until they are 
+    evicted. Job IDs that are not in DynamoDB are remembered for 
+    `negative_ttl` seconds, which covers jobs whose archive write is still 
+    in flight.
+    '''
+    def __init__(self, size, negative_ttl):
+        self.size = size
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, job_id):
+        '''Find a job in the cache
+
+        Returns:
+            tuple:
+                bool: Whether the job was found in the cache
+                dict: The job's record, `None` if the job does not exist
+        '''
+        with self.lock:
+            entry = self.entries.get(job_id)
+            if entry is not None and entry[1] is not None and entry[1] < time.time():
+                del self.entries[job_id]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            self.entries.move_to_end(job_id)
+            return True, entry[0]
+
+    def put(self, job_id, item):
+        '''Cache a job's record, or that it does not exist when `item` is `None`
+
+        Only finished jobs are cached.
+        '''
+        if item is not None and item.get('status') not in [config['STATUS_COMPLETE'], config['STATUS_FAIL']]:
+            return
+        expires = time.time() + self.negative_ttl if item is None else None
+        with self.lock:
+            self.entries[job_id] = (item, expires)
+            self.entries.move_to_end(job_id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 
+                    'misses': self.misses, 
+                    'entries': len(self.entries), 
+                    'hit_ratio': self.hits / lookups if lookups > 0 else 0.0}
+
+
+job_cache = JobCache(config['JOB_CACHE_SIZE'], config['JOB_CACHE_NEGATIVE_TTL'])
+
+
+def metrics():
+    '''Server metrics in the Prometheus text format'''
+    stats = job_cache.stats()
+    lines = []
+    for name, kind, value, description in [
+            ('job_cache_hits_total', 'counter', stats['hits'], 'Finished job lookups served from the cache'),
+            ('job_cache_misses_total', 'counter', stats['misses'], 'Finished job lookups read from DynamoDB'),
+            ('job_cache_entries', 'gauge', stats['entries'], 'Jobs held in the finished job cache'),
+            ('job_cache_hit_ratio', 'gauge', stats['hit_ratio'], 'Share of finished job lookups served from the cache')]:
+        lines.append('# HELP flexes_{} {}'.format(name, description))
+        lines.append('# TYPE flexes_{} {}'.format(name, kind))
+        lines.append('flexes_{} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
+
+
+def job_events(db, job_id, timeout=None, keepalive=None):
+    '''Follow the status changes and messages of a job as they happen
+
+    The job's events channel is subscribed to before its current status is 
+    read, so no change published in between is missed. Following stops once 
+    the job reaches a final status.
+
+    Args:
+        db (redis.StrictRedis): A Redis database connection.
+        job_id (str): The unique ID for the submitted job.
+        timeout (float, optional): Maximum time to follow the job in seconds, 
+            default `None` to follow it until it finishes
+        keepalive (float, optional): Time without events after which `None` 
+            is yielded, default `None` to never yield `None`
+
+    Yields:
+        dict: Events published for the job, starting with its current status. 
+            Status events contain the job_id and status, message events 
+            contain the job_id and messages.
+    '''
+    final = [config['STATUS_COMPLETE'], config['STATUS_FAIL'], config['STATUS_ACTIVE']]
+    pubsub = db.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(config['EVENTS_PREFIX'] + job_id)
+    try:
+        status = query_job_status(db, job_id)
+        yield {'event': 'status', 'job_id': job_id, 'status': status.get('status')}
+        if status.get('status') in final:
+            return
+
+        deadline = time.time() + timeout if timeout is not None else None
+        last_event = time.time()
+        while deadline is None or time.time() < deadline:
+            wake = [t for t in [deadline, last_event + keepalive if keepalive is not None else None] 
+                    if t is not None]
+            wait = max(min(wake) - time.time(), 0) if len(wake) > 0 else None
+            message = pubsub.get_message(timeout=wait)
+            if message is None:
+                if keepalive is not None and time.time() - last_event >= keepalive:
+                    last_event = time.time()
+                    yield None
+                continue
+            last_event = time.time()
+            event = ujson.loads(message['data'])
+            yield event
+            if event.get('event') == 'status' and event.get('status') in final:
+                return
+    finally:
+        pubsub.close()
+
+
+def wait_for_job(db, job_id, timeout):
+    '''Wait for a job to finish
+
+    Args:
+        db (redis.StrictRedis): A Redis database connection.
+        job_id (str): The unique ID for the submitted job.
+        timeout (float): Maximum time to wait in seconds.
+
+    Returns:
+        dict: A dictionary with the job_id and the status of the job when it 
+            finished or the wait timed out.
+    '''
+    status = None
+    for event in job_events(db, job_id, timeout=timeout):
+        if event['event'] == 'status':
+            status = event['status']
+    return {'job_id': job_id, 'status': status}
 
 
 def parse_hashmap(db, name, keys):
@@ -107,53 +599,495 @@ def job_messages(db, job_id):
     return ujson.loads(messages) if messages is not None else []
 
 
-def all_running_jobs(db):
-    '''List all running jobs
+def hashmaps(db, names, keys):
+    '''Retrieve a set of keys from many Redis hashmaps in one round trip
 
     Args:
         db (redis.StrictRedis): A Redis database connection.
+        names (list): The keys for the hashmaps in the Redis database.
+        keys (list): A list of keys to retrieve from each hashmap.
+
+    Returns:
+        list: A dictionary with the keys and values of each hashmap, `None` 
+            for hashmaps that do not exist
+    '''
+    pipe = db.pipeline(transaction=False)
+    hashmap_commands(pipe, names, keys)
+    return hashmap_entries(keys, pipe.execute())
+
+
+def hashmap_commands(pipe, names, keys):
+    '''Add the commands that read a set of keys from many hashmaps to a pipeline'''
+    for name in names:
+        pipe.hmget(name, keys)
+
+
+def hashmap_entries(keys, results):
+    '''Pair the values read by `hashmap_commands` with their keys
 
     Returns:
-        list: A list of jobs as dictionaries containing the 
-            job_id, status and queue for each job.
+        list: A dictionary with the keys and values of each hashmap, `None` 
+            for hashmaps that do not exist
     '''
-    jobs = [parse_hashmap(db, job, ['job_id', 'status', 'queue']) 
-            for job in db.keys(pattern='{}*'.format(config['JOB_PREFIX']))]
-    return jobs
+    return [dict(zip(keys, values)) if any(value is not None for value in values) else None
+            for values in results]
 
 
-def all_queues(db):
-    '''List all queues with active jobs
+def active_queues(db):
+    '''List the names of all queues jobs have been submitted to or workers 
+    have registered on
 
     Args:
         db (redis.StrictRedis): A Redis database connection.
 
     Returns:
-        list: A list of active queues as dictionaries containing the 
-            name and number of jobs in each queue.
+        list: Queue names
     '''
-    queues = [{'name': queue.replace(config['QUEUE_PREFIX'], ''), 'jobs': db.scard(queue)} 
-              for queue in db.keys(pattern='{}*'.format(config['QUEUE_PREFIX']))] 
-    return queues
+    return sorted(db.smembers(config['QUEUES_KEY']))
 
 
-def all_workers(db):
-    '''List all workers
+def worker_entries(db, keys):
+    '''Retrieve a set of keys from the entry of every live and dead worker
 
     Args:
         db (redis.StrictRedis): A Redis database connection.
+        keys (list): A list of keys to retrieve from each worker's hashmap.
 
     Returns:
-        list: A list of workers as dictionaries containing the 
-            id, status and queue for each worker.
+        list: Dictionaries with the id and requested keys of each worker, 
+            sorted by id
     '''
-    workers = []
-    for worker in db.keys(pattern='{}*'.format(config['WORKER_PREFIX'])):
-        worker_id = worker.replace(config['WORKER_PREFIX'], '')
-        workers.append({**{'id': worker_id}, **parse_hashmap(db, worker, ['status', 'queue'])})
+    pipe = db.pipeline(transaction=False)
+    worker_set_commands(pipe, active_queues(db))
+    worker_ids, dead = worker_set_members(pipe.execute())
+    entries = hashmaps(db, [config['WORKER_PREFIX'] + worker_id for worker_id in worker_ids], keys)
+    workers, expired = merge_worker_entries(worker_ids, dead, entries)
+    if len(expired) > 0:
+        db.srem('workers:dead', *expired)
     return workers
 
 
+def worker_set_commands(pipe, queues):
+    '''Add the commands that read the live workers of queues and the dead 
+    workers to a pipeline'''
+    for queue in queues:
+        pipe.smembers('{}:workers'.format(queue))
+    pipe.smembers('workers:dead')
+
+
+def worker_set_members(results):
+    '''Collect the worker IDs read by `worker_set_commands`
+
+    Returns:
+        tuple:
+            list: IDs of every live and dead worker, sorted
+            set: IDs of the dead workers
+    '''
+    *live, dead = results
+    return sorted(set().union(*live, dead)), dead
+
+
+def merge_worker_entries(worker_ids, dead, entries):
+    '''Pair worker IDs with their entries
+
+    Args:
+        worker_ids (list): Worker IDs
+        dead (set): IDs of the dead workers
+        entries (list): The entry of each worker, `None` if it has expired
+
+    Returns:
+        tuple:
+            list: Dictionaries with the id and entry of each worker that 
+                has one
+            list: Dead workers whose entries have expired, to be removed 
+                from the `workers:dead` index
+    '''
+    expired = [worker_id for worker_id, entry in zip(worker_ids, entries) 
+               if entry is None and worker_id in dead]
+    workers = [{**{'id': worker_id}, **entry} 
+               for worker_id, entry in zip(worker_ids, entries) if entry is not None]
+    return workers, expired
+
+
+def encode_cursor(score, member):
+    '''Encode the position of the last item of a page as a cursor'''
+    return '{!r}:{}'.format(score, member)
+
+
+def decode_cursor(cursor):
+    '''Decode a cursor produced by `encode_cursor`
+
+    Raises:
+        ValueError: If the cursor is malformed
+    '''
+    score, member = cursor.split(':', 1)
+    return float(score), member
+
+
+def list_jobs(db, status=None, queue=None, since=None, until=None, 
+              order='desc', limit=100, cursor=None):
+    '''List one page of jobs ordered by submission time
+
+    Jobs are read from the `JOBS_INDEX` sorted set, scored by submission 
+    time, or from the index of each queue in `queue`, and filtered on their 
+    entries. Listing only submitted or running jobs reads the `{queue}:jobs` 
+    or `{queue}:jobs:running` sets instead, which only hold unfinished jobs. 
+    Index entries for jobs that have left Redis are removed as they are 
+    found, and entries older than `JOBS_INDEX_RETENTION` seconds are dropped 
+    whenever jobs are submitted.
+
+    Args:
+        db (redis.StrictRedis): A Redis database connection.
+        status (list, optional): Statuses to include
+        queue (list, optional): Queues to include
+        since (float, optional): Earliest submission time as a Unix timestamp
+        until (float, optional): Latest submission time as a Unix timestamp
+        order (str, optional): `asc` for oldest first or `desc` for newest 
+            first, default `desc`
+        limit (int, optional): Maximum number of jobs, default `100`
+        cursor (str, optional): `next_cursor` of the previous page
+
+    Returns:
+        dict: The jobs on the page and the cursor of the next page, `None` 
+            when there are no more jobs
+
+    Raises:
+        ValueError: If the cursor is malformed
+    '''
+    page = JobPage(status, queue, since, until, order, limit, cursor)
+    if page.live():
+        sets = page.live_sets(queue if queue is not None else active_queues(db))
+        job_ids = sorted(db.sunion(sets)) if len(sets) > 0 else []
+        page.collect(job_ids, hashmaps(db, page.names(job_ids), page.keys))
+        return page.result()
+
+    fetch = db.zrangebyscore if order == 'asc' else db.zrevrangebyscore
+    for index in page.indexes():
+        part = page.part()
+        while not part.full():
+            entries = fetch(index, *part.bounds, **part.window())
+            if len(entries) == 0:
+                break
+            entries = part.unseen(entries)
+            part.add(entries, hashmaps(db, part.names([job_id for job_id, _ in entries]), part.keys))
+        if len(part.expired) > 0:
+            db.zrem(index, *part.expired)
+        page.merge(part)
+    return page.result()
+
+
+def queue_index(queue):
+    '''Name of the sorted set indexing the jobs of a queue by submission time'''
+    return '{}:jobs:index'.format(queue)
+
+
+class JobPage(object):
+    '''Cursor, filter and paging state of one `list_jobs` page
+
+    It holds no connection, so the synchronous and asyncio servers share it 
+    and only read the indexes and the job entries themselves. A page walking 
+    several queue indexes collects a `part` from each one and merges them.
+    '''
+    keys = ['job_id', 'status', 'queue', 'service', 'submitted_at']
+    # Finished jobs leave the queue sets, so these are served from them
+    live_statuses = {'submitted', config['STATUS_RUNNING']}
+
+    def __init__(self, status=None, queue=None, since=None, until=None, 
+                 order='desc', limit=100, cursor=None):
+        self.args = (status, queue, since, until, order, limit, cursor)
+        self.status = status
+        self.queue = queue
+        self.order = order
+        self.limit = limit
+        low = since if since is not None else '-inf'
+        high = until if until is not None else '+inf'
+        self.after = None
+        if cursor is not None:
+            self.after = decode_cursor(cursor)
+            if order == 'asc':
+                low = self.after[0]
+            else:
+                high = self.after[0]
+        self.range = (float(low), float(high))
+        self.bounds = (low, high) if order == 'asc' else (high, low)
+        self.found = []
+        self.expired = []
+        self.offset = 0
+        self.chunk = max(limit, 100)
+
+    def live(self):
+        '''Whether the status filter only matches jobs in the queue sets'''
+        return self.status is not None and set(self.status) <= self.live_statuses
+
+    def live_sets(self, queues):
+        '''Names of the queue sets holding the jobs a `live` page can match'''
+        name = '{}:jobs:running' if set(self.status) == {config['STATUS_RUNNING']} else '{}:jobs'
+        return [name.format(queue) for queue in queues]
+
+    def indexes(self):
+        '''Names of the sorted sets to walk for the page'''
+        if self.queue is None:
+            return [config['JOBS_INDEX']]
+        return [queue_index(queue) for queue in sorted(set(self.queue))]
+
+    def part(self):
+        '''An empty page with the same filters to collect from one index'''
+        return JobPage(*self.args)
+
+    def window(self):
+        '''Keyword arguments that read the next chunk of the index'''
+        return {'start': self.offset, 'num': self.chunk, 'withscores': True}
+
+    def full(self):
+        return len(self.found) >= self.limit
+
+    def seen(self, job_id, score):
+        # Members with equal scores are ordered by ID, in reverse for `desc`
+        if self.after is None or score != self.after[0]:
+            return False
+        return job_id <= self.after[1] if self.order == 'asc' else job_id >= self.after[1]
+
+    def unseen(self, entries):
+        '''Move past a chunk of (job_id, score) index entries, dropping those 
+        on earlier pages'''
+        self.offset += len(entries)
+        return [(job_id, score) for job_id, score in entries if not self.seen(job_id, score)]
+
+    def names(self, job_ids):
+        return [config['JOB_PREFIX'] + job_id for job_id in job_ids]
+
+    def sort(self, found):
+        return sorted(found, key=lambda item: item[:2], reverse=self.order == 'desc')
+
+    def add(self, entries, found):
+        '''Add the jobs that match the filters until the page is full
+
+        Args:
+            entries (list): (job_id, score) index entries
+            found (list): The entry of each job, `None` if it has left Redis
+        '''
+        for (job_id, score), job in zip(entries, found):
+            if job is None:
+                self.expired.append(job_id)
+                continue
+            if self.status is not None and job['status'] not in self.status:
+                continue
+            if self.queue is not None and job['queue'] not in self.queue:
+                continue
+            self.found.append((score, job_id, job))
+            if self.full():
+                break
+
+    def collect(self, job_ids, found):
+        '''Fill the page from unordered jobs read outside of an index
+
+        Args:
+            job_ids (list): IDs of the jobs
+            found (list): The entry of each job, `None` if it has left Redis
+        '''
+        entries = []
+        for job_id, job in zip(job_ids, found):
+            if job is None or job.get('submitted_at') is None:
+                continue
+            score = float(job['submitted_at'])
+            if self.range[0] <= score <= self.range[1] and not self.seen(job_id, score):
+                entries.append((score, job_id, job))
+        for score, job_id, job in self.sort(entries):
+            self.add([(job_id, score)], [job])
+            if self.full():
+                break
+
+    def merge(self, part):
+        '''Merge the jobs collected by a `part` of the page'''
+        self.found = self.sort(self.found + part.found)[:self.limit]
+
+    def result(self):
+        next_cursor = encode_cursor(*self.found[-1][:2]) if self.full() else None
+        return {'jobs': [job for _, _, job in self.found], 'next_cursor': next_cursor}
+
+
+def list_queues(db, order='asc', limit=100, cursor=None):
+    '''List one page of queues ordered by name with their job and worker counts
+
+    Args:
+        db (redis.StrictRedis): A Redis database connection.
+        order (str, optional): `asc` or `desc` by name, default `asc`
+        limit (int, optional): Maximum number of queues, default `100`
+        cursor (str, optional): `next_cursor` of the previous page
+
+    Returns:
+        dict: The queues on the page and the cursor of the next page, `None` 
+            when there are no more queues
+    '''
+    page, next_cursor = page_items(active_queues(db), order, limit, cursor)
+    pipe = db.pipeline(transaction=False)
+    queue_count_commands(pipe, page)
+    return {'queues': queue_counts(page, pipe.execute()), 'next_cursor': next_cursor}
+
+
+QUEUE_COUNTS = ['queued', 'jobs', 'running', 'workers', 'busy_workers']
+
+def queue_count_commands(pipe, queues):
+    '''Add the commands that count the jobs and workers of queues to a pipeline'''
+    for queue in queues:
+        pipe.llen(queue)
+        pipe.scard('{}:jobs'.format(queue))
+        pipe.scard('{}:jobs:running'.format(queue))
+        pipe.scard('{}:workers'.format(queue))
+        pipe.scard('{}:workers:busy'.format(queue))
+
+
+def queue_counts(queues, results):
+    '''Pair the counts read by `queue_count_commands` with their queues'''
+    n = len(QUEUE_COUNTS)
+    return [{'name': queue, **dict(zip(QUEUE_COUNTS, results[i * n:(i + 1) * n]))} 
+            for i, queue in enumerate(queues)]
+
+
+def page_items(items, order, limit, cursor, key=None):
+    '''Cut one page out of items sorted by a unique key
+
+    Args:
+        items (list): Items in ascending order of their key
+        order (str): `asc` or `desc`
+        limit (int): Maximum number of items
+        cursor (str): Key of the last item of the previous page, `None` for 
+            the first page
+        key (callable, optional): Key of an item, defaults to the item itself
+
+    Returns:
+        tuple:
+            list: The items on the page
+            str: Cursor of the next page, `None` when there are no more items
+    '''
+    key = key if key is not None else (lambda item: item)
+    if order == 'desc':
+        items = items[::-1]
+    if cursor is not None:
+        items = [item for item in items if (key(item) > cursor if order == 'asc' else key(item) < cursor)]
+    page = items[:limit]
+    next_cursor = key(page[-1]) if len(items) > limit else None
+    return page, next_cursor
+
+
+def list_workers(db, status=None, queue=None, worker_type=None, 
+                 order='asc', limit=100, cursor=None):
+    '''List one page of workers ordered by ID
+
+    Args:
+        db (redis.StrictRedis): A Redis database connection.
+        status (list, optional): Statuses to include
+        queue (list, optional): Queues to include
+        worker_type (list, optional): Worker classes to include
+        order (str, optional): `asc` or `desc` by ID, default `asc`
+        limit (int, optional): Maximum number of workers, default `100`
+        cursor (str, optional): `next_cursor` of the previous page
+
+    Returns:
+        dict: The workers on the page and the cursor of the next page, `None` 
+            when there are no more workers
+    '''
+    workers = filter_workers(worker_entries(db, WORKER_KEYS), status, queue, worker_type)
+    page, next_cursor = page_items(workers, order, limit, cursor, key=lambda worker: worker['id'])
+    return {'workers': page, 'next_cursor': next_cursor}
+
+
+WORKER_KEYS = ['status', 'queue', 'worker_type', 'instance_type', 
+               'concurrency', 'busy_slots', 'heartbeat']
+
+def filter_workers(workers, status=None, queue=None, worker_type=None):
+    '''Keep the workers with one of the given statuses, queues and types'''
+    return [worker for worker in workers
+            if (status is None or worker['status'] in status) 
+            and (queue is None or worker['queue'] in queue) 
+            and (worker_type is None or worker['worker_type'] in worker_type)]
+
+
+class ServiceCatalog(object):
+    '''Shared cache of the services in the Docker registry
+
+    The catalog is served from memory for `ttl` seconds. After that the stale 
+    copy keeps being served while a single background thread refreshes it, 
+    and only a catalog older than `max_stale` seconds is refreshed in the 
+    request itself. Registry responses are kept with their ETags so unchanged 
+    pages are revalidated instead of downloaded again.
+    '''
+    def __init__(self, ttl, max_stale):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        '''Drop the cached catalog and registry responses'''
+        self.services = None
+        self.updated = 0
+        self.responses = {}
+        self.refreshing = False
+
+    def age(self):
+        return time.time() - self.updated
+
+    def stale(self):
+        '''Whether the catalog is missing or too old to be served'''
+        return self.services is None or self.age() > self.max_stale
+
+    def expired(self):
+        '''Whether the catalog is due for a background refresh'''
+        return self.age() > self.ttl
+
+    def snapshot(self):
+        '''Return a copy of the catalog that callers may modify'''
+        return copy.deepcopy(self.services)
+
+    def update(self, services):
+        '''Replace the catalog with freshly fetched services'''
+        with self.lock:
+            self.services = services
+            self.updated = time.time()
+
+    def refresh(self):
+        '''Fetch the catalog from the registry'''
+        with self.refresh_lock:
+            # Each refresh runs on its own event loop so it is safe from 
+            # request and background threads alike
+            self.update(asyncio.run(get_services(self.responses)))
+
+    def refresh_in_background(self):
+        '''Start a background refresh unless one is already running'''
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                print('Service catalog refresh failed: {}'.format(e))
+            finally:
+                with self.lock:
+                    self.refreshing = False
+        threading.Thread(target=run, daemon=True).start()
+
+    def get(self):
+        '''Return a copy of the catalog, refreshing it if it is out of date'''
+        if self.stale():
+            with self.refresh_lock:
+                # Another request may have refreshed it while this one waited
+                if self.stale():
+                    self.refresh()
+            return self.snapshot()
+        services = self.snapshot()
+        if self.expired():
+            self.refresh_in_background()
+        return services
+
+
+catalog = ServiceCatalog(config['CATALOG_TTL'], config['CATALOG_MAX_STALE'])
+
+
 def list_services(tags=None):
     '''List all available services deployed through the API
 
@@ -176,9 +1110,19 @@ def list_services(tags=None):
             ]
         }
     '''
-    loop = asyncio.get_event_loop()
-    responses = loop.run_until_complete(get_services())
+    return filter_services(catalog.get(), tags)
+
 
+def filter_services(responses, tags=None):
+    '''Keep the services with any of the given tags, and only those tags
+
+    Args:
+        responses (list): Services and their tags, modified in place
+        tags (list, optional): Tags to keep, default `None` to keep all
+
+    Returns:
+        dict: The services as returned by `list_services`
+    '''
     if tags is not None:
         services = {'services': []}
         for response in responses:
@@ -191,9 +1135,13 @@ def list_services(tags=None):
         return {'services': responses}
 
 
-async def get_services():
+async def get_services(responses=None):
     '''Retrieve all of the images and their tags contained in the Docker registry
 
+    Args:
+        responses (dict, optional): Earlier registry responses by URL, used for 
+            conditional requests and updated in place
+
     Returns:
         list: A list of responses from the Docker registry
 
@@ -202,32 +1150,165 @@ async def get_services():
             {'name': 'serviceB', 'tags': ['latest', dev]}
         ]
     '''
+    if responses is None:
+        responses = {}
+    semaphore = asyncio.Semaphore(config['CATALOG_CONCURRENCY'])
+    registry = 'https://{}'.format(config['DOCKER_REGISTRY'])
     async with ClientSession() as session:
-        url = 'https://{}/v2/_catalog'.format(config['DOCKER_REGISTRY'])
-        services = await fetch(session, url)
-        tasks = []
-        for service in services['repositories']:
-            url = 'https://{}/v2/{}/tags/list'.format(config['DOCKER_REGISTRY'], service)
-            task = asyncio.ensure_future(fetch(session, url))
-            tasks.append(task)
+        url = '{}/v2/_catalog?n={}'.format(registry, config['CATALOG_PAGE_SIZE'])
+        repositories = []
+        async for page in fetch_pages(session, url, semaphore, responses):
+            repositories.extend(page.get('repositories') or [])
 
+        tasks = [get_tags(session, registry, repository, semaphore, responses) 
+                 for repository in repositories]
         return await asyncio.gather(*tasks)
 
 
-async def fetch(session, url):
-    '''Wrapper for aiohttp GET request
+async def get_tags(session, registry, repository, semaphore, responses):
+    '''Retrieve every tag of one repository in the Docker registry'''
+    url = '{}/v2/{}/tags/list?n={}'.format(registry, repository, config['CATALOG_PAGE_SIZE'])
+    tags = []
+    async for page in fetch_pages(session, url, semaphore, responses):
+        tags.extend(page.get('tags') or [])
+    return {'name': repository, 'tags': tags}
+
+
+async def fetch_pages(session, url, semaphore, responses):
+    '''Yield each page of a paginated registry listing'''
+    while url is not None:
+        page, url = await fetch(session, url, semaphore, responses)
+        yield page
+
+
+async def fetch(session, url, semaphore, responses):
+    '''Wrapper for a conditional aiohttp GET request
     
     Args:
         session (aiohttp.ClientSession): HTTP session
         url (str): URL to fetch
+        semaphore (asyncio.Semaphore): Limit on concurrent requests
+        responses (dict): Earlier responses by URL, updated in place
 
     Returns:
-        coroutine: The request response in JSON format
+        tuple: The response in JSON format and the URL of the next page 
+            from the `Link` header, or None on the last page
     '''
-    async with session.get(url) as response:
-        return await response.json()
+    cached = responses.get(url)
+    headers = {'If-None-Match': cached['etag']} if cached is not None else {}
+    async with semaphore:
+        async with session.get(url, headers=headers) as response:
+            if response.status == 304 and cached is not None:
+                return cached['body'], cached['next']
+            response.raise_for_status()
+            body = await response.json()
+            link = response.links.get('next')
+            next_url = str(response.url.join(link['url'])) if link is not None else None
+            etag = response.headers.get('ETag')
+            if etag is not None:
+                responses[url] = {'etag': etag, 'body': body, 'next': next_url}
+            return body, next_url
 
 # AWS Utils
+s3_client = None
+s3_lock = threading.Lock()
+
+def get_s3():
+    '''Return the S3 client shared by every request, creating it on first use'''
+    global s3_client
+    with s3_lock:
+        if s3_client is None:
+            s3_client = boto3.client('s3', endpoint_url=config['S3_ENDPOINT'])
+        return s3_client
+
+
+dynamodb_client = None
+dynamodb_lock = threading.Lock()
+deserializer = TypeDeserializer()
+
+def get_dynamodb():
+    '''Return the DynamoDB client shared by every request, creating it on first use'''
+    global dynamodb_client
+    with dynamodb_lock:
+        if dynamodb_client is None:
+            dynamodb_client = boto3.client('dynamodb', endpoint_url=config['DYNAMODB_ENDPOINT'])
+        return dynamodb_client
+
+
+def deserialize_item(item):
+    '''Convert a DynamoDB item from the client's typed format to plain values'''
+    return {key: deserializer.deserialize(value) for key, value in item.items()}
+
+
+class DocsCache(object):
+    '''LRU cache of parsed service documentation
+
+    Entries are keyed by service and tag. Once an entry is older than 
+    `revalidate` seconds it is checked against S3 with its ETag, and the 
+    documentation is only downloaded again if it has changed.
+    '''
+    def __init__(self, size, revalidate):
+        self.size = size
+        self.revalidate = revalidate
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def fetch(self, bucket, key, entry):
+        request = {'Bucket': bucket, 'Key': key}
+        if entry is not None:
+            request['IfNoneMatch'] = entry['etag']
+        try:
+            response = get_s3().get_object(**request)
+        except botocore.exceptions.ClientError as e:
+            if entry is not None and e.response['Error']['Code'] in ['304', 'NotModified']:
+                return dict(entry, checked=time.time())
+            raise
+        return {'docs': ujson.loads(response['Body'].read()), 
+                'etag': response['ETag'], 
+                'checked': time.time()}
+
+    def get(self, service, tag):
+        '''Return the documentation of a service and its S3 ETag
+
+        Raises:
+            botocore.exceptions.ClientError: The documentation does not exist
+        '''
+        key = (service, tag)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or time.time() - entry['checked'] > self.revalidate:
+            doc_key = 'lanlytics-api/docs/{}/{}/service_docs.json'.format(service, tag)
+            entry = self.fetch(config['DOCS_BUCKET'], doc_key, entry)
+            with self.lock:
+                self.entries[key] = entry
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        return entry['docs'], entry['etag']
+
+
+docs_cache = DocsCache(config['DOCS_CACHE_SIZE'], config['DOCS_REVALIDATE'])
+
+
+def get_service_docs(service, tag):
+    '''Get the documentation of a service from the docs cache
+
+    Args:
+        service (str): Name of the service
+        tag (str): Image tag of the service
+
+    Returns:
+        tuple: The documentation and its ETag
+    '''
+    return docs_cache.get(service, tag)
+
+
 def split_s3_uri(uri):
     '''Split S3 URI into bucket and key parts'''
     return uri.split('/', 3)[2:]
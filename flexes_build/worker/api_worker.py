@@ -3,18 +3,26 @@
 import argparse
 import boto3
 import copy
+import io
 import json
 import os
 import shutil
 import signal
 import sys
+import threading
 import time
 import traceback
 from . import utils
 from .. import config
+from .. import scheduler
+from .archiver import JobArchiver
+from .input_cache import InputCache
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
 from itertools import cycle
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from pathlib import Path
+from queue import Queue
 from redis import StrictRedis
 from uuid import uuid4
 
@@ -25,27 +33,105 @@ class APIWorker(object):
 
     Attributes:
         config (dict): Worker configuration
-        local_files_path (str): Worker's root directory
+        message_validator (jsonschema.protocols.Validator): Message schema 
+            validator, compiled once for the worker
+        local_files_path (str): Worker's root directory, each job runs in a slot 
+            worker with its own directory
         queue (str): Queue worker listens to, default `docker`
-        poll_frequency (int): Worker queue poll frequency in seconds, default `1`
+        poll_frequency (int): Worker queue poll frequency in seconds, default `1`. 
+            In blocking mode this is only how long the worker waits after leaving 
+            a job to a worker with its image.
+        blocking (bool): Block on the queue instead of polling it, default `True`
+        block_timeout (int): Timeout of each blocking pop in seconds, an idle 
+            worker sends one command per timeout
+        reliable (bool): Move received messages into a per-worker processing list 
+            until they are finished so a reaper can requeue them if the worker dies, 
+            default `False`
+        concurrency (int): Number of jobs the worker runs at once, default `1`
+        slot (int): Job slot a slot worker runs in, `None` for the main worker
+        busy_slots (int): Number of job slots currently running a job
+        in_flight (dict): Raw messages currently held by the worker keyed by job ID
+        stopped (threading.Event): Set when the worker stops to end background threads
         db (redis.StrictRedis): Redis connection, connection parameters are specified 
             in the worker configuration file.
-        s3 (boto3.resource): S3 connection
+        s3 (botocore.client.S3): S3 client, shared by all transfers and slot workers 
+            since clients are thread-safe and resources are not
+        transfer_config (boto3.s3.transfer.TransferConfig): Multipart settings for 
+            S3 transfers
+        input_cache (InputCache): Cache of S3 inputs shared by the worker's jobs, 
+            `None` when `INPUT_CACHE_SIZE` is `0`
         dyn (boto3.resource): DynamoDB connection
+        archiver (JobArchiver): Writes finished jobs to DynamoDB in the background
 
     Args:
         queue (str): Queue worker listens to, default `docker`
         poll_frequency (int): Worker queue poll frequency in seconds, default `1`
+        blocking (bool): Block on the queue instead of polling it, default `True`
+        block_timeout (int): Timeout of each blocking pop in seconds, default 
+            `BLOCK_TIMEOUT`
+        reliable (bool): Use the reliable queue, default `False`
+        concurrency (int): Number of jobs the worker runs at once, default `1`
     """
     def __init__(self, *args, **kwargs):
         self.config = config.load_config()
-        self.message_schema = config.load_message_schema()
-        self.local_files_path = str(Path.home().joinpath('lanlytics_worker_local', str(uuid4().hex)))
+        self.message_validator = config.load_message_validator()
+        self.message_schema = self.message_validator.schema
+        self.local_files_path = self.new_local_files_path()
         self.queue = kwargs.get('queue', 'docker')
         self.poll_frequency = kwargs.get('poll_frequency', 1)
+        self.blocking = kwargs.get('blocking', True)
+        self.block_timeout = kwargs.get('block_timeout') or self.config['BLOCK_TIMEOUT']
+        self.reliable = kwargs.get('reliable', False)
+        self.in_flight = {}
+        self.stopped = threading.Event()
+        self.concurrency = kwargs.get('concurrency', 1)
+        self.slot = None
+        self.instance_id = None
+        self.busy_slots = 0
+        self.slot_lock = threading.Lock()
         self.db = StrictRedis(self.config['REDIS_HOST'], self.config['REDIS_PORT'], decode_responses=True)
-        self.s3 = boto3.resource('s3', endpoint_url=self.config['S3_ENDPOINT'])
+        self.s3 = boto3.client('s3', endpoint_url=self.config['S3_ENDPOINT'])
+        self.transfer_config = TransferConfig(multipart_threshold=self.config['S3_MULTIPART_THRESHOLD'], 
+                                              multipart_chunksize=self.config['S3_MULTIPART_CHUNKSIZE'], 
+                                              max_concurrency=self.config['S3_TRANSFER_CONCURRENCY'])
+        self.input_cache = None
+        if self.config['INPUT_CACHE_SIZE'] > 0:
+            cache_dir = self.config['INPUT_CACHE_DIR'] or str(Path.home().joinpath('lanlytics_worker_cache'))
+            self.input_cache = InputCache(cache_dir, self.config['INPUT_CACHE_SIZE'])
         self.dyn = boto3.resource('dynamodb', endpoint_url=self.config['DYNAMODB_ENDPOINT'])
+        self.archiver = JobArchiver(self.dyn, self.config['JOBS_TABLE'], 
+                                    batch_size=self.config['ARCHIVE_BATCH_SIZE'], 
+                                    flush_interval=self.config['ARCHIVE_FLUSH_INTERVAL'], 
+                                    max_pending=self.config['ARCHIVE_MAX_PENDING'], 
+                                    max_retries=self.config['ARCHIVE_MAX_RETRIES'], 
+                                    max_requeues=self.config['ARCHIVE_MAX_REQUEUES'])
+
+    @staticmethod
+    def new_local_files_path():
+        """Create a unique local directory path for a job
+
+        Returns:
+            str: Local directory path
+        """
+        return str(Path.home().joinpath('lanlytics_worker_local', str(uuid4().hex)))
+
+    def slot_worker(self, slot):
+        """Create a worker to run a single job in a job slot
+
+        The slot worker shares this worker's configuration, registration and 
+        Redis, S3 and DynamoDB connections but has its own local files directory, 
+        so concurrent jobs never see each other's files.
+
+        Args:
+            slot (int): Job slot the job runs in
+
+        Returns:
+            APIWorker: Worker for the job
+        """
+        worker = copy.copy(self)
+        worker.slot = slot
+        worker.local_files_path = self.new_local_files_path()
+        return worker
 
     def test_service(self, message):
         print('Confirmed active status for {}'.format(message['service']))
@@ -54,6 +140,8 @@ class APIWorker(object):
     def process_message(self, message):
         """Execute a job based on a message received from the queue
 
+        The job was already marked running by `receive_message`.
+
         Args:
             message (dict): Message received from queue
 
@@ -62,15 +150,13 @@ class APIWorker(object):
         """
         print('Received message: {}'.format(message['job_id']))
         try:
-            validate(message, self.message_schema)
+            self.message_validator.validate(message)
             if 'test' in message and message['test']:
-                self.update_job(message['job_id'], self.config['STATUS_RUNNING'], None)
                 return self.test_service(message)
         except ValidationError as e:
             print('Message JSON failed validation')
             return self.handle_exception(message['job_id'], e)
 
-        self.update_job(message['job_id'], self.config['STATUS_RUNNING'])
         try:
             status, result, stdout_data, stderr_data = self.launch(message)
             print('Result: {}'.format(result))
@@ -81,61 +167,130 @@ class APIWorker(object):
     def receive_message(self):
         """Receive message from queue
 
+        In blocking mode the worker waits on the queue for up to `block_timeout` 
+        seconds so a job is dispatched as soon as it is pushed, otherwise the 
+        queue is checked once and the method returns immediately. In reliable 
+        mode the message is atomically moved into the worker's processing list 
+        where it stays until `acknowledge_message` is called.
+
+        Jobs submitted through the API are held by the queue's fair scheduler 
+        and the queue only holds a dispatch token for each of them. For a token 
+        the next job is taken from the scheduler, which is also checked when the 
+        queue is empty in case a token was lost with a worker. The scheduler 
+        prefers jobs whose image and inputs this worker already holds.
+
         Returns:
-            dict: Job message
+            dict: Job message, `None` if the queue is empty
         """
-        message = self.db.rpop(self.queue)
-        if message is not None:
-            message = json.loads(message)
+        if self.reliable and self.blocking:
+            raw = self.db.brpoplpush(self.queue, self.processing_queue, timeout=self.block_timeout)
+        elif self.reliable:
+            raw = self.db.rpoplpush(self.queue, self.processing_queue)
+        elif self.blocking:
+            item = self.db.brpop(self.queue, timeout=self.block_timeout)
+            raw = item[1] if item is not None else None
+        else:
+            raw = self.db.rpop(self.queue)
+        if raw is None or scheduler.is_token(raw):
+            token = raw is not None
+            raw = scheduler.dispatch(self.db, self.queue, 
+                                     self.processing_queue if self.reliable else None, 
+                                     worker=self.instance_id, 
+                                     images=self.warm_images(), 
+                                     cached=self.warm_inputs(), 
+                                     token=token)
+            if raw is None and token:
+                # The job is held for a worker with its image, which gets the 
+                # token back while this worker waits
+                self.stopped.wait(self.poll_frequency)
+        message = None
+        if raw is not None:
+            message = json.loads(raw)
+            self.in_flight[message['job_id']] = raw
             self.update_job(message['job_id'], self.config['STATUS_RUNNING'])
         return message
 
-    def update_job(self, job_id, status, result=None, stdout_data=None, stderr_data=None):
+    def acknowledge_message(self, message):
+        """Mark a received message as finished
+
+        In reliable mode this removes the message from the worker's processing 
+        list, after which it can no longer be requeued by the reaper.
+
+        Args:
+            message (dict): Job message returned by `receive_message`
+        """
+        raw = self.in_flight.pop(message['job_id'], None)
+        if self.reliable and raw is not None:
+            self.db.lrem(self.processing_queue, 1, raw)
+
+    @property
+    def processing_queue(self):
+        """str: Name of the list holding messages this worker is processing"""
+        return '{}:processing:{}'.format(self.queue, self.instance_id)
+
+    def update_job(self, job_id, status, result=None, stdout_data=None, stderr_data=None, queue=None):
         """Update job status in database
 
+        All of the Redis writes for a status change are sent as a single 
+        MULTI/EXEC transaction, which also publishes the change on the job's 
+        events channel. Finished jobs are handed to the archiver, which writes 
+        them to DynamoDB in the background.
+
         Args:
             job_id (str): Unique ID for job
             status (str): New job status
             result (str, optional): Result of job execution, default `None`
             stdout_data (str, optional): Return from STDOUT, default `None`
             stderr_data (str, optional): Return from STDERR, default `None`
+            queue (str, optional): Queue the job was received from, defaults to 
+                the worker's queue
 
         Returns:
             tuple: (job_status, job_result) 
         """
         job = self.config['JOB_PREFIX'] + job_id
-        queue = self.db.hget(job, 'queue')
-        self.db.hmset(job, 
-                      {'status': status, 
-                       'result': result, 
-                       'stdout': stdout_data, 
-                       'stderr': stderr_data})
+        queue = queue if queue is not None else self.queue
+        fields = {'status': status, 
+                  'result': result, 
+                  'stdout': stdout_data, 
+                  'stderr': stderr_data}
+        pipe = self.db.pipeline()
+        # Redis hashes cannot hold None, so unset fields are left out
+        pipe.hmset(job, {key: value for key, value in fields.items() if value is not None})
         if status == self.config['STATUS_RUNNING']:
-            self.db.sadd('{}:jobs:running'.format(queue), job_id)
+            pipe.sadd('{}:jobs:running'.format(queue), job_id)
         elif status in [self.config['STATUS_COMPLETE'], self.config['STATUS_FAIL']]:
-            self.db.expire(job, 60)
-            self.db.srem('{}:jobs'.format(queue), job_id)
-            self.db.srem('{}:jobs:running'.format(queue), job_id)
-            table = self.dyn.Table(self.config['JOBS_TABLE'])
-            table.update_item(Key={'job_id': job_id},
-                              UpdateExpression='SET #stat = :val1, #r = :val2',
-                              ExpressionAttributeNames={'#stat': 'status', '#r': 'result'},
-                              ExpressionAttributeValues={':val1': status, ':val2': result})
+            pipe.expire(job, 60)
+            pipe.expire(self.config['MESSAGE_PREFIX'] + job_id, 60)
+            pipe.srem('{}:jobs'.format(queue), job_id)
+            pipe.srem('{}:jobs:running'.format(queue), job_id)
         elif status == self.config['STATUS_ACTIVE']:
-            self.db.expire(job, 30)
-            self.db.srem('{}:jobs'.format(queue), job_id)
-            self.db.srem('{}:jobs:running'.format(queue), job_id)
+            pipe.expire(job, 30)
+            pipe.srem('{}:jobs'.format(queue), job_id)
+            pipe.srem('{}:jobs:running'.format(queue), job_id)
+        pipe.publish(self.config['EVENTS_PREFIX'] + job_id, 
+                     json.dumps({'event': 'status', 'job_id': job_id, 'status': status}))
+        pipe.execute()
+
+        if status in [self.config['STATUS_COMPLETE'], self.config['STATUS_FAIL']]:
+            self.archiver.archive(job_id, status, result)
         return status, result
 
     def update_job_messages(self, job_id, messages):
         """Update intermediate job execution messages in database
 
+        Messages are stored as JSON under the job's message key, where the 
+        server reads them from, and published on the job's events channel.
+
         Args:
             job_id (str): Unique ID for job
             messages (list): List of messages from running job
         """
-        job = self.config['JOB_PREFIX'] + job_id
-        self.db.hmset(job, {'messages': messages})
+        pipe = self.db.pipeline()
+        pipe.set(self.config['MESSAGE_PREFIX'] + job_id, json.dumps(messages))
+        pipe.publish(self.config['EVENTS_PREFIX'] + job_id, 
+                     json.dumps({'event': 'messages', 'job_id': job_id, 'messages': messages}))
+        pipe.execute()
 
     def get_local_path(self, uri):
         """Get local path from S3 URI
@@ -174,11 +329,80 @@ class APIWorker(object):
             local_file_name = self.get_local_path(uri)
             self.make_local_dirs(local_file_name)
             print('Downloading to local filesystem:\n{}\n{}'.format(uri, local_file_name))
-            utils.get_s3_file(self.s3, uri, local_file_name)
+            utils.get_s3_file(self.s3, uri, local_file_name, 
+                              config=self.transfer_config, cache=self.input_cache)
             return local_file_name
         else:
             return uri
 
+    def localize_resources(self, uris, job_id=None):
+        """Download S3 URIs to the worker's local file system concurrently
+
+        Up to `S3_DOWNLOAD_CONCURRENCY` files are downloaded at once through the 
+        worker's shared S3 connection. The time taken by each download is 
+        reported in the job's messages.
+
+        Args:
+            uris (list): S3 URIs
+            job_id (str, optional): Unique ID for job to report download times to
+
+        Returns:
+            dict: Local path for each URI
+        """
+        def localize(uri):
+            start = time.time()
+            local_file_name = self.localize_resource(uri)
+            return local_file_name, time.time() - start
+
+        uris = list(dict.fromkeys(uris))
+        if len(uris) == 0:
+            return {}
+        max_workers = min(self.config['S3_DOWNLOAD_CONCURRENCY'], len(uris))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(localize, uris))
+
+        messages = ['Downloaded {} in {:.2f} s'.format(uri, seconds) 
+                    for uri, (_, seconds) in zip(uris, results) if utils.is_s3_uri(uri)]
+        for message in messages:
+            print(message)
+        if job_id is not None and len(messages) > 0:
+            self.update_job_messages(job_id, messages)
+        self.publish_cache_stats()
+        return {uri: local_file_name for uri, (local_file_name, _) in zip(uris, results)}
+
+    def warm_images(self):
+        """List the images the worker can start jobs on without pulling them
+
+        Returns:
+            list: Image names
+        """
+        return []
+
+    def warm_inputs(self):
+        """List the S3 objects the worker has in its input cache
+
+        Returns:
+            list: S3 URIs, at most `AFFINITY_MAX_INPUTS` of them
+        """
+        if self.input_cache is None:
+            return []
+        return self.input_cache.recent(self.config['AFFINITY_MAX_INPUTS'])
+
+    def advertise(self):
+        """Record the worker's warm images and cached inputs in its database entry
+
+        The scheduler holds jobs back from other workers for a while so they
+        run where their image is warm.
+        """
+        name = self.config['WORKER_PREFIX'] + self.instance_id
+        self.db.hmset(name, {'images': json.dumps(self.warm_images()), 
+                             'inputs': json.dumps(self.warm_inputs())})
+
+    def publish_cache_stats(self):
+        """Record the input cache counters in the worker's database entry"""
+        if self.input_cache is not None and self.instance_id is not None:
+            self.db.hmset(self.config['WORKER_PREFIX'] + self.instance_id, self.input_cache.stats())
+
     def localize_output(self, uri):
         """Get local path for output file
 
@@ -195,42 +419,61 @@ class APIWorker(object):
         else:
             return uri
 
-    def persist_resource(self, uri):
+    def persist_resource(self, uri, listings=None, executor=None):
         """Upload local file to S3
 
         Args:
             uri (str): S3 URI for file destination        
+            listings (dict, optional): Sorted file names of each local directory 
+                that has already been listed
+            executor (concurrent.futures.Executor, optional): Executor to run the 
+                uploads on
+
+        Returns:
+            list: Futures for the uploads submitted to `executor`
         """
         if utils.is_s3_uri(uri):
             local_file_name = self.get_local_path(uri)
             print('Uploading to s3:\n  {}\n  {}'.format(local_file_name, uri))
-            utils.put_file_s3(self.s3, local_file_name, uri)
+            return utils.put_file_s3(self.s3, local_file_name, uri, listings=listings, 
+                                     config=self.transfer_config, executor=executor)
+        return []
 
-    def localize_command(self, command):
+    def localize_command(self, command, job_id=None):
         """Localize input and output arguments in command
 
+        All of the inputs are downloaded concurrently before the command is 
+        rewritten. When `STREAM_STDIN_FROM_S3` is set a STDIN URI is left in 
+        place so it can be streamed from S3 by `open_stdin`.
+
         Args:
             command (dict): Command for worker to execute
+            job_id (str, optional): Unique ID for job to report download times to
 
         Returns:
             dict: Command rewritten with local input and output arguments
         """
         local_command = copy.deepcopy(command)
-        if 'stdin' in local_command and local_command['stdin']['type'] == 'uri':
-            local_command['stdin']['value'] = self.localize_resource(local_command['stdin']['value'])
+        stream_stdin = self.config['STREAM_STDIN_FROM_S3']
+        inputs = []
+        if 'stdin' in local_command and local_command['stdin']['type'] == 'uri' and not stream_stdin:
+            inputs.append(local_command['stdin']['value'])
+        inputs.extend(local_command.get('input', []))
+        inputs.extend(arg['value'] for arg in local_command['arguments'] if arg['type'] == 'input')
+        local_paths = self.localize_resources(inputs, job_id)
+
+        if 'stdin' in local_command and local_command['stdin']['type'] == 'uri' and not stream_stdin:
+            local_command['stdin']['value'] = local_paths[local_command['stdin']['value']]
         if 'stdout' in local_command and local_command['stdout']['type'] == 'uri': 
             local_command['stdout']['value'] = self.localize_output(local_command['stdout']['value'])
-        if 'stderr' in local_command and local_command['stdout']['type'] == 'uri':
+        if 'stderr' in local_command and local_command['stderr']['type'] == 'uri':
             local_command['stderr']['value'] = self.localize_output(local_command['stderr']['value'])
-        if 'input' in local_command:
-            for uri in local_command['input']:
-                self.localize_resource(uri)
         if 'output' in local_command:
             for uri in local_command['output']:
                 self.localize_output(uri)
         for arg in local_command['arguments']:
             if arg['type'] == 'input':
-                arg['value'] = self.localize_resource(arg['value'])
+                arg['value'] = local_paths[arg['value']]
             if arg['type'] == 'output':
                 arg['value'] = self.localize_output(arg['value'])
             if arg['type'] == 'parameter' and utils.is_s3_uri(arg['value']):
@@ -240,20 +483,29 @@ class APIWorker(object):
     def persist_command(self, command):
         """Upload outputs specified in command
 
+        Each output directory is listed once and up to `S3_UPLOAD_CONCURRENCY` 
+        files are uploaded at once.
+
         Args:
             command (dict): Command for worker to execute
         """
         print(command)
+        uris = []
         if 'stdout' in command and command['stdout']['type'] == 'uri':
-            self.persist_resource(command['stdout']['value'])
+            uris.append(command['stdout']['value'])
         if 'stderr' in command and command['stderr']['type'] == 'uri':
-            self.persist_resource(command['stderr']['value'])
+            uris.append(command['stderr']['value'])
         if 'output' in command:
-            for uri in command['output']:
-                self.persist_resource(uri)
-        for arg in command['arguments']:
-            if arg['type'] == 'output':
-                self.persist_resource(arg['value'])
+            uris.extend(command['output'])
+        uris.extend(arg['value'] for arg in command['arguments'] if arg['type'] == 'output')
+
+        listings = {}
+        with ThreadPoolExecutor(max_workers=self.config['S3_UPLOAD_CONCURRENCY']) as executor:
+            futures = []
+            for uri in uris:
+                futures.extend(self.persist_resource(uri, listings, executor))
+            for future in futures:
+                future.result()
 
     # This is not currently used, but may still be useful
     @staticmethod
@@ -313,18 +565,57 @@ class APIWorker(object):
                 stdout_pipe = True
         if 'stderr' in local_command:
             if local_command['stderr']['type'] == 'uri':
-                stdout = local_command['stderr']['value']
+                stderr = local_command['stderr']['value']
             else:
                 assert(local_command['stderr']['type'] == 'pipe')
                 stderr_pipe = True
         return command, stdin, stdin_pipe, stdout, stdout_pipe, stderr, stderr_pipe
 
 
-    def build_localized_command(self, command, cmd_prefix=[]):
+    def open_stdin(self, stdin, stdin_pipe):
+        """Open the source of a job's STDIN for streaming
+
+        Args:
+            stdin (str): Value piped to STDIN, local path or S3 URI
+            stdin_pipe (bool): Whether `stdin` is the value itself
+
+        Returns:
+            A binary file-like object to read STDIN from
+        """
+        if stdin_pipe:
+            return io.BytesIO(stdin.encode())
+        if utils.is_s3_uri(stdin):
+            print('Streaming STDIN from {}'.format(stdin))
+            return utils.open_s3_stream(self.s3, stdin)
+        return open(stdin, 'rb')
+
+    def stream_stdin(self, stdin, stdin_pipe, fd, job_id=None):
+        """Stream a job's STDIN to a file descriptor and record its throughput
+
+        Args:
+            stdin (str): Value piped to STDIN, local path or S3 URI
+            stdin_pipe (bool): Whether `stdin` is the value itself
+            fd (int): File descriptor to write STDIN to
+            job_id (str, optional): Unique ID for job to record throughput to
+
+        Returns:
+            dict: Number of bytes streamed, time taken and throughput
+        """
+        with self.open_stdin(stdin, stdin_pipe) as source:
+            stats = utils.copy_stream(source, lambda data: os.write(fd, data), 
+                                      self.config['STDIN_CHUNK_SIZE'])
+        print('Streamed {stdin_bytes} bytes to STDIN in {stdin_seconds} s'.format(**stats))
+        if job_id is not None:
+            self.db.hmset(self.config['JOB_PREFIX'] + job_id, stats)
+        return stats
+
+    def build_localized_command(self, command, cmd_prefix=[], job_id=None):
         """Build command with localized input and output arguments
         
         Args:
             command (dict): Command for worker to execute
+            cmd_prefix (list, optional): Command prefix printed before the command
+            job_id (str, optional): Unique ID for job to report download times to
 
         Returns:
             dict: Command with input and output arguments localized
@@ -332,7 +623,7 @@ class APIWorker(object):
         abstract_cmd = self.build_bash_command(command)
         print('\nAbstract unix command:')
         print('{} {}\n'.format(cmd_prefix, abstract_cmd))
-        local_command = self.localize_command(command)
+        local_command = self.localize_command(command, job_id)
         return local_command
 
     def worker_cleanup(self, command, exit_code, worker_log, stdout_data, stderr_data):
@@ -394,7 +685,7 @@ class APIWorker(object):
         """
         ## TODO: handle case where worker has an active job
         print('SIGTERM received: {} {}'.format(signo, stack_frame))
-        update_worker_status('dead')
+        self.update_worker_status('dead')
         sys.exit(0)
 
     def launch(self, message):
@@ -408,6 +699,46 @@ class APIWorker(object):
         """
         raise NotImplementedError('launch method is not implemented')
 
+    def heartbeat(self):
+        """Record that the worker is alive in its database entry"""
+        name = self.config['WORKER_PREFIX'] + self.instance_id
+        self.db.hset(name, 'heartbeat', time.time())
+
+    def start_heartbeat(self):
+        """Send heartbeats from a background thread while the worker runs
+
+        Returns:
+            threading.Thread: The heartbeat thread
+        """
+        def beat():
+            while not self.stopped.is_set():
+                try:
+                    self.heartbeat()
+                    self.advertise()
+                except Exception as e:
+                    print('Heartbeat failed: {}'.format(e))
+                self.stopped.wait(self.config['HEARTBEAT_INTERVAL'])
+
+        thread = threading.Thread(target=beat, name='heartbeat', daemon=True)
+        thread.start()
+        return thread
+
+    def update_slot_status(self, slot, status):
+        """Update the status of a job slot in the database
+
+        The worker is reported as busy once all of its slots are busy.
+
+        Args:
+            slot (int): Job slot
+            status (str): New slot status, `busy` or `idle`
+        """
+        with self.slot_lock:
+            self.busy_slots += 1 if status == 'busy' else -1
+            busy_slots = self.busy_slots
+        name = self.config['WORKER_PREFIX'] + self.instance_id
+        self.db.hmset(name, {'slot:{}'.format(slot): status, 'busy_slots': busy_slots})
+        self.update_worker_status('busy' if busy_slots >= self.concurrency else 'idle')
+
     def update_worker_status(self, status):
         name = self.config['WORKER_PREFIX'] + self.instance_id
         self.db.hset(name, 'status', status)
@@ -425,44 +756,111 @@ class APIWorker(object):
     def register_worker(self):
         """Create entry for worker in database
         
+        Workers sharing a host get a numbered suffix so each one has its own 
+        entry, heartbeat and processing list.
+
         Returns:
             str: Unique ID for worker
         """
         instance_id, instance_type, private_ip = utils.get_instance_info()
-        self.instance_id = instance_id
 
         worker_info = {'queue': self.queue, 
                        'worker_type': self.__class__.__name__, 
                        'status': 'idle', 
                        'instance_type': instance_type, 
-                       'private_ip': private_ip}
-        worker_id = self.config['WORKER_PREFIX'] + self.instance_id
-        if self.db.exists(worker_id):
-            keys = self.db.keys(pattern='{}*'.format(worker_id))
-            worker_id = '{}_{}'.format(worker_id, len(keys))
-
-        self.db.hmset(worker_id, worker_info)
-        self.db.sadd('{}:workers'.format(self.queue), self.instance_id)
+                       'private_ip': private_ip,
+                       'reliable': int(self.reliable),
+                       'concurrency': self.concurrency,
+                       'busy_slots': 0,
+                       'heartbeat': time.time()}
+        # Claiming the entry with HSETNX keeps workers starting together on 
+        # one host from taking the same ID
+        worker_id = self.config['WORKER_PREFIX'] + instance_id
+        host_id = instance_id
+        suffix = 0
+        while not self.db.hsetnx(worker_id, 'queue', self.queue):
+            suffix += 1
+            instance_id = '{}_{}'.format(host_id, suffix)
+            worker_id = self.config['WORKER_PREFIX'] + instance_id
+        self.instance_id = instance_id
+
+        pipe = self.db.pipeline()
+        pipe.hmset(worker_id, {key: value for key, value in worker_info.items() if value is not None})
+        pipe.sadd('{}:workers'.format(self.queue), self.instance_id)
+        pipe.sadd(self.config['QUEUES_KEY'], self.queue)
+        pipe.execute()
         return instance_id
 
+    def run_job(self, message, slot):
+        """Process a message in a job slot
+
+        The message is acknowledged even if processing it fails, the reaper 
+        only requeues the messages of dead workers and a job this worker 
+        already started must not run a second time. A job that fails outside 
+        of its launch is marked failed if Redis can still be reached.
+
+        Args:
+            message (dict): Job message
+            slot (int): Job slot the job runs in
+        """
+        worker = self
+        try:
+            self.update_slot_status(slot, 'busy')
+            worker = self.slot_worker(slot)
+            worker.process_message(message)
+            self.advertise()
+        except Exception as e:
+            try:
+                worker.handle_exception(message['job_id'], e)
+            except Exception:
+                traceback.print_exc()
+        finally:
+            try:
+                worker.acknowledge_message(message)
+            finally:
+                self.update_slot_status(slot, 'idle')
+
     def run(self):
-        """Start worker"""
+        """Start worker
+
+        The worker only takes a message off the queue when one of its 
+        `concurrency` job slots is free. With more than one slot, jobs run on a 
+        thread pool that shares the worker's connections and running jobs are 
+        allowed to finish when the worker stops.
+        """
         signal.signal(signal.SIGTERM, self.gracefully_exit)
         print('Starting worker on process {}'.format(os.getpid()))
         self.register_worker()
+        self.start_heartbeat()
+        self.archiver.start()
+
+        slots = Queue()
+        for slot in range(self.concurrency):
+            slots.put(slot)
+        executor = ThreadPoolExecutor(max_workers=self.concurrency) if self.concurrency > 1 else None
+
+        def run_slot(message, slot):
+            try:
+                self.run_job(message, slot)
+            finally:
+                slots.put(slot)
 
         spinner = cycle(['/', '-', '\\', '|'])
         try:
             while True:
+                slot = slots.get()
                 message = self.receive_message()
                 if message is not None:
-                    self.update_worker_status('busy')
-                    self.process_message(message)
-                    self.update_worker_status('idle')
+                    if executor is None:
+                        run_slot(message, slot)
+                    else:
+                        executor.submit(run_slot, message, slot)
                 else:
+                    slots.put(slot)
                     sys.stdout.write(next(spinner))
                     sys.stdout.flush()
-                    time.sleep(self.poll_frequency)
+                    if not self.blocking:
+                        time.sleep(self.poll_frequency)
                     sys.stdout.write('\b')
         except KeyboardInterrupt:
             print('\rStopping worker')
@@ -470,4 +868,8 @@ class APIWorker(object):
         except Exception as e:
             print(e)
             self.update_worker_status('dead')
-                
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+            self.stopped.set()
+            self.archiver.stop()
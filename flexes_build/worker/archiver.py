@@ -0,0 +1,191 @@
+import queue
+import threading
+import time
+from botocore.exceptions import ClientError
+
+
+class JobArchiver(object):
+    """Archive finished jobs to DynamoDB in batches from a background thread.
+
+    Records are buffered in a bounded queue and written with `batch_write_item`
+    once `batch_size` records are waiting or `flush_interval` seconds have
+    passed since the first one arrived. `archive` blocks while the buffer is
+    full, which throttles the worker when DynamoDB falls behind instead of
+    growing the buffer without bound. Records that still fail after
+    `max_retries` are kept and written again with later batches, at most
+    `max_requeues` times, so a DynamoDB outage longer than the retry backoff
+    does not lose finished jobs.
+
+    Attributes:
+        dyn (boto3.resource): DynamoDB connection
+        table_name (str): Name of the jobs table
+        batch_size (int): Maximum number of records per write, at most `25`
+        flush_interval (float): Maximum time a record waits before it is written
+        max_retries (int): Number of times a failed write is retried
+        max_requeues (int): Number of later batches a failed record is 
+            written again with before it is dropped
+        records (queue.Queue): Records waiting to be written
+        failed (list): Records that could not be written and the number of 
+            times each has been requeued, at most `max_pending` records
+
+    Args:
+        dyn (boto3.resource): DynamoDB connection
+        table_name (str): Name of the jobs table
+        batch_size (int, optional): Maximum number of records per write, default `25`
+        flush_interval (float, optional): Maximum time in seconds a record waits
+            before it is written, default `5`
+        max_pending (int, optional): Maximum number of buffered records, default `1000`
+        max_retries (int, optional): Number of times a failed write is retried,
+            default `5`
+        max_requeues (int, optional): Number of later batches a failed record 
+            is written again with, default `60`
+    """
+    # DynamoDB rejects batches with more than 25 requests
+    MAX_BATCH_SIZE = 25
+
+    def __init__(self, dyn, table_name, batch_size=25, flush_interval=5,
+                 max_pending=1000, max_retries=5, max_requeues=60):
+        self.dyn = dyn
+        self.table_name = table_name
+        self.batch_size = min(batch_size, self.MAX_BATCH_SIZE)
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.max_requeues = max_requeues
+        self.max_pending = max_pending
+        self.records = queue.Queue(maxsize=max_pending)
+        self.failed = []
+        self.thread = None
+
+    def archive(self, job_id, status, result):
+        """Queue a finished job to be written to DynamoDB
+
+        Args:
+            job_id (str): Unique ID for job
+            status (str): Final job status
+            result (str): Result of job execution
+        """
+        self.records.put({'job_id': job_id, 'status': status, 'result': result})
+
+    def start(self):
+        """Start writing records from a background thread"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='archiver', daemon=True)
+            self.thread.start()
+
+    def stop(self, timeout=None):
+        """Write all queued records and stop the background thread
+
+        Args:
+            timeout (float, optional): Maximum time to wait for the thread
+        """
+        if self.thread is not None:
+            self.records.put(None)
+            self.thread.join(timeout)
+            self.thread = None
+
+    def next_batch(self):
+        """Wait for the next batch of records
+
+        The wait for the first record is limited to `flush_interval` while 
+        failed records are waiting to be written again.
+
+        Returns:
+            tuple:
+                list: Records to write
+                bool: Whether the archiver was asked to stop
+        """
+        try:
+            batch = [self.records.get(timeout=self.flush_interval if self.failed else None)]
+        except queue.Empty:
+            return [], False
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size and batch[-1] is not None:
+            try:
+                batch.append(self.records.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+        stopping = batch[-1] is None
+        return [record for record in batch if record is not None], stopping
+
+    def run(self):
+        """Write batches of records until the archiver is stopped"""
+        stopping = False
+        while not stopping:
+            batch, stopping = self.next_batch()
+            self.flush_pending(batch)
+        if len(self.failed) > 0:
+            print('Failed to archive jobs {}'.format([record['job_id'] for record, _ in self.failed]))
+
+    def flush_pending(self, records):
+        """Write records along with the records that failed before
+
+        Records that fail again are kept for the next batch until they have 
+        been requeued `max_requeues` times. The oldest are dropped when more 
+        than `max_pending` records have failed.
+
+        Args:
+            records (list): New job records to write
+        """
+        requeues = {record['job_id']: count for record, count in self.failed}
+        records = [record for record, _ in self.failed] + records
+        self.failed = []
+        if len(records) == 0:
+            return
+        dropped = []
+        for record in self.flush(records):
+            count = requeues.get(record['job_id'], 0) + 1
+            if count > self.max_requeues:
+                dropped.append(record)
+            else:
+                self.failed.append((record, count))
+        if len(self.failed) > self.max_pending:
+            dropped.extend(record for record, _ in self.failed[:-self.max_pending])
+            self.failed = self.failed[-self.max_pending:]
+        if len(dropped) > 0:
+            print('Failed to archive jobs {}'.format([record['job_id'] for record in dropped]))
+
+    def flush(self, records):
+        """Write records to DynamoDB, retrying unprocessed items with backoff
+
+        Only the most recent record for each job is written because a batch
+        may not contain the same key twice.
+
+        Args:
+            records (list): Job records to write
+
+        Returns:
+            list: Records of the batches that could not be written
+        """
+        latest = {record['job_id']: record for record in records}
+        requests = [{'PutRequest': {'Item': record}} for record in latest.values()]
+        failed = []
+        for i in range(0, len(requests), self.batch_size):
+            batch = requests[i:i + self.batch_size]
+            try:
+                self.write_batch(batch)
+            except Exception as e:
+                print('Failed to write batch, requeueing: {}'.format(e))
+                failed.extend(request['PutRequest']['Item'] for request in batch)
+        return failed
+
+    def write_batch(self, requests):
+        """Write a single batch of requests to DynamoDB
+
+        Args:
+            requests (list): DynamoDB write requests
+
+        Raises:
+            RuntimeError: If requests are still unprocessed after all retries
+        """
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                time.sleep(0.05 * 2 ** attempt)
+            try:
+                response = self.dyn.batch_write_item(RequestItems={self.table_name: requests})
+            except ClientError as e:
+                print('Batch write failed: {}'.format(e))
+                continue
+            requests = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            if len(requests) == 0:
+                return
+        raise RuntimeError('{} records unprocessed after {} retries'.format(len(requests), self.max_retries))
@@ -2,21 +2,38 @@
 
 import copy
 import docker
-import os
 import sys
-import time
+import threading
+from . import utils
 from .api_worker import APIWorker
+from .image_cache import ImageCache
 from argparse import ArgumentParser
+from collections import deque
 from pathlib import Path
 
 class DockerWorker(APIWorker):
-    """API worker capable of executing Docker containers"""
+    """API worker capable of executing Docker containers
+
+    Attributes:
+        client (docker.DockerClient): Docker connection
+        image_cache (ImageCache): Resolves images without pulling them for every job
+    """
     def __init__(self, *args, **kwargs):
         super(self.__class__, self).__init__(*args, **kwargs)
         self.client = docker.DockerClient(base_url='unix://var/run/docker.sock', version='auto')
-        self.local_files_dir = Path(self.local_files_path).anchor + str(Path(self.local_files_path).relative_to(Path.home()))
+        login = None
         if self.config['AUTHENTICATE'] is not None:
             self.registry_login()
+            login = lambda: self.registry_login(reauth=True)
+        self.image_cache = ImageCache(self.client, 
+                                      ttl=self.config['IMAGE_DIGEST_TTL'], 
+                                      max_bytes=self.config['IMAGE_DISK_BUDGET'], 
+                                      login=login)
+
+    @property
+    def local_files_dir(self):
+        """str: Path the job's local files are mounted at inside the container"""
+        return Path(self.local_files_path).anchor + str(Path(self.local_files_path).relative_to(Path.home()))
 
     def test_service(self, message):
         """Test if the specified service exists and can be pulled 
@@ -30,7 +47,7 @@ class DockerWorker(APIWorker):
             return self.update_job(message['job_id'], self.config['STATUS_FAIL'], 
                                    'Image {} not found'.format(message['service']))
 
-    def registry_login(self):
+    def registry_login(self, reauth=False):
         username = self.config['AUTHENTICATE'].get('REGISTRY_USERNAME')
         password = self.config['AUTHENTICATE'].get('REGISTRY_PASSWORD')
         if username is None:
@@ -40,22 +57,49 @@ class DockerWorker(APIWorker):
         else:
             self.client.login(username=username, 
                               password=password, 
-                              registry=self.config['DOCKER_REGISTRY'])
+                              registry=self.config['DOCKER_REGISTRY'], 
+                              reauth=reauth)
 
     def image_exists(self, image_name, tag='latest'):
         image = '{}/{}:{}'.format(self.config['DOCKER_REGISTRY'], image_name, tag)
         try:
-            image = self.client.images.get(image)
+            self.image_cache.resolve(image)
             return True
         except docker.errors.ImageNotFound:
-            try:
-                print('Image {} not found locally'.format(image))
-                if self.config['AUTHENTICATE'] is not None:
-                    self.client.login(reauth=True)
-                self.client.images.pull(image)
-                return True
-            except docker.errors.ImageNotFound:
-                return False
+            print('Image {} not found'.format(image))
+            return False
+
+    def warm_images(self):
+        """List the images the worker has resolved, most recently used first"""
+        return self.image_cache.images()
+
+    def popular_images(self):
+        """Get the images most often run from the worker's queue
+
+        Returns:
+            list: Image names, most popular first
+        """
+        key = '{}:images'.format(self.queue)
+        return self.db.zrevrange(key, 0, self.config['IMAGE_PREPULL_COUNT'] - 1)
+
+    def start_prepull(self):
+        """Keep the most popular images of the queue pulled from a background thread
+
+        Returns:
+            threading.Thread: The pre-pull thread
+        """
+        def prepull():
+            while not self.stopped.is_set():
+                try:
+                    for image in self.popular_images():
+                        self.image_cache.resolve(image)
+                except Exception as e:
+                    print('Pre-pull failed: {}'.format(e))
+                self.stopped.wait(self.config['IMAGE_PREPULL_INTERVAL'])
+
+        thread = threading.Thread(target=prepull, name='prepull', daemon=True)
+        thread.start()
+        return thread
 
     def get_docker_path(self, uri):
         """Translate host path to container path"""
@@ -90,6 +134,36 @@ class DockerWorker(APIWorker):
                 arg['value'] = self.get_docker_path(arg['value'])
         return docker_command
 
+    def stream_output(self, container, stdout_sink, stderr_sink, log, publisher):
+        """Stream a container's output to its destinations in a single pass
+
+        STDOUT and STDERR are read from one demultiplexed attach stream and 
+        written to their sinks as they arrive, both are kept in the bounded 
+        worker log and the last lines of STDERR are published as job messages.
+
+        Args:
+            container (docker.models.containers.Container): Running container
+            stdout_sink (utils.OutputSink): Destination for STDOUT
+            stderr_sink (utils.OutputSink): Destination for STDERR
+            log (utils.TailBuffer): End of the combined output
+            publisher (utils.CoalescingPublisher): Publisher for the job messages
+        """
+        def stderr_chunks():
+            output = container.attach(stdout=True, stderr=True, stream=True, logs=True, demux=True)
+            for stdout_chunk, stderr_chunk in output:
+                if stdout_chunk:
+                    stdout_sink.write(stdout_chunk)
+                    log.write(stdout_chunk)
+                if stderr_chunk:
+                    stderr_sink.write(stderr_chunk)
+                    log.write(stderr_chunk)
+                    yield stderr_chunk
+
+        tail = deque(maxlen=self.config['MESSAGE_TAIL_LINES'])
+        for line in utils.iter_lines(stderr_chunks()):
+            tail.append(line.decode(errors='replace'))
+            publisher.update(list(tail))
+
     def launch(self, message):
         print('\n\033[1mStarting Docker Job\033[0m')
 
@@ -97,20 +171,12 @@ class DockerWorker(APIWorker):
         image = '{}/{}:{}'.format(self.config['DOCKER_REGISTRY'], message['service'], tag)
         print('\nDocker Image: {}'.format(image))
 
-        local_command = self.build_localized_command(message['command'])
+        local_command = self.build_localized_command(message['command'], job_id=message.get('job_id'))
         local_cmd, stdin_file, stdin_pipe, stdout_file, stdout_pipe, stderr_file, stderr_pipe = self.build_command_parts(local_command)
 
         docker_command = self.dockerize_command(local_command)
         docker_cmd, *docker_other = self.build_command_parts(docker_command)
 
-        stdin_data = None
-        if stdin_file is not None:
-            if stdin_pipe:
-                stdin_data = stdin_file
-            else:
-                with open(stdin_file, 'r') as stdin:
-                    stdin_data = stdin.read()
-
         docker_cmd = ' '.join(docker_cmd)
         print('\nDocker command: {}'.format(docker_cmd))
 
@@ -125,46 +191,51 @@ class DockerWorker(APIWorker):
         print(volumes)
 
         container = None
+        image_id = None
         try:
-            if self.config['AUTHENTICATE'] is not None:
-                self.client.login(reauth=True)
-            self.client.images.pull(image)
-            container = self.client.containers.run(image, 
+            image_id = self.image_cache.acquire(image)
+            self.db.zincrby('{}:images'.format(self.queue), 1, image)
+            container = self.client.containers.run(image_id, 
                                               command=docker_cmd, 
                                               detach=True, 
                                               environment=environment,
                                               volumes=volumes, 
-                                              stdin_open = (stdin_data != None))
-
-            if stdin_data != None:
-                socket = container.attach_socket(params={'stdin': 1, 'stream': 1})
-                os.write(socket.fileno(), stdin_data.encode())
-                socket.close()
-                print('input socket closed')
-
-            messages = []
-            while container.status != 'exited':
-                tail = [line.strip().decode() for line in container.logs(stream=True, stdout=False, stderr=True, tail=5)]
-                if tail != messages and len(tail) > 0:
-                    messages = tail
+                                              stdin_open = (stdin_file != None))
+
+            # A single demultiplexed stream writes the output while the 
+            # container runs and wait() blocks until the daemon reports that 
+            # it exited, so nothing is polled or read twice. The output is 
+            # followed before STDIN is streamed so neither side can stall.
+            def publish(messages):
+                if 'job_id' in message:
                     self.update_job_messages(message['job_id'], messages)
-                # Report container stats???
-                stats = container.stats(decode=True)
-                time.sleep(0.1)
-                container.reload()
-            exit_code = container.wait()['StatusCode']
-
-            logs = container.logs(stdout=True, stderr=True).decode()
-            if stdout_file != None:
-                with open(stdout_file, 'w') as stdout:
-                    stdout_lines = [line.strip().decode() for line in container.logs(stream=True, stdout=True, stderr=False)]
-                    stdout.writelines(stdout_lines)
-            if stderr_file != None:
-                with open(stderr_file, 'w') as stderr:
-                    stderr_lines = [line.strip().decode() for line in container.logs(stream=True, stdout=False, stderr=True)]
-                    stderr.writelines(stderr_lines)
-            stdout_data = container.logs(stdout=True, stderr=False).decode() if stdout_pipe else None
-            stderr_data = container.logs(stdout=False, stderr=True).decode() if stderr_pipe else None 
+            publisher = utils.CoalescingPublisher(publish, self.config['MESSAGE_UPDATE_INTERVAL'])
+            limit = self.config['OUTPUT_PIPE_LIMIT']
+            stdout_sink = utils.OutputSink(stdout_file, stdout_pipe, limit)
+            stderr_sink = utils.OutputSink(stderr_file, stderr_pipe, limit)
+            log = utils.TailBuffer(self.config['OUTPUT_TAIL_BYTES'])
+            follower = threading.Thread(target=self.stream_output, 
+                                        args=(container, stdout_sink, stderr_sink, log, publisher), 
+                                        daemon=True)
+            follower.start()
+            try:
+                if stdin_file != None:
+                    socket = container.attach_socket(params={'stdin': 1, 'stream': 1})
+                    try:
+                        self.stream_stdin(stdin_file, stdin_pipe, socket.fileno(), message.get('job_id'))
+                    finally:
+                        socket.close()
+                        print('input socket closed')
+                exit_code = container.wait()['StatusCode']
+                follower.join()
+            finally:
+                stdout_sink.close()
+                stderr_sink.close()
+            publisher.flush()
+
+            logs = log.getvalue()
+            stdout_data = stdout_sink.getvalue()
+            stderr_data = stderr_sink.getvalue()
         except docker.errors.ContainerError as e:
             print('Container error: {}'.format(e))
             logs = e.stderr.decode()
@@ -178,14 +249,32 @@ class DockerWorker(APIWorker):
         finally:
             if container:
                 container.remove()
+            if image_id is not None:
+                self.image_cache.release(image)
         return self.worker_cleanup(message['command'], exit_code, logs, stdout_data, stderr_data)
 
+    def run(self):
+        """Start worker and keep popular images pulled in the background"""
+        self.start_prepull()
+        super(self.__class__, self).run()
+
 if __name__ == '__main__': # pragma: no cover
     parser = ArgumentParser()
     parser.add_argument('-q', '--queue', default='docker', 
                         help='queue for the worker to pull work from')
     parser.add_argument('-pf', '--poll_frequency', default=1, type=int, 
                         help='time to wait between polling the work queue (seconds)')
+    parser.add_argument('-nb', '--non_blocking', action='store_true', 
+                        help='poll the work queue instead of blocking on it')
+    parser.add_argument('-bt', '--block_timeout', type=int, 
+                        help='time to block on the work queue before checking the scheduler (seconds)')
+    parser.add_argument('-r', '--reliable', action='store_true', 
+                        help='keep jobs in a processing list until they finish so they can be requeued')
+    parser.add_argument('-c', '--concurrency', default=1, type=int, 
+                        help='number of jobs to run at once')
     args = parser.parse_args()
-    worker = DockerWorker(queue=args.queue, poll_frequency=args.poll_frequency)
+    worker = DockerWorker(queue=args.queue, poll_frequency=args.poll_frequency,
+                          blocking=not args.non_blocking, block_timeout=args.block_timeout, 
+                          reliable=args.reliable,
+                          concurrency=args.concurrency)
     worker.run()
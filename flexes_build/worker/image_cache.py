@@ -0,0 +1,219 @@
+import docker
+import threading
+import time
+from collections import Counter, OrderedDict
+
+
+class ImageCache(object):
+    """Resolve Docker images to local images without pulling them for every job.
+
+    A tag is resolved to the local image whose repository digest matches the
+    registry's current digest for that tag, and the resolution is trusted for
+    `ttl` seconds before the registry is asked again. Images are only pulled
+    when they are missing locally or the tag now points to a different digest.
+    When `max_bytes` is set the least recently used images that are not in use
+    by a running job are removed once the images the cache has resolved take
+    up more space than that.
+
+    Attributes:
+        client (docker.DockerClient): Docker connection
+        ttl (float): Time in seconds a resolved image is trusted
+        max_bytes (int): Disk budget for resolved images in bytes, `None` to
+            never remove images
+        login (callable): Function called to log in to the registry again
+            when a pull is rejected
+        resolved (dict): Local image ID and resolution time for each image
+        sizes (collections.OrderedDict): Size of each image in least recently
+            used order
+        in_use (collections.Counter): Number of running jobs using each image
+
+    Args:
+        client (docker.DockerClient): Docker connection
+        ttl (float, optional): Time in seconds a resolved image is trusted,
+            default `300`
+        max_bytes (int, optional): Disk budget for resolved images in bytes,
+            default `None`
+        login (callable, optional): Function called to log in to the registry
+            again when a pull is rejected
+    """
+    def __init__(self, client, ttl=300, max_bytes=None, login=None):
+        self.client = client
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.login = login
+        self.resolved = {}
+        self.sizes = OrderedDict()
+        self.in_use = Counter()
+        self.lock = threading.Lock()
+
+    def remote_digest(self, image):
+        """Get the digest the registry currently has for an image
+
+        Args:
+            image (str): Image name including registry and tag
+
+        Returns:
+            str: Image digest, `None` if the registry cannot be reached
+        """
+        try:
+            return self.client.images.get_registry_data(image).id
+        except docker.errors.APIError as e:
+            print('Could not check digest of {}: {}'.format(image, e))
+            return None
+
+    def local_image(self, image):
+        """Get the local copy of an image
+
+        Args:
+            image (str): Image name including registry and tag
+
+        Returns:
+            docker.models.images.Image: Local image, `None` if it is missing
+        """
+        try:
+            return self.client.images.get(image)
+        except docker.errors.ImageNotFound:
+            return None
+
+    def pull(self, image):
+        """Pull an image, logging in again once if the registry rejects the pull
+
+        Args:
+            image (str): Image name including registry and tag
+
+        Returns:
+            docker.models.images.Image: Pulled image
+
+        Raises:
+            docker.errors.ImageNotFound: If the image does not exist
+        """
+        print('Pulling image {}'.format(image))
+        try:
+            return self.client.images.pull(image)
+        except docker.errors.ImageNotFound:
+            raise
+        except docker.errors.APIError:
+            if self.login is None:
+                raise
+            self.login()
+            return self.client.images.pull(image)
+
+    @staticmethod
+    def has_digest(local, digest):
+        """Determine if a local image was pulled with a specific digest"""
+        return any(repo_digest.endswith('@' + digest)
+                   for repo_digest in local.attrs.get('RepoDigests') or [])
+
+    def resolve(self, image, acquire=False):
+        """Get a local image that is current with the registry
+
+        Args:
+            image (str): Image name including registry and tag
+            acquire (bool, optional): Whether to mark the image in use while 
+                holding the same lock it is resolved under, default `False`
+
+        Returns:
+            str: ID of the local image
+
+        Raises:
+            docker.errors.ImageNotFound: If the image does not exist
+        """
+        with self.lock:
+            cached = self.resolved.get(image)
+            if cached is not None and time.time() - cached[1] < self.ttl:
+                if image in self.sizes:
+                    self.sizes.move_to_end(image)
+                if acquire:
+                    self.in_use[image] += 1
+                return cached[0]
+
+        local = self.local_image(image)
+        if local is None:
+            local = self.pull(image)
+        else:
+            digest = self.remote_digest(image)
+            if digest is not None and not self.has_digest(local, digest):
+                local = self.pull(image)
+
+        with self.lock:
+            self.resolved[image] = (local.id, time.time())
+            self.sizes[image] = local.attrs.get('Size', 0)
+            self.sizes.move_to_end(image)
+            if acquire:
+                self.in_use[image] += 1
+        return local.id
+
+    def acquire(self, image):
+        """Resolve an image for a job and protect it from pruning
+
+        The image is marked in use under the lock it is resolved under, so a 
+        concurrent `prune` cannot remove it in between. An image removed 
+        before that, for example outside of the cache, is pulled again.
+
+        Args:
+            image (str): Image name including registry and tag
+
+        Returns:
+            str: ID of the local image
+        """
+        image_id = self.resolve(image, acquire=True)
+        if self.local_image(image_id) is None:
+            with self.lock:
+                self.resolved.pop(image, None)
+            try:
+                image_id = self.resolve(image)
+            except Exception:
+                self.release(image)
+                raise
+        return image_id
+
+    def release(self, image):
+        """Mark an image as no longer used by a job and prune unused images
+
+        Args:
+            image (str): Image name including registry and tag
+        """
+        with self.lock:
+            self.in_use[image] -= 1
+            if self.in_use[image] <= 0:
+                del self.in_use[image]
+        self.prune()
+
+    def prune(self):
+        """Remove least recently used images until they fit the disk budget
+
+        Returns:
+            list: Images that were removed
+        """
+        removed = []
+        if self.max_bytes is None:
+            return removed
+        # Images are removed under the lock so none is acquired meanwhile
+        with self.lock:
+            total = sum(self.sizes.values())
+            for image in list(self.sizes):
+                if total <= self.max_bytes:
+                    break
+                if image in self.in_use:
+                    continue
+                try:
+                    self.client.images.remove(self.resolved[image][0])
+                except docker.errors.ImageNotFound:
+                    pass
+                except docker.errors.APIError as e:
+                    print('Could not remove image {}: {}'.format(image, e))
+                    continue
+                print('Removed image {}'.format(image))
+                total -= self.sizes.pop(image, 0)
+                self.resolved.pop(image, None)
+                removed.append(image)
+        return removed
+
+    def images(self):
+        """List the images the cache has resolved, most recently used first
+
+        Returns:
+            list: Image names
+        """
+        with self.lock:
+            return list(reversed(self.sizes))
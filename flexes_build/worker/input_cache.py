@@ -0,0 +1,207 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from uuid import uuid4
+
+# Linux ioctl cloning a file's blocks, see ioctl_ficlone(2)
+FICLONE = getattr(fcntl, 'FICLONE', 0x40049409)
+
+class InputCache(object):
+    """Content-addressed on-disk cache of S3 objects shared by a worker's jobs.
+
+    Objects are stored under `root` by a hash of their bucket, key and ETag, so
+    a changed object is never served from the cache. Each job gets its own
+    copy of a cached file, so a job writing to its inputs cannot corrupt the
+    cache even when it runs as root. The copy is a reflink sharing the cached
+    blocks on copy-on-write file systems. The least recently used entries are
+    evicted once the cache holds more than `max_bytes`.
+
+    Attributes:
+        root (str): Cache directory
+        max_bytes (int): Disk budget for cached files in bytes
+        entries (collections.OrderedDict): Size of each cached file in least
+            recently used order
+        uris (dict): S3 URI of each file cached since the worker started
+        size (int): Total size of cached files in bytes
+        hits (int): Number of objects served from the cache
+        misses (int): Number of objects downloaded into the cache
+
+    Args:
+        root (str): Cache directory, created if it does not exist
+        max_bytes (int): Disk budget for cached files in bytes
+    """
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.uris = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.load()
+
+    def load(self):
+        """Index the files already in the cache directory, oldest first"""
+        files = []
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                if name.endswith('.part'):
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                files.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(files):
+            self.entries[path] = size
+            self.size += size
+        self.evict()
+
+    def entry_path(self, bucket, key, etag):
+        """Get the cache path for a version of an S3 object
+
+        Args:
+            bucket (str): S3 bucket name
+            key (str): S3 object key
+            etag (str): S3 object ETag
+
+        Returns:
+            str: Path of the cached file
+        """
+        digest = hashlib.sha256('\n'.join([bucket, key, etag]).encode()).hexdigest()
+        return os.path.join(self.root, digest[:2], digest)
+
+    def fetch(self, bucket, key, etag, size, local_file, download):
+        """Place an S3 object at a local path, downloading it on a cache miss
+
+        Args:
+            bucket (str): S3 bucket name
+            key (str): S3 object key
+            etag (str): S3 object ETag
+            size (int): S3 object size in bytes
+            local_file (str): Destination for the object
+            download (callable): Function that downloads the object to the path
+                it is called with
+
+        Returns:
+            bool: Whether the object was served from the cache
+        """
+        path = self.entry_path(bucket, key, etag)
+        uri = 's3://{}/{}'.format(bucket, key)
+        with self.lock:
+            cached = path in self.entries
+            if cached:
+                self.entries.move_to_end(path)
+        if cached:
+            try:
+                os.utime(path)
+                self.copy(path, local_file)
+            except FileNotFoundError:
+                # Removed by eviction or from outside the cache
+                with self.lock:
+                    self.forget(path)
+            else:
+                with self.lock:
+                    self.uris[path] = uri
+                    self.hits += 1
+                return True
+        with self.lock:
+            self.misses += 1
+
+        if size > self.max_bytes:
+            download(local_file)
+            return False
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part = '{}.{}.part'.format(path, uuid4().hex)
+        try:
+            download(part)
+            os.chmod(part, 0o444)
+            self.copy(part, local_file)
+            os.replace(part, path)
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
+
+        with self.lock:
+            if path not in self.entries:
+                self.entries[path] = os.path.getsize(path)
+                self.size += self.entries[path]
+            self.uris[path] = uri
+            self.entries.move_to_end(path)
+            self.evict()
+        return False
+
+    def forget(self, path):
+        """Drop the entry of a cached file that no longer exists
+
+        Args:
+            path (str): Path of the cached file
+        """
+        if path in self.entries and not os.path.exists(path):
+            self.size -= self.entries.pop(path)
+            self.uris.pop(path, None)
+
+    @staticmethod
+    def copy(path, local_file):
+        """Copy a cached file to a local path, as a reflink where supported
+
+        Args:
+            path (str): Path of the cached file
+            local_file (str): Destination path
+        """
+        if os.path.lexists(local_file):
+            os.remove(local_file)
+        try:
+            with open(path, 'rb') as src, open(local_file, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except FileNotFoundError:
+            raise
+        except OSError:
+            shutil.copyfile(path, local_file)
+
+    def evict(self):
+        """Remove least recently used files until the cache fits its budget"""
+        while self.size > self.max_bytes and len(self.entries) > 0:
+            path, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.uris.pop(path, None)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def recent(self, limit):
+        """List the S3 URIs of the most recently used cached files
+
+        Args:
+            limit (int): Maximum number of URIs
+
+        Returns:
+            list: S3 URIs, most recently used first
+        """
+        recent = []
+        with self.lock:
+            for path in reversed(self.entries):
+                uri = self.uris.get(path)
+                if uri is not None and uri not in recent:
+                    recent.append(uri)
+                    if len(recent) >= limit:
+                        break
+        return recent
+
+    def stats(self):
+        """Get cache usage counters
+
+        Returns:
+            dict: Cache hits, misses, number of entries and size in bytes
+        """
+        with self.lock:
+            return {'cache_hits': self.hits,
+                    'cache_misses': self.misses,
+                    'cache_entries': len(self.entries),
+                    'cache_bytes': self.size}
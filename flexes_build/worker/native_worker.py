@@ -1,15 +1,27 @@
 #! /usr/bin/env python
 
 import os
+import signal
 import subprocess
+import threading
+import time
+from . import utils
 from .api_worker import APIWorker
 from argparse import ArgumentParser
+from collections import deque
 
 class NativeWorker(APIWorker):
-    """API worker that executes jobs directly on the host"""
+    """API worker that executes jobs directly on the host
+
+    The process's output is read while it runs and written straight to its 
+    destinations, so memory use does not grow with the output. Jobs running 
+    longer than `JOB_TIMEOUT` seconds or producing more than `JOB_OUTPUT_LIMIT` 
+    bytes of output are killed along with every process they started.
+    """
     def __init__(self, *args, **kwargs):
         super(self.__class__, self).__init__(*args, **kwargs)
         self.log_line_limit = 10
+        self.read_size = 65536
         self.cmd_prefix = kwargs['cmd_prefix']
 
     @staticmethod
@@ -18,63 +30,172 @@ class NativeWorker(APIWorker):
         parts = parts[-tail_length:]
         return '\n'.join(parts)
 
-    def launch(self, command):
-        print('\n\033[1mStarting Native Job\033[0m')
+    def stream_output(self, stream, sink, tail, check_limit, publisher=None):
+        """Copy one of a process's output streams to its destinations as it is produced
+
+        Args:
+            stream (io.BufferedReader): STDOUT or STDERR of the process
+            sink (utils.OutputSink): Destination for the output
+            tail (utils.TailBuffer): End of the output for the worker log
+            check_limit (callable): Called after each chunk to enforce the 
+                output size limit
+            publisher (utils.CoalescingPublisher, optional): Publisher for the 
+                last lines of the output as job messages
+        """
+        def chunks():
+            for chunk in iter(lambda: stream.read1(self.read_size), b''):
+                sink.write(chunk)
+                tail.write(chunk)
+                check_limit()
+                yield chunk
+
+        if publisher is None:
+            for _ in chunks():
+                pass
+        else:
+            lines = deque(maxlen=self.config['MESSAGE_TAIL_LINES'])
+            for line in utils.iter_lines(chunks()):
+                lines.append(line.decode(errors='replace'))
+                publisher.update(list(lines))
+        stream.close()
+
+    @staticmethod
+    def kill_process_group(process):
+        """Kill a process started in its own session and everything it started
+
+        Args:
+            process (subprocess.Popen): Process started with `start_new_session`
+        """
+        if os.name == 'nt':
+            process.kill()
+            return
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
 
-        local_command = self.build_localized_command(command, self.cmd_prefix)
+    @staticmethod
+    def join_threads(threads, timeout):
+        """Wait for threads to finish for at most `timeout` seconds in total
+
+        Args:
+            threads (list): Threads to join
+            timeout (float): Seconds to wait, `None` waits indefinitely
+
+        Returns:
+            bool: `True` if every thread finished
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        return not any(thread.is_alive() for thread in threads)
+
+    def launch(self, message):
+        print('\n\033[1mStarting Native Job\033[0m')
 
-        stdin = None
-        stdout = subprocess.PIPE
-        stderr = subprocess.PIPE
+        command = message['command']
+        local_command = self.build_localized_command(command, self.cmd_prefix, job_id=message.get('job_id'))
 
         native_cmd, stdin_file, stdin_pipe, stdout_file, stdout_pipe, stderr_file, stderr_pipe = self.build_command_parts(local_command)
 
         native_cmd = self.cmd_prefix + native_cmd
 
+        # STDIN is fed through an OS pipe by a writer thread so it is streamed 
+        # in chunks without competing with the output readers
+        stdin = read_fd = write_fd = None
         if stdin_file is not None:
-            stdin = io.StringIO(stdin_file) if stdin_pipe else open(stdin_file, 'r')
-
-        if stdout_file is not None:
-            stdout = open(stdout_file, 'w')
-        if stdout_pipe:
-            assert(stdout_file is None)
-            stdout_file = ''
-            stdout = io.StringIO(stdout_file)
-
-        if stderr_file is not None:
-            stderr = open(stderr_file, 'w')
-        if stderr_pipe:
-            assert(stderr_file is None)
-            stderr_file = ''
-            stderr = io.StringIO(stderr_file)
+            read_fd, write_fd = os.pipe()
+            stdin = read_fd
 
         print('\nNative command:')
         print(native_cmd)
-        print('stdin:  {}'.format(stdin))
-        print('stdout: {}'.format(stdout))
-        print('stderr: {}'.format(stderr))
+        print('stdin:  {}'.format(stdin_file))
+        print('stdout: {}'.format(stdout_file))
+        print('stderr: {}'.format(stderr_file))
         
-        # Shell command used for Windows support
-        process = subprocess.Popen(native_cmd, stdin=stdin, 
-                                   stdout=stdout, stderr=stderr, 
-                                   shell=(os.name == 'nt'))
-
-        stdout_log, stderr_log = process.communicate()
-
-        if stdout_log != None:
-            stdout_log = self.lines_tail(stdout_log.decode(), self.log_line_limit)
-        if stderr_log != None:
-            stderr_log = self.lines_tail(stderr_log.decode(), self.log_line_limit)
-
+        try:
+            # Shell command used for Windows support, the process gets its own 
+            # session so the processes it starts can be killed with it
+            process = subprocess.Popen(native_cmd, stdin=stdin, 
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, 
+                                       shell=(os.name == 'nt'), start_new_session=True)
+        except Exception:
+            if write_fd is not None:
+                os.close(write_fd)
+            raise
+        finally:
+            if read_fd is not None:
+                os.close(read_fd)
+
+        threads = []
+        if stdin_file is not None:
+            def write_stdin():
+                try:
+                    self.stream_stdin(stdin_file, stdin_pipe, write_fd, message.get('job_id'))
+                except BrokenPipeError:
+                    print('Process closed STDIN before it was fully written')
+                finally:
+                    os.close(write_fd)
+            threads.append(threading.Thread(target=write_stdin, daemon=True))
+
+        def publish(messages):
+            if 'job_id' in message:
+                self.update_job_messages(message['job_id'], messages)
+        publisher = utils.CoalescingPublisher(publish, self.config['MESSAGE_UPDATE_INTERVAL'])
+
+        pipe_limit = self.config['OUTPUT_PIPE_LIMIT']
+        stdout_sink = utils.OutputSink(stdout_file, stdout_pipe, pipe_limit)
+        stderr_sink = utils.OutputSink(stderr_file, stderr_pipe, pipe_limit)
+        stdout_tail = utils.TailBuffer(self.config['OUTPUT_TAIL_BYTES'])
+        stderr_tail = utils.TailBuffer(self.config['OUTPUT_TAIL_BYTES'])
+
+        killed = []
+        def kill(reason):
+            if len(killed) == 0:
+                killed.append(reason)
+                print(reason)
+                self.kill_process_group(process)
+
+        output_limit = self.config['JOB_OUTPUT_LIMIT']
+        def check_limit():
+            if output_limit is not None and stdout_sink.size + stderr_sink.size > output_limit:
+                kill('Job exceeded output limit of {} bytes'.format(output_limit))
+
+        threads.append(threading.Thread(target=self.stream_output, 
+                                        args=(process.stdout, stdout_sink, stdout_tail, check_limit), 
+                                        daemon=True))
+        threads.append(threading.Thread(target=self.stream_output, 
+                                        args=(process.stderr, stderr_sink, stderr_tail, check_limit, publisher), 
+                                        daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            process.wait(timeout=self.config['JOB_TIMEOUT'])
+        except subprocess.TimeoutExpired:
+            kill('Job exceeded time limit of {} seconds'.format(self.config['JOB_TIMEOUT']))
+            process.wait()
+        finally:
+            # Processes left behind by the job can keep its output pipes open 
+            # after it exits, they are killed if the output does not end in time
+            drain_timeout = self.config['OUTPUT_DRAIN_TIMEOUT']
+            if not self.join_threads(threads, drain_timeout):
+                print('Killing processes still holding the job output')
+                self.kill_process_group(process)
+                if not self.join_threads(threads, drain_timeout):
+                    print('Job output did not close, abandoning its readers')
+            stdout_sink.close()
+            stderr_sink.close()
+        publisher.flush()
+
+        stdout_log = self.lines_tail(stdout_tail.getvalue(), self.log_line_limit)
+        stderr_log = self.lines_tail(stderr_tail.getvalue(), self.log_line_limit)
         worker_log = 'stdout:\n{}\n\nstderr:\n{}'.format(stdout_log, stderr_log)
+        if len(killed) > 0:
+            worker_log = killed[0] + '\n' + worker_log
 
-        stdout_data = stdout_file if stdout_pipe else None
-        stderr_data = stderr_file if stderr_pipe else None
-
-        for f in [stdin_file, stdout_file, stderr_file]:
-            if f is not None:
-                f.close()
-        return self.worker_cleanup(command, process.returncode, worker_log, stdout_data, stderr_data)
+        return self.worker_cleanup(command, process.returncode, worker_log, 
+                                   stdout_sink.getvalue(), stderr_sink.getvalue())
 
 
 if __name__ == '__main__': # pragma: no cover
@@ -87,6 +208,17 @@ if __name__ == '__main__': # pragma: no cover
                         help='queue for the worker to pull work from')
     parser.add_argument('-pf', '--poll_frequency', default=1, type=int, 
                         help='time to wait between polling the work queue (seconds)')
+    parser.add_argument('-nb', '--non_blocking', action='store_true', 
+                        help='poll the work queue instead of blocking on it')
+    parser.add_argument('-bt', '--block_timeout', type=int, 
+                        help='time to block on the work queue before checking the scheduler (seconds)')
+    parser.add_argument('-r', '--reliable', action='store_true', 
+                        help='keep jobs in a processing list until they finish so they can be requeued')
+    parser.add_argument('-c', '--concurrency', default=1, type=int, 
+                        help='number of jobs to run at once')
     args = parser.parse_args()
-    worker = NativeWorker(cmd_prefix=args.cmd_prefix, queue=args.queue, poll_frequency=args.poll_frequency)
+    worker = NativeWorker(cmd_prefix=args.cmd_prefix, queue=args.queue, poll_frequency=args.poll_frequency,
+                          blocking=not args.non_blocking, block_timeout=args.block_timeout, 
+                          reliable=args.reliable,
+                          concurrency=args.concurrency)
     worker.run()
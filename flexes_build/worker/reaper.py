@@ -0,0 +1,164 @@
+#! /usr/bin/env python
+
+import json
+import time
+from .. import config as configure
+from .. import scheduler
+from argparse import ArgumentParser
+from redis import StrictRedis
+
+
+class Reaper(object):
+    """Requeue jobs held by workers that stopped without finishing them.
+
+    Workers running in reliable mode keep the messages they are processing in
+    a per-worker list (`{queue}:processing:{worker_id}`) and send heartbeats to
+    their `worker:` entry. The reaper treats a worker as dead when it has been
+    marked dead, its entry has expired or its heartbeat is older than
+    `WORKER_TIMEOUT` and pushes its messages back onto the front of the queue.
+    Messages that have already been retried `MAX_RETRIES` times are moved to
+    the dead-letter list (`{queue}:deadletter`) and their job is marked failed.
+
+    Attributes:
+        config (dict): Reaper configuration
+        queue (str): Queue to reap, default `docker`
+        interval (int): Time between reaping passes in seconds
+        db (redis.StrictRedis): Redis connection
+
+    Args:
+        queue (str): Queue to reap, default `docker`
+        interval (int, optional): Time between reaping passes in seconds,
+            defaults to `REAPER_INTERVAL` in the configuration
+    """
+    def __init__(self, *args, **kwargs):
+        self.config = configure.load_config()
+        self.queue = kwargs.get('queue', 'docker')
+        self.interval = kwargs.get('interval', self.config['REAPER_INTERVAL'])
+        self.db = StrictRedis(self.config['REDIS_HOST'], self.config['REDIS_PORT'], decode_responses=True)
+
+    def is_dead(self, worker_id):
+        """Determine if a worker has stopped
+
+        Args:
+            worker_id (str): Unique ID for worker
+
+        Returns:
+            bool
+        """
+        status, heartbeat = self.db.hmget(self.config['WORKER_PREFIX'] + worker_id,
+                                          ['status', 'heartbeat'])
+        if status is None or status == 'dead':
+            return True
+        if heartbeat is None:
+            return False
+        return time.time() - float(heartbeat) > self.config['WORKER_TIMEOUT']
+
+    def mark_dead(self, worker_id):
+        """Remove a worker from the live workers of the queue
+
+        Args:
+            worker_id (str): Unique ID for worker
+        """
+        pipe = self.db.pipeline()
+        pipe.hset(self.config['WORKER_PREFIX'] + worker_id, 'status', 'dead')
+        pipe.srem('{}:workers:busy'.format(self.queue), worker_id)
+        pipe.smove('{}:workers'.format(self.queue), 'workers:dead', worker_id)
+        pipe.expire(self.config['WORKER_PREFIX'] + worker_id, 600)
+        pipe.execute()
+
+    def requeue_message(self, processing):
+        """Move the oldest message in a processing list back to the queue
+
+        The move runs in a transaction watching the processing list so a
+        message is never lost or requeued twice by concurrent reapers.
+
+        Args:
+            processing (str): Name of the processing list
+
+        Returns:
+            str: ID of the job that was requeued or dead-lettered, the dispatch 
+                token if a token was requeued, `None` if the processing list 
+                is empty
+        """
+        def requeue(pipe):
+            raw = pipe.lindex(processing, -1)
+            if raw is None:
+                return None
+            if scheduler.is_token(raw):
+                # The worker died before taking a job for the token
+                pipe.multi()
+                pipe.rpop(processing)
+                pipe.rpush(self.queue, raw)
+                return raw
+            message = json.loads(raw)
+            job_id = message['job_id']
+            job = self.config['JOB_PREFIX'] + job_id
+            message['retries'] = message.get('retries', 0) + 1
+
+            pipe.multi()
+            pipe.rpop(processing)
+            pipe.srem('{}:jobs:running'.format(self.queue), job_id)
+            if message['retries'] > self.config['MAX_RETRIES']:
+                print('Dead-lettering job {} after {} retries'.format(job_id, message['retries'] - 1))
+                pipe.lpush('{}:deadletter'.format(self.queue), json.dumps(message))
+                pipe.srem('{}:jobs'.format(self.queue), job_id)
+                pipe.hmset(job, {'status': self.config['STATUS_FAIL'],
+                                 'result': 'Job abandoned by worker too many times'})
+            else:
+                print('Requeueing job {} (retry {})'.format(job_id, message['retries']))
+                pipe.rpush(self.queue, json.dumps(message))
+                pipe.hmset(job, {'status': 'submitted', 'retries': message['retries']})
+            return job_id
+        return self.db.transaction(requeue, processing, value_from_callable=True)
+
+    def reap(self):
+        """Requeue the messages of every dead worker on the queue
+
+        The processing lists are found from the members of `workers:dead` 
+        rather than by scanning the keyspace. Workers stay there until their 
+        entry expires, which gives the reaper many passes to drain them.
+
+        Returns:
+            list: IDs of the jobs that were requeued or dead-lettered
+        """
+        for worker_id in self.db.smembers('{}:workers'.format(self.queue)):
+            if self.is_dead(worker_id):
+                print('Worker {} is dead'.format(worker_id))
+                self.mark_dead(worker_id)
+
+        jobs = []
+        for worker_id in sorted(self.db.smembers('workers:dead')):
+            # A worker restarted with the same ID owns its processing list again
+            if not self.is_dead(worker_id):
+                continue
+            processing = '{}:processing:{}'.format(self.queue, worker_id)
+            job_id = self.requeue_message(processing)
+            while job_id is not None:
+                if not scheduler.is_token(job_id):
+                    jobs.append(job_id)
+                job_id = self.requeue_message(processing)
+        return jobs
+
+    def run(self):
+        """Start reaper"""
+        print('Reaping queue {} every {} seconds'.format(self.queue, self.interval))
+        try:
+            while True:
+                self.reap()
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            print('\rStopping reaper')
+
+
+if __name__ == '__main__': # pragma: no cover
+    parser = ArgumentParser()
+    parser.add_argument('-q', '--queue', default='docker',
+                        help='queue to requeue abandoned jobs on')
+    parser.add_argument('-i', '--interval', default=None, type=int,
+                        help='time to wait between reaping passes (seconds)')
+    args = parser.parse_args()
+    kwargs = {'queue': args.queue}
+    if args.interval is not None:
+        kwargs['interval'] = args.interval
+    reaper = Reaper(**kwargs)
+    reaper.run()
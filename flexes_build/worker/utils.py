@@ -2,76 +2,144 @@ import boto3
 import docker
 import json
 import os
+import re
 import requests
+import threading
 import time
 from .. import config as configure
+from bisect import bisect_left
 from botocore.exceptions import ClientError
 from jsonschema import validate, ValidationError
 from pathlib import Path
 from uuid import uuid4
 
 config = configure.load_config()
-message_schema = configure.load_message_schema()
+message_validator = configure.load_message_validator()
+message_schema = message_validator.schema
 s3_uri_schema = message_schema['definitions']['s3_uri']
+s3_uri_pattern = re.compile(s3_uri_schema['pattern'])
 
-def s3_get_uri(s3, uri):
-    """Split S3 URI into a bucket object and key
+def s3_get_uri(uri):
+    """Split S3 URI into a bucket name and key
 
     Args:
-        s3 (boto3.resource): S3 connection
         uri (str): S3 URI
 
     Returns:
         tuple:
-            boto3.resource.Bucket: S3 bucket object
+            str: S3 bucket name
             str: S3 object key
     """
     bucket_name, key = uri.split('/', 3)[2:]
-    return (s3.Bucket(bucket_name), key)
+    return (bucket_name, key)
 
 
-def get_s3_file(s3, uri, local_file):
+def get_s3_file(s3, uri, local_file, config=None, cache=None):
     """Download file(s) from S3
     
     Args:
-        s3 (boto3.resource): S3 connection
+        s3 (botocore.client.S3): S3 client, clients are safe to share 
+            between the threads running transfers
         uri (str): S3 URI
         local_file (str): Local file destination for download
+        config (boto3.s3.transfer.TransferConfig, optional): Multipart transfer 
+            settings, defaults to the boto3 defaults
+        cache (InputCache, optional): Cache to serve objects from and download 
+            them into
 
     Raises:
         ValueError: If S3 object does not exist
     """
-    bucket, key = s3_get_uri(s3, uri)
-    files = [obj.key for obj in bucket.objects.filter(Prefix=key)
-                if not obj.key.endswith('/')]
+    bucket, key = s3_get_uri(uri)
+    pages = s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=key)
+    objects = [obj for page in pages for obj in page.get('Contents', [])
+                if not obj['Key'].endswith('/')]
 
-    if len(files) == 0:
+    if len(objects) == 0:
         raise ValueError('File {} not found'.format(uri))
 
-    for obj in files:
-        local_file = str(Path(local_file).with_name(Path(obj).name))
-        bucket.download_file(obj, local_file)
+    kwargs = {'Config': config} if config is not None else {}
+    for obj in objects:
+        local_file = str(Path(local_file).with_name(Path(obj['Key']).name))
+        if cache is None:
+            s3.download_file(bucket, obj['Key'], local_file, **kwargs)
+        else:
+            download = lambda path, key=obj['Key']: s3.download_file(bucket, key, path, **kwargs)
+            cache.fetch(bucket, obj['Key'], obj['ETag'], obj['Size'], local_file, download)
 
 
-def put_file_s3(s3, local_file, uri):
-    """Upload file to S3
+def open_s3_stream(s3, uri):
+    """Open an S3 object for reading without downloading it
 
     Args:
-        s3 (boto3.resource): S3 connection
+        s3 (botocore.client.S3): S3 client
+        uri (str): S3 URI of a single object
+
+    Returns:
+        botocore.response.StreamingBody: Object contents
+
+    Raises:
+        ValueError: If S3 object does not exist
+    """
+    bucket, key = s3_get_uri(uri)
+    try:
+        return s3.get_object(Bucket=bucket, Key=key)['Body']
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            raise ValueError('File {} not found'.format(uri))
+        raise
+
+
+def put_file_s3(s3, local_file, uri, listings=None, config=None, executor=None):
+    """Upload file(s) to S3
+
+    If there is no file named exactly like `local_file` every file in its 
+    directory that starts with its name is uploaded.
+
+    Args:
+        s3 (botocore.client.S3): S3 client
         local_file (str): Path to local file
         uri (str): S3 URI for upload destination
+        listings (dict, optional): Sorted file names of each local directory 
+            that has already been listed. The directory of `local_file` is added 
+            when it is missing so repeated uploads from one directory only list 
+            it once.
+        config (boto3.s3.transfer.TransferConfig, optional): Multipart transfer 
+            settings, defaults to the boto3 defaults
+        executor (concurrent.futures.Executor, optional): Executor to run the 
+            uploads on, files are uploaded one at a time when not provided
+
+    Returns:
+        list: Futures for the uploads submitted to `executor`
     """
-    bucket, key = s3_get_uri(s3, uri)
+    bucket, key = s3_get_uri(uri)
     local_dir = os.path.dirname(local_file)
     prefix = os.path.basename(local_file)
-    for f in os.listdir(local_dir):
-        if f == prefix:
-            bucket.upload_file(local_file, key)
-            break
-        elif f.startswith(prefix):
-            upload_file = os.path.join(local_dir, f)
-            upload_key = os.path.join(os.path.dirname(key), f)
-            bucket.upload_file(upload_file, upload_key)
+    if listings is None:
+        matches = [f for f in os.listdir(local_dir) if f.startswith(prefix)]
+    else:
+        if local_dir not in listings:
+            listings[local_dir] = sorted(os.listdir(local_dir))
+        files = listings[local_dir]
+        matches = []
+        i = bisect_left(files, prefix)
+        while i < len(files) and files[i].startswith(prefix):
+            matches.append(files[i])
+            i += 1
+
+    if prefix in matches:
+        uploads = [(local_file, key)]
+    else:
+        uploads = [(os.path.join(local_dir, f), os.path.join(os.path.dirname(key), f)) 
+                   for f in matches]
+
+    kwargs = {'Config': config} if config is not None else {}
+    if executor is None:
+        for upload_file, upload_key in uploads:
+            s3.upload_file(upload_file, bucket, upload_key, **kwargs)
+        return []
+    return [executor.submit(s3.upload_file, upload_file, bucket, upload_key, **kwargs) 
+            for upload_file, upload_key in uploads]
 
 
 def get_instance_info():
@@ -97,6 +165,212 @@ def get_instance_info():
     return instance_id, instance_type, private_ip
 
 
+class CoalescingPublisher(object):
+    """Publish a frequently changing value at a limited rate
+
+    Values updated less than `interval` seconds after the last publish are 
+    coalesced and only the most recent one is published once the interval has 
+    passed, so the publish rate does not grow with the update rate.
+
+    Attributes:
+        publish (callable): Function called with each value that is published
+        interval (float): Minimum time in seconds between publishes
+
+    Args:
+        publish (callable): Function called with each value that is published
+        interval (float): Minimum time in seconds between publishes
+    """
+    def __init__(self, publish, interval):
+        self.publish = publish
+        self.interval = interval
+        self.last_published = 0
+        self.pending = None
+        self.has_pending = False
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def update(self, value):
+        """Set a new value to publish
+
+        Args:
+            value: Value to publish
+        """
+        with self.lock:
+            self.pending = value
+            self.has_pending = True
+            wait = self.last_published + self.interval - time.time()
+            if wait > 0:
+                if self.timer is None:
+                    self.timer = threading.Timer(wait, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        """Publish the pending value, if there is one"""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.has_pending:
+                return
+            value = self.pending
+            self.has_pending = False
+            self.last_published = time.time()
+        self.publish(value)
+
+
+def iter_lines(chunks):
+    """Split a stream of byte chunks into lines
+
+    Args:
+        chunks (iterable): Byte strings
+
+    Yields:
+        bytes: Each line without its line ending
+    """
+    buffer = b''
+    for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            yield line.rstrip(b'\r')
+    if len(buffer) > 0:
+        yield buffer
+
+
+def copy_stream(source, write, chunk_size=1048576):
+    """Copy a readable stream to a writer one chunk at a time
+
+    Only one chunk is held in memory and the copy waits whenever the writer 
+    does, so the reader never gets ahead of the consumer. Partial writes are 
+    retried until the whole chunk is written.
+
+    Args:
+        source: Object with a `read(size)` method returning bytes
+        write (callable): Function that writes bytes and returns the number 
+            of bytes written, such as `os.write` bound to a file descriptor
+        chunk_size (int, optional): Maximum number of bytes read at once, 
+            default `1048576`
+
+    Returns:
+        dict: Number of bytes copied, time taken in seconds and throughput 
+            in bytes per second
+    """
+    start = time.time()
+    copied = 0
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        view = memoryview(chunk)
+        while len(view) > 0:
+            view = view[write(view):]
+        copied += len(chunk)
+    seconds = time.time() - start
+    return {'stdin_bytes': copied, 
+            'stdin_seconds': round(seconds, 3), 
+            'stdin_rate': round(copied / seconds) if seconds > 0 else copied}
+
+
+class OutputSink(object):
+    """Write a stream of output to a file and keep it in memory up to a limit
+
+    Output is written to `path` as it arrives so it never has to be held in 
+    memory. When `pipe` is set the first `limit` bytes are also kept so they 
+    can be returned to the user and anything past the limit is dropped.
+
+    Attributes:
+        path (str): File the output is written to, `None` to not write a file
+        pipe (bool): Whether the output is kept to return to the user
+        limit (int): Maximum number of bytes kept in memory
+        size (int): Number of bytes written
+        truncated (bool): Whether output past `limit` was dropped
+
+    Args:
+        path (str, optional): File the output is written to
+        pipe (bool, optional): Whether the output is kept to return to the 
+            user, default `False`
+        limit (int, optional): Maximum number of bytes kept in memory, 
+            default `None` for no limit
+    """
+    def __init__(self, path=None, pipe=False, limit=None):
+        self.path = path
+        self.pipe = pipe
+        self.limit = limit
+        self.size = 0
+        self.truncated = False
+        self.data = bytearray()
+        self.file = open(path, 'wb') if path is not None else None
+
+    def write(self, chunk):
+        """Write a chunk of output
+
+        Args:
+            chunk (bytes): Output
+        """
+        self.size += len(chunk)
+        if self.file is not None:
+            self.file.write(chunk)
+        if self.pipe and not self.truncated:
+            if self.limit is not None and len(self.data) + len(chunk) > self.limit:
+                chunk = chunk[:self.limit - len(self.data)]
+                self.truncated = True
+            self.data += chunk
+
+    def close(self):
+        """Close the output file"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def getvalue(self):
+        """Get the output kept in memory
+
+        Returns:
+            str: Output, `None` if the output is not piped
+        """
+        if not self.pipe:
+            return None
+        value = self.data.decode(errors='replace')
+        if self.truncated:
+            value += '\n[output truncated to {} of {} bytes]'.format(self.limit, self.size)
+        return value
+
+
+class TailBuffer(object):
+    """Keep the last bytes of a stream of output
+
+    Attributes:
+        limit (int): Maximum number of bytes kept
+
+    Args:
+        limit (int): Maximum number of bytes kept
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = bytearray()
+
+    def write(self, chunk):
+        """Write a chunk of output
+
+        Args:
+            chunk (bytes): Output
+        """
+        self.data += chunk[-self.limit:]
+        if len(self.data) > self.limit:
+            del self.data[:len(self.data) - self.limit]
+
+    def getvalue(self):
+        """Get the end of the output
+
+        Returns:
+            str: Last `limit` bytes of the output
+        """
+        return self.data.decode(errors='replace')
+
+
 # Validation
 def is_str_list(x):
     """Determine if object is a list of strings"""
@@ -112,12 +386,16 @@ def is_valid_message(message):
     Returns:
         bool
     """
-    return isvalid(message, message_schema)
+    return message_validator.is_valid(message)
 
 
 def is_s3_uri(uri):
-    """Determine if a string is a valid S3 URI"""
-    return isvalid(uri, s3_uri_schema)
+    """Determine if a string is a valid S3 URI
+
+    The schema's pattern is matched directly, which is equivalent to 
+    validating against `s3_uri_schema` without the overhead of jsonschema.
+    """
+    return isinstance(uri, str) and s3_uri_pattern.search(uri) is not None
 
 
 def isvalid(obj, schema):
@@ -13,16 +13,17 @@ setuptools.setup(
     long_description_content_type='text/markdown',
     packages=setuptools.find_packages(),
     package_data={'': ['*.css', '*.html', '*.js', '*.json']},
+    python_requires='>=3.8',
     install_requires=[
         'aiohttp>=3.5.4',
         'boto3>=1.9.117',
-        'docker>=3.7.1',
+        'docker>=4.0',
         'flask>=1.0.2',
         'flask-redis>=0.3.0',
         'flask-swagger-ui>=3.20.9',
         'gunicorn>=19.9.0',
         'jsonschema>=3.0.1',
-        'redis>=3.2.1',
+        'redis>=4.2',
         'requests>=2.21.0',
         'ujson>=1.35'
     ],
@@ -30,7 +31,9 @@ setuptools.setup(
         'dev': [
             'asynctest',
             'codecov',
+            'fakeredis',
             'mock',
+            'moto>=5.0',
             'pytest>=3.6',
             'pytest-cov',
             'pytest-flask'
@@ -38,6 +41,8 @@ setuptools.setup(
     },
     classifiers=[
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
         'License :: OSI Approved :: BSD License',
         'Operating System :: OS Independent'
     ]    
@@ -1,11 +1,13 @@
 import os, pytest, sys
 
+import fakeredis
+import io
 import json
 import mock
 import requests
 from argparse import ArgumentParser
 from botocore.exceptions import ClientError
-from collections import namedtuple
+from flexes_build import scheduler
 from flexes_build.config import load_config
 from flexes_build.worker.api_worker import APIWorker
 from flexes_build.worker import utils
@@ -16,9 +18,10 @@ SUCCESS = 'It worked!'
 config = load_config()
 
 class TestMessage:
+    @mock.patch('boto3.client')
     @mock.patch('flexes_build.worker.api_worker.StrictRedis')
     @mock.patch('boto3.resource')
-    def setup_method(self, _, mock_redis, mock_resource):
+    def setup_method(self, _, mock_redis, mock_resource, mock_client):
         self.message = {'job_id': '1234', 'service': 'worker'}
         self.worker = APIWorker(queue='test', poll_frequency=1)
         self.worker.launch = mock.MagicMock(return_value=(config['STATUS_COMPLETE'], SUCCESS, None, None))
@@ -61,9 +64,10 @@ class TestMessage:
         assert('error occurred (404)' in result)
 
 class TestLocalize:
+    @mock.patch('boto3.client')
     @mock.patch('flexes_build.worker.api_worker.StrictRedis')
     @mock.patch('boto3.resource')
-    def setup_method(self, _, mock_redis, mock_resource):
+    def setup_method(self, _, mock_redis, mock_resource, mock_client):
         self.message = {'job_id': '1234', 'service': 'worker'}
         self.worker = APIWorker(queue='test', poll_frequency=1)
         self.worker.launch = mock.MagicMock(return_value=(config['STATUS_COMPLETE'], SUCCESS, None, None))
@@ -79,9 +83,10 @@ class TestLocalize:
         mock_makedirs.assert_called()
 
 class TestCommands:
+    @mock.patch('boto3.client')
     @mock.patch('flexes_build.worker.api_worker.StrictRedis')
     @mock.patch('boto3.resource')
-    def setup_method(self, _, mock_redis, mock_resource):
+    def setup_method(self, _, mock_redis, mock_resource, mock_client):
         self.message = {'job_id': '1234', 'service': 'worker'}
         self.worker = APIWorker(queue='test', poll_frequency=1)
         self.worker.launch = mock.MagicMock(return_value=(config['STATUS_COMPLETE'], SUCCESS, None, None))
@@ -108,6 +113,19 @@ class TestCommands:
         bash_command = self.worker.build_bash_command(command)
         assert(bash_command == expected)
         
+    @mock.patch('flexes_build.worker.utils.get_s3_file')
+    @mock.patch('os.makedirs', return_value=None)
+    def test_localize_command_concurrent(self, mock_makedirs, mock_get_s3):
+        command = test_commands['full_command']['command']
+        local_command = self.worker.localize_command(command, job_id='1234')
+        assert(mock_get_s3.call_count == 3)
+        for call in mock_get_s3.call_args_list:
+            assert(call[1]['config'] is self.worker.transfer_config)
+        assert(local_command['arguments'][0]['value'] == self.worker.get_local_path('s3://bucket/path/to/input.txt'))
+        key, messages = self.worker.db.pipeline.return_value.set.call_args[0]
+        assert(key == 'message:1234')
+        assert(len(json.loads(messages)) == 3)
+
     @mock.patch('os.makedirs', return_value=None)
     def test_localize_command(self, mock_makedirs):
         self.worker.localize_resource = mock.MagicMock(return_value='/path/to/resource.txt')
@@ -115,10 +133,27 @@ class TestCommands:
         local_command = self.worker.localize_command(command)
         assert(isinstance(local_command, dict))
 
+    @mock.patch('os.makedirs', return_value=None)
+    def test_localize_command_stream_stdin(self, mock_makedirs):
+        self.worker.config = dict(self.worker.config, STREAM_STDIN_FROM_S3=True)
+        self.worker.localize_resource = mock.MagicMock(return_value='/path/to/resource.txt')
+        command = dict(test_commands['std_command']['command'], 
+                       stdin={'type': 'uri', 'value': 's3://bucket/path/to/stdin.txt'})
+        local_command = self.worker.localize_command(command)
+        assert(local_command['stdin']['value'] == command['stdin']['value'])
+        assert(mock.call(command['stdin']['value']) not in self.worker.localize_resource.call_args_list)
+
+    def test_open_stdin(self):
+        self.worker.s3.get_object.return_value = {'Body': io.BytesIO(b'data')}
+        assert(self.worker.open_stdin('some raw data', True).read() == b'some raw data')
+        assert(self.worker.open_stdin('s3://bucket/path/to/stdin.txt', False).read() == b'data')
+        self.worker.s3.get_object.assert_called_once_with(Bucket='bucket', Key='path/to/stdin.txt')
+
 class TestIO:
+    @mock.patch('boto3.client')
     @mock.patch('flexes_build.worker.api_worker.StrictRedis')
     @mock.patch('boto3.resource')
-    def setup_method(self, _, mock_redis, mock_resource):
+    def setup_method(self, _, mock_redis, mock_resource, mock_client):
         self.uri = 's3://bucket/path/to/file.txt'
         self.local_file = '/bucket/path/to/file.txt'
         self.message = {'job_id': '1234', 'service': 'worker'}
@@ -139,35 +174,53 @@ class TestIO:
         json_input = self.worker.get_local_path(filename)
         assert(json_input == filename)
 
+    def list_objects(self, *keys):
+        paginator = self.worker.s3.get_paginator.return_value
+        paginator.paginate.return_value = [{'Contents': [{'Key': key} for key in keys]}]
+        return paginator
+
     def test_s3_file_not_found(self):
-        self.worker.s3.Bucket.return_value.objects.filter.return_value = []
+        self.worker.s3.get_paginator.return_value.paginate.return_value = [{}]
         with pytest.raises(ValueError):
             utils.get_s3_file(self.worker.s3, self.uri, self.local_file)
 
     def test_get_s3_file(self):
-        Obj = namedtuple('Obj', ['key'])
         key = 'path/to/file.txt'
-        self.worker.s3.Bucket.return_value.objects.filter.return_value = [Obj(key=key)]
+        self.list_objects(key)
         utils.get_s3_file(self.worker.s3, self.uri, self.local_file)
-        self.worker.s3.Bucket.return_value.download_file.assert_called_with(key, self.local_file)
+        self.worker.s3.download_file.assert_called_with('bucket', key, self.local_file)
 
     @mock.patch('os.listdir')
     def test_put_file_s3(self, mock_listdir):
-        Obj = namedtuple('Obj', ['key'])
         key = 'path/to/file.txt'
         mock_listdir.return_value = ['file.txt']
-        self.worker.s3.Bucket.return_value.objects.filter.return_value = [Obj(key=key)]
         utils.put_file_s3(self.worker.s3, self.local_file, self.uri)
-        self.worker.s3.Bucket.return_value.upload_file.assert_called_with(self.local_file, key)
+        self.worker.s3.upload_file.assert_called_with(self.local_file, 'bucket', key)
+
+    @mock.patch('os.listdir')
+    def test_put_file_s3_listings(self, mock_listdir):
+        mock_listdir.return_value = ['file.dbf', 'other.txt', 'file.shp', 'files']
+        listings = {}
+        executor = mock.MagicMock()
+        uri = os.path.splitext(self.uri)[0]
+        local_file = os.path.splitext(self.local_file)[0]
+        futures = utils.put_file_s3(self.worker.s3, local_file, uri, listings=listings, executor=executor)
+        assert(listings == {'/bucket/path/to': ['file.dbf', 'file.shp', 'files', 'other.txt']})
+        assert(len(futures) == 3)
+        executor.submit.assert_called_with(self.worker.s3.upload_file, 
+                                           local_file + 's', 'bucket', 'path/to/files')
+        utils.put_file_s3(self.worker.s3, local_file + '.shp', uri + '.shp', listings=listings, executor=executor)
+        executor.submit.assert_called_with(self.worker.s3.upload_file, 
+                                           local_file + '.shp', 'bucket', 'path/to/file.shp')
+        mock_listdir.assert_called_once()
 
     def test_get_s3_file_prefix(self):
-        Obj = namedtuple('Obj', ['key'])
         uri = os.path.splitext(self.uri)[0]
-        key = 'path/to/file.txt'
-        self.worker.s3.Bucket.return_value.objects.filter.return_value = [Obj(key=key)]
+        paginator = self.list_objects('path/to/file.txt')
         local_file = os.path.splitext(self.local_file)[0]
         utils.get_s3_file(self.worker.s3, uri, local_file)
-        self.worker.s3.Bucket.return_value.objects.filter.assert_called_with(Prefix='path/to/file')
+        paginator.paginate.assert_called_with(Bucket='bucket', Prefix='path/to/file')
+        self.worker.s3.download_file.assert_called_with('bucket', 'path/to/file.txt', local_file + '.txt')
 
     @mock.patch('os.listdir')
     def test_put_file_s3_prefix(self, mock_listdir):
@@ -176,14 +229,90 @@ class TestIO:
         uri = os.path.splitext(self.uri)[0]
         local_file = os.path.splitext(self.local_file)[0]
         key = 'path/to/file'
-        calls = [mock.call(local_file + ext, key + ext) for ext in extensions]
+        calls = [mock.call(local_file + ext, 'bucket', key + ext) for ext in extensions]
         utils.put_file_s3(self.worker.s3, local_file, uri)
-        self.worker.s3.Bucket.return_value.upload_file.assert_has_calls(calls)
+        self.worker.s3.upload_file.assert_has_calls(calls)
+
+class TestCoalescingPublisher:
+    def setup_method(self, _):
+        self.published = []
+        self.publisher = utils.CoalescingPublisher(self.published.append, 60)
+
+    def test_coalesce(self):
+        for i in range(5):
+            self.publisher.update(i)
+        assert(self.published == [0])
+        self.publisher.flush()
+        assert(self.published == [0, 4])
+        self.publisher.flush()
+        assert(self.published == [0, 4])
+
+    def test_publish_after_interval(self):
+        self.publisher.interval = 0.01
+        self.publisher.update(1)
+        self.publisher.update(2)
+        self.publisher.timer.join()
+        assert(self.published == [1, 2])
+
+    def test_iter_lines(self):
+        chunks = [b'first li', b'ne\nsecond line\r\nthi', b'rd']
+        assert(list(utils.iter_lines(chunks)) == [b'first line', b'second line', b'third'])
+
+class TestOutputSink:
+    def test_file(self, tmp_path):
+        path = str(tmp_path / 'stdout.txt')
+        sink = utils.OutputSink(path)
+        sink.write(b'line 1\n')
+        sink.write(b'line 2\n')
+        sink.close()
+        assert(open(path, 'rb').read() == b'line 1\nline 2\n')
+        assert(sink.getvalue() == None)
+
+    def test_pipe_limit(self):
+        sink = utils.OutputSink(pipe=True, limit=5)
+        sink.write(b'abc')
+        sink.write(b'defgh')
+        assert(sink.truncated)
+        assert(sink.getvalue() == 'abcde\n[output truncated to 5 of 8 bytes]')
+
+    def test_tail(self):
+        tail = utils.TailBuffer(4)
+        tail.write(b'abc')
+        tail.write(b'de')
+        assert(tail.getvalue() == 'bcde')
+        tail.write(b'0123456789')
+        assert(tail.getvalue() == '6789')
+
+class TestValidation:
+    @pytest.mark.parametrize('uri', ['s3://bucket/path/to/file.txt', 's3://my-bucket.1a/', 
+                                     's3://bucket/path/to/dir/', 's3:/bucket/file.txt', 
+                                     's3://bucket1/file.txt', 's3://bucket/file name.txt', 
+                                     '/local/path/file.txt', 'arg_val', '', 1, None])
+    def test_is_s3_uri_matches_schema(self, uri):
+        assert(utils.is_s3_uri(uri) == utils.isvalid(uri, utils.s3_uri_schema))
+
+    def test_is_valid_message(self):
+        message = dict(test_commands['full_command'], job_id='1234')
+        assert(utils.is_valid_message(message))
+        del message['service']
+        assert(not utils.is_valid_message(message))
+
+class TestCopyStream:
+    def test_partial_writes(self):
+        written = []
+        def write(data):
+            written.append(bytes(data[:3]))
+            return min(len(data), 3)
+        stats = utils.copy_stream(io.BytesIO(b'abcdefghij'), write, chunk_size=4)
+        assert(b''.join(written) == b'abcdefghij')
+        assert(max(len(chunk) for chunk in written) == 3)
+        assert(stats['stdin_bytes'] == 10)
 
 class TestModifyJob:
+    @mock.patch('boto3.client')
     @mock.patch('flexes_build.worker.api_worker.StrictRedis')
     @mock.patch('boto3.resource')
-    def setup_method(self, _, mock_redis, mock_resource):
+    def setup_method(self, _, mock_redis, mock_resource, mock_client):
         self.uri = 's3://bucket/path/to/file.txt'
         self.local_file = '/bucket/path/to/file.txt'
         self.message = {'job_id': '1234', 'service': 'worker'}
@@ -195,15 +324,90 @@ class TestModifyJob:
         status, result = self.worker.update_job('test1234', 'testing')
         assert(status == 'testing')
 
+    def test_update_job_running(self):
+        status, result = self.worker.update_job('test1234', config['STATUS_RUNNING'])
+        pipe = self.worker.db.pipeline.return_value
+        pipe.sadd.assert_called_with('test:jobs:running', 'test1234')
+        pipe.execute.assert_called_once()
+        self.worker.db.hget.assert_not_called()
+
+    def test_update_job_complete(self):
+        status, result = self.worker.update_job('test1234', config['STATUS_COMPLETE'], SUCCESS, queue='other')
+        pipe = self.worker.db.pipeline.return_value
+        pipe.expire.assert_has_calls([mock.call('job:test1234', 60), 
+                                      mock.call('message:test1234', 60)])
+        pipe.srem.assert_has_calls([mock.call('other:jobs', 'test1234'), 
+                                    mock.call('other:jobs:running', 'test1234')])
+        pipe.execute.assert_called_once()
+        channel, event = pipe.publish.call_args[0]
+        assert(channel == 'events:test1234')
+        assert(json.loads(event) == {'event': 'status', 'job_id': 'test1234', 'status': config['STATUS_COMPLETE']})
+        assert(self.worker.archiver.records.get_nowait() == {'job_id': 'test1234', 
+                                                             'status': config['STATUS_COMPLETE'], 
+                                                             'result': SUCCESS})
+        assert(status == config['STATUS_COMPLETE'])
+        assert(result == SUCCESS)
+
+    def test_update_job_messages(self):
+        self.worker.update_job_messages('test1234', ['step 1'])
+        pipe = self.worker.db.pipeline.return_value
+        pipe.set.assert_called_with('message:test1234', '["step 1"]')
+        channel, event = pipe.publish.call_args[0]
+        assert(channel == 'events:test1234')
+        assert(json.loads(event)['messages'] == ['step 1'])
+        pipe.execute.assert_called_once()
+
+class TestRedis:
+    @mock.patch('boto3.client')
+    @mock.patch('flexes_build.worker.api_worker.StrictRedis')
+    @mock.patch('boto3.resource')
+    def setup_method(self, _, mock_redis, mock_resource, mock_client):
+        self.worker = APIWorker(queue='test', poll_frequency=1)
+        self.worker.db = fakeredis.FakeStrictRedis(decode_responses=True)
+        self.worker.archiver = mock.MagicMock()
+        self.worker.launch = mock.MagicMock(return_value=(config['STATUS_COMPLETE'], SUCCESS, None, None))
+
+    @mock.patch('requests.get', side_effect=requests.exceptions.ConnectionError)
+    def test_run_job(self, mock_get):
+        # Local workers have no private IP
+        instance_id = self.worker.register_worker()
+        assert(self.worker.db.hget('worker:' + instance_id, 'status') == 'idle')
+        self.worker.db.lpush('test', json.dumps({'job_id': 'job1', 'service': 'test', 'command': {'arguments': []}}))
+        message = self.worker.receive_message()
+        assert(self.worker.db.hget('job:job1', 'status') == config['STATUS_RUNNING'])
+        with mock.patch.object(self.worker, 'update_job', wraps=self.worker.update_job) as mock_update:
+            self.worker.process_message(message)
+        # Running was already written when the message was received
+        mock_update.assert_called_once_with('job1', config['STATUS_COMPLETE'], SUCCESS, None, None)
+        assert(self.worker.db.hgetall('job:job1') == {'status': config['STATUS_COMPLETE'], 'result': SUCCESS})
+
+    @mock.patch('requests.get', side_effect=requests.exceptions.ConnectionError)
+    def test_run_job_error_acknowledged(self, mock_get):
+        self.worker.reliable = True
+        self.worker.register_worker()
+        self.worker.db.lpush('test', json.dumps({'job_id': 'job1', 'service': 'test', 'command': {'arguments': []}}))
+        message = self.worker.receive_message()
+        assert(self.worker.db.llen(self.worker.processing_queue) == 1)
+        self.worker.process_message = mock.MagicMock(side_effect=ConnectionError('Redis went away'))
+        self.worker.run_job(message, 0)
+        # Failed jobs leave the processing list so the reaper never runs them again
+        assert(self.worker.db.llen(self.worker.processing_queue) == 0)
+        assert(self.worker.db.hget('job:job1', 'status') == config['STATUS_FAIL'])
+        assert(self.worker.in_flight == {})
+
+
 class TestWorker:
+    @mock.patch('boto3.client')
     @mock.patch('flexes_build.worker.api_worker.StrictRedis')
     @mock.patch('boto3.resource')
-    def setup_method(self, _, mock_redis, mock_resource):
+    def setup_method(self, _, mock_redis, mock_resource, mock_client):
         self.uri = 's3://bucket/path/to/file.txt'
         self.local_file = '/bucket/path/to/file.txt'
         self.message = {'job_id': '1234', 'service': 'worker'}
         self.worker = APIWorker(queue='test', poll_frequency=1)
         self.worker.launch = mock.MagicMock(return_value=(config['STATUS_COMPLETE'], SUCCESS, None, None))
+        # No jobs waiting in the fair scheduler
+        self.worker.db.transaction.return_value = None
 
     def test_update_worker_status(self):
         self.worker.instance_id = 'test'
@@ -221,6 +425,18 @@ class TestWorker:
         instance_id = self.worker.register_worker()
         assert(instance_id == 'test')
 
+    @mock.patch('requests.get')
+    def test_register_worker_shared_host(self, mock_get):
+        mock_get.return_value.json.return_value = {'instanceId': 'test', 'instanceType': 't2.micro', 'privateIp': '10.0.0.1'}
+        self.worker.db.hsetnx.side_effect = [False, False, True]
+        instance_id = self.worker.register_worker()
+        assert(instance_id == 'test_2')
+        assert(self.worker.instance_id == 'test_2')
+        self.worker.db.keys.assert_not_called()
+        pipe = self.worker.db.pipeline.return_value
+        pipe.sadd.assert_any_call('test:workers', 'test_2')
+        pipe.sadd.assert_any_call('queues', 'test')
+
     @mock.patch('requests.get', side_effect=requests.exceptions.ConnectionError)
     def test_register_worker_local(self, mock_get):
         instance_id = self.worker.register_worker()
@@ -233,9 +449,152 @@ class TestWorker:
                 'instanceType': 't2.micro', 
                 'privateIp': '10.0.0.1'
         }
+        self.worker.blocking = False
         self.worker.db.rpop.side_effect = [
                     None, None, None,
                     '{"job_id":"test","test":true}',
                     None, None, None, KeyboardInterrupt
                 ]
         self.worker.run()
+
+    @mock.patch('time.sleep')
+    @mock.patch('requests.get')
+    def test_worker_run_blocking(self, mock_get, mock_sleep):
+        mock_get.return_value.json.return_value = {
+                'instanceId': 'test', 
+                'instanceType': 't2.micro', 
+                'privateIp': '10.0.0.1'
+        }
+        self.worker.db.brpop.side_effect = [
+                    None,
+                    ('test', '{"job_id":"test","test":true}'),
+                    None, KeyboardInterrupt
+                ]
+        self.worker.run()
+        self.worker.db.brpop.assert_called_with('test', timeout=config['BLOCK_TIMEOUT'])
+        self.worker.db.rpop.assert_not_called()
+        mock_sleep.assert_not_called()
+
+    def test_receive_message_blocking(self):
+        self.worker.db.brpop.return_value = ('test', '{"job_id":"test"}')
+        message = self.worker.receive_message()
+        assert(message == {'job_id': 'test'})
+
+    def test_receive_message_blocking_timeout(self):
+        self.worker.db.brpop.return_value = None
+        assert(self.worker.receive_message() is None)
+
+    @mock.patch('boto3.client')
+    @mock.patch('flexes_build.worker.api_worker.StrictRedis')
+    @mock.patch('boto3.resource')
+    def test_block_timeout(self, mock_resource, mock_redis, mock_client):
+        worker = APIWorker(queue='test', poll_frequency=1, block_timeout=120)
+        worker.db.transaction.return_value = None
+        worker.db.brpop.return_value = None
+        assert(worker.receive_message() is None)
+        worker.db.brpop.assert_called_with('test', timeout=120)
+
+    def test_receive_message_reliable(self):
+        raw = '{"job_id":"test"}'
+        self.worker.instance_id = 'worker1'
+        self.worker.reliable = True
+        self.worker.db.brpoplpush.return_value = raw
+        message = self.worker.receive_message()
+        self.worker.db.brpoplpush.assert_called_with('test', 'test:processing:worker1', timeout=config['BLOCK_TIMEOUT'])
+        assert(self.worker.in_flight == {'test': raw})
+        self.worker.acknowledge_message(message)
+        self.worker.db.lrem.assert_called_with('test:processing:worker1', 1, raw)
+        assert(self.worker.in_flight == {})
+
+    @mock.patch('flexes_build.scheduler.dispatch', return_value='{"job_id":"test"}')
+    def test_receive_message_token(self, mock_dispatch):
+        self.worker.db.brpop.return_value = ('test', scheduler.TOKEN)
+        assert(self.worker.receive_message() == {'job_id': 'test'})
+        args, kwargs = mock_dispatch.call_args
+        assert(args == (self.worker.db, 'test', None))
+        assert(kwargs['token'] is True)
+
+    @mock.patch('flexes_build.scheduler.dispatch', return_value='{"job_id":"test"}')
+    def test_receive_message_token_reliable(self, mock_dispatch):
+        self.worker.instance_id = 'worker1'
+        self.worker.reliable = True
+        self.worker.db.brpoplpush.return_value = scheduler.TOKEN
+        message = self.worker.receive_message()
+        assert(mock_dispatch.call_args[0] == (self.worker.db, 'test', 'test:processing:worker1'))
+        assert(mock_dispatch.call_args[1]['worker'] == 'worker1')
+        self.worker.acknowledge_message(message)
+        self.worker.db.lrem.assert_called_with('test:processing:worker1', 1, '{"job_id":"test"}')
+
+    def test_receive_message_reliable_non_blocking(self):
+        self.worker.instance_id = 'worker1'
+        self.worker.reliable = True
+        self.worker.blocking = False
+        self.worker.db.rpoplpush.return_value = None
+        assert(self.worker.receive_message() is None)
+        self.worker.db.rpoplpush.assert_called_with('test', 'test:processing:worker1')
+
+    def test_acknowledge_message_unreliable(self):
+        self.worker.db.brpop.return_value = ('test', '{"job_id":"test"}')
+        message = self.worker.receive_message()
+        self.worker.acknowledge_message(message)
+        self.worker.db.lrem.assert_not_called()
+
+    def test_slot_worker(self):
+        worker = self.worker.slot_worker(1)
+        assert(worker.slot == 1)
+        assert(worker.local_files_path != self.worker.local_files_path)
+        assert(worker.db is self.worker.db)
+        assert(worker.in_flight is self.worker.in_flight)
+        assert(self.worker.slot is None)
+
+    def test_update_slot_status(self):
+        self.worker.instance_id = 'worker1'
+        self.worker.concurrency = 2
+        self.worker.update_worker_status = mock.MagicMock()
+        self.worker.update_slot_status(0, 'busy')
+        self.worker.update_worker_status.assert_called_with('idle')
+        self.worker.update_slot_status(1, 'busy')
+        self.worker.db.hmset.assert_called_with('worker:worker1', {'slot:1': 'busy', 'busy_slots': 2})
+        self.worker.update_worker_status.assert_called_with('busy')
+        self.worker.update_slot_status(0, 'idle')
+        self.worker.update_worker_status.assert_called_with('idle')
+        assert(self.worker.busy_slots == 1)
+
+    @mock.patch('requests.get')
+    def test_worker_run_concurrent(self, mock_get):
+        mock_get.return_value.json.return_value = {
+                'instanceId': 'test', 
+                'instanceType': 't2.micro', 
+                'privateIp': '10.0.0.1'
+        }
+        self.worker.concurrency = 2
+        self.worker.process_message = mock.MagicMock()
+        self.worker.db.brpop.side_effect = [
+                    ('test', '{"job_id":"job1","service":"test","command":{"arguments":[]}}'),
+                    ('test', '{"job_id":"job2","service":"test","command":{"arguments":[]}}'),
+                    None, KeyboardInterrupt
+                ]
+        self.worker.run()
+        assert(self.worker.process_message.call_count == 2)
+        assert(self.worker.busy_slots == 0)
+
+    def test_heartbeat(self):
+        self.worker.instance_id = 'worker1'
+        self.worker.heartbeat()
+        args = self.worker.db.hset.call_args[0]
+        assert(args[:2] == ('worker:worker1', 'heartbeat'))
+
+    def test_advertise(self):
+        self.worker.instance_id = 'worker1'
+        self.worker.input_cache = mock.MagicMock()
+        self.worker.input_cache.recent.return_value = ['s3://bucket/a']
+        self.worker.advertise()
+        self.worker.db.hmset.assert_called_with('worker:worker1', {'images': '[]', 'inputs': '["s3://bucket/a"]'})
+        self.worker.input_cache.recent.assert_called_with(self.worker.config['AFFINITY_MAX_INPUTS'])
+
+    @mock.patch('flexes_build.scheduler.dispatch', return_value=None)
+    def test_receive_message_token_declined(self, mock_dispatch):
+        self.worker.stopped = mock.MagicMock()
+        self.worker.db.brpop.return_value = ('test', scheduler.TOKEN)
+        assert(self.worker.receive_message() is None)
+        self.worker.stopped.wait.assert_called_with(self.worker.poll_frequency)
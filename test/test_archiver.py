@@ -0,0 +1,113 @@
+import os, pytest, sys
+
+import boto3
+import mock
+from botocore.exceptions import ClientError
+from flexes_build.worker.archiver import JobArchiver
+from moto import mock_aws
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+
+class TestArchiverDynamoDB:
+    def setup_method(self, _):
+        self.mock_aws = mock_aws()
+        self.mock_aws.start()
+        self.dyn = boto3.resource('dynamodb', region_name='us-east-1')
+        self.table = self.dyn.create_table(TableName='jobs',
+                                           KeySchema=[{'AttributeName': 'job_id', 'KeyType': 'HASH'}],
+                                           AttributeDefinitions=[{'AttributeName': 'job_id', 'AttributeType': 'S'}],
+                                           BillingMode='PAY_PER_REQUEST')
+        self.archiver = JobArchiver(self.dyn, 'jobs', batch_size=10, flush_interval=0.1)
+
+    def teardown_method(self, _):
+        self.mock_aws.stop()
+
+    def test_archive(self):
+        self.archiver.start()
+        for i in range(30):
+            self.archiver.archive('job{}'.format(i), 'complete', 'result {}'.format(i))
+        self.archiver.stop()
+        items = self.table.scan()['Items']
+        assert(len(items) == 30)
+        item = self.table.get_item(Key={'job_id': 'job7'})['Item']
+        assert(item == {'job_id': 'job7', 'status': 'complete', 'result': 'result 7'})
+
+    def test_archive_flush_interval(self):
+        self.archiver.start()
+        self.archiver.archive('job1', 'failed', None)
+        for _ in range(50):
+            if 'Item' in self.table.get_item(Key={'job_id': 'job1'}):
+                break
+            self.archiver.thread.join(0.05)
+        assert(self.table.get_item(Key={'job_id': 'job1'})['Item']['status'] == 'failed')
+        self.archiver.stop()
+
+    def test_flush_duplicates(self):
+        self.archiver.flush([{'job_id': 'job1', 'status': 'running', 'result': None},
+                             {'job_id': 'job1', 'status': 'complete', 'result': 'done'}])
+        item = self.table.get_item(Key={'job_id': 'job1'})['Item']
+        assert(item['status'] == 'complete')
+
+class TestArchiverRetry:
+    def setup_method(self, _):
+        self.dyn = mock.MagicMock()
+        self.archiver = JobArchiver(self.dyn, 'jobs', max_retries=2)
+        self.requests = [{'PutRequest': {'Item': {'job_id': 'job1'}}}]
+
+    @mock.patch('time.sleep')
+    def test_unprocessed_items(self, mock_sleep):
+        self.dyn.batch_write_item.side_effect = [{'UnprocessedItems': {'jobs': self.requests}}, 
+                                                 {'UnprocessedItems': {}}]
+        self.archiver.write_batch(self.requests)
+        assert(self.dyn.batch_write_item.call_count == 2)
+
+    @mock.patch('time.sleep')
+    def test_client_error(self, mock_sleep):
+        error = ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'BatchWriteItem')
+        self.dyn.batch_write_item.side_effect = [error, {}]
+        self.archiver.write_batch(self.requests)
+        assert(self.dyn.batch_write_item.call_count == 2)
+
+    @mock.patch('time.sleep')
+    def test_retries_exhausted(self, mock_sleep):
+        self.dyn.batch_write_item.return_value = {'UnprocessedItems': {'jobs': self.requests}}
+        with pytest.raises(RuntimeError):
+            self.archiver.write_batch(self.requests)
+        assert(self.dyn.batch_write_item.call_count == 3)
+
+    def test_batch_size_limit(self):
+        archiver = JobArchiver(self.dyn, 'jobs', batch_size=100)
+        assert(archiver.batch_size == 25)
+
+    def test_requeue_failed(self):
+        self.archiver.write_batch = mock.MagicMock(side_effect=[RuntimeError('throttled'), None])
+        self.archiver.flush_pending([{'job_id': 'job1', 'status': 'complete'}])
+        assert(self.archiver.failed == [({'job_id': 'job1', 'status': 'complete'}, 1)])
+        self.archiver.flush_pending([])
+        self.archiver.write_batch.assert_called_with([{'PutRequest': {'Item': {'job_id': 'job1', 'status': 'complete'}}}])
+        assert(self.archiver.failed == [])
+
+    def test_requeue_limit(self):
+        archiver = JobArchiver(self.dyn, 'jobs', max_requeues=1, max_pending=1)
+        archiver.write_batch = mock.MagicMock(side_effect=RuntimeError('throttled'))
+        archiver.flush_pending([{'job_id': 'job1'}, {'job_id': 'job2'}])
+        # Only the most recent failures are kept beyond `max_pending`
+        assert(archiver.failed == [({'job_id': 'job2'}, 1)])
+        archiver.flush_pending([])
+        assert(archiver.failed == [])
+
+    @mock.patch('time.sleep')
+    def test_run_retries_after_outage(self, mock_sleep):
+        archiver = JobArchiver(self.dyn, 'jobs', flush_interval=0.01, max_retries=0)
+        error = ClientError({'Error': {'Code': 'ServiceUnavailable'}}, 'BatchWriteItem')
+        self.dyn.batch_write_item.side_effect = [error, error, {}]
+        archiver.start()
+        archiver.archive('job1', 'complete', 'done')
+        for _ in range(100):
+            if self.dyn.batch_write_item.call_count == 3:
+                break
+            archiver.thread.join(0.01)
+        archiver.stop()
+        assert(self.dyn.batch_write_item.call_count == 3)
+        assert(archiver.failed == [])
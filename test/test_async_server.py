@@ -0,0 +1,307 @@
+import os, pytest, sys
+
+import asyncio
+import botocore
+import json
+import mock
+import time
+from aiohttp.test_utils import TestClient, TestServer
+from asynctest import CoroutineMock, MagicMock
+from flexes_build.server import async_app, async_utils, utils
+
+def mock_db():
+    db = MagicMock()
+    db.pubsub.return_value.close = CoroutineMock()
+    return db
+
+
+def request(method, url, db=None, **kwargs):
+    async def send():
+        async with TestClient(TestServer(async_app.create_app(db or mock_db()))) as client:
+            response = await client.request(method, url, **kwargs)
+            body = await response.read()
+            return response, body
+    return asyncio.run(send())
+
+
+class TestAsyncEndpoints:
+    def test_index(self):
+        response, body = request('GET', '/')
+        assert(response.status == 200)
+        assert(b'/static/css/style.css' in body)
+
+    @mock.patch('flexes_build.server.async_app.submit_job', new_callable=CoroutineMock, return_value='job_id')
+    def test_service_post(self, mock_submit):
+        message = {'service': 'test', 'command': {'arguments': []}}
+        response, body = request('POST', '/', json=message)
+        assert(response.status == 202)
+        assert(json.loads(body) == {'job_id': 'job_id', 'status': 'submitted', 'message': 'job submitted'})
+        assert(response.headers['Location'].endswith('/jobs/job_id'))
+
+    @mock.patch.dict('flexes_build.server.utils.config', {'TENANT_HEADER': 'X-Tenant'})
+    @mock.patch('flexes_build.server.async_app.submit_job', new_callable=CoroutineMock, return_value='job_id')
+    def test_service_post_tenant_header(self, mock_submit):
+        message = {'service': 'test', 'tenant': 'alice', 'command': {'arguments': []}}
+        response, body = request('POST', '/', json=message, headers={'X-Tenant': 'bob'})
+        assert(response.status == 202)
+        assert(mock_submit.call_args[0][1]['tenant'] == 'bob')
+
+    def test_service_post_empty(self):
+        response, body = request('POST', '/')
+        assert(response.status == 400)
+        assert(json.loads(body)['message'] == 'no message found in request')
+
+    def test_service_post_invalid(self):
+        response, body = request('POST', '/', json={'foo': 'bar'})
+        assert(response.status == 400)
+        assert(json.loads(body)['message'] == 'not a valid input')
+
+    @mock.patch('flexes_build.server.async_app.submit_jobs', new_callable=CoroutineMock, return_value=('batch_id', ['a', 'b']))
+    def test_batch_post(self, mock_submit):
+        messages = [{'service': 'test', 'command': {'arguments': []}} for _ in range(2)]
+        response, body = request('POST', '/jobs/batch', json=messages)
+        assert(response.status == 202)
+        assert(json.loads(body)['job_ids'] == ['a', 'b'])
+
+    @mock.patch('flexes_build.server.async_app.batch_status', new_callable=CoroutineMock, return_value=None)
+    def test_batch_missing(self, mock_status):
+        response, body = request('GET', '/jobs/batch/abc')
+        assert(response.status == 404)
+        assert(b'Page Not Found' in body)
+
+    @mock.patch('flexes_build.server.async_app.query_job_status', new_callable=CoroutineMock,
+                return_value={'job_id': 'abc', 'status': 'running'})
+    def test_job_status(self, mock_status):
+        response, body = request('GET', '/jobs/abc/status')
+        assert(json.loads(body) == {'job_id': 'abc', 'status': 'running'})
+
+    @mock.patch('flexes_build.server.async_app.wait_for_job', new_callable=CoroutineMock,
+                return_value={'job_id': 'abc', 'status': 'complete'})
+    def test_job_status_wait(self, mock_wait):
+        response, body = request('GET', '/jobs/abc/status?wait=600')
+        assert(json.loads(body)['status'] == 'complete')
+        assert(mock_wait.call_args[0][2:] == ('abc', async_app.config['MAX_WAIT']))
+        response, body = request('GET', '/jobs/abc/status?wait=soon')
+        assert(response.status == 400)
+
+    @mock.patch('flexes_build.server.async_app.job_events')
+    def test_job_events(self, mock_events):
+        async def events(*args, **kwargs):
+            yield {'event': 'status', 'job_id': 'abc', 'status': 'running'}
+            yield None
+            yield {'event': 'status', 'job_id': 'abc', 'status': 'complete'}
+        mock_events.side_effect = events
+        response, body = request('GET', '/jobs/abc/events')
+        assert(response.headers['Content-Type'].startswith('text/event-stream'))
+        assert(body.decode().split('\n\n')[:3] == [
+            'event: status\ndata: {"event": "status", "job_id": "abc", "status": "running"}',
+            ': keepalive',
+            'event: status\ndata: {"event": "status", "job_id": "abc", "status": "complete"}'])
+        assert(mock_events.call_args[1]['timeout'] == async_app.config['MAX_WAIT'])
+
+    @mock.patch('flexes_build.server.async_app.job_messages', new_callable=CoroutineMock, return_value=['a'])
+    def test_job_messages(self, mock_messages):
+        response, body = request('GET', '/jobs/abc/messages')
+        assert(json.loads(body) == {'job_id': 'abc', 'messages': ['a']})
+
+    @mock.patch('flexes_build.server.async_app.list_jobs', new_callable=CoroutineMock,
+                return_value={'jobs': [], 'next_cursor': None})
+    def test_jobs(self, mock_list):
+        response, body = request('GET', '/jobs?status=running,submitted&limit=10')
+        assert(json.loads(body) == {'jobs': [], 'next_cursor': None})
+        kwargs = mock_list.call_args[1]
+        assert(kwargs['status'] == ['running', 'submitted'])
+        assert(kwargs['limit'] == 10)
+        assert(kwargs['order'] == 'desc')
+        response, body = request('GET', '/jobs?order=sideways')
+        assert(response.status == 400)
+
+    @mock.patch('flexes_build.server.async_app.get_service_docs', new_callable=CoroutineMock,
+                return_value=({'name': 'popecon'}, '"abc"'))
+    def test_service_info(self, mock_docs):
+        response, body = request('GET', '/services/popecon')
+        assert(json.loads(body) == {'name': 'popecon'})
+        assert(response.headers['ETag'] == '"abc"')
+        response, body = request('GET', '/services/popecon', headers={'If-None-Match': '"abc"'})
+        assert(response.status == 304)
+
+    @mock.patch('flexes_build.server.async_app.get_service_docs', new_callable=CoroutineMock,
+                side_effect=botocore.exceptions.ClientError({'Error': {'Code': 404}}, 'test'))
+    def test_bad_service_info(self, mock_docs):
+        response, body = request('GET', '/services/foo')
+        assert(response.status == 404)
+
+    def test_dashboard(self):
+        response, body = request('GET', '/dashboard')
+        assert(b'/static/js/dashboard.js' in body)
+        assert(b'data-url="/jobs"' in body)
+
+    def test_metrics(self):
+        response, body = request('GET', '/metrics')
+        assert(response.headers['Content-Type'].startswith('text/plain'))
+        assert(b'flexes_job_cache_hit_ratio' in body)
+
+    def test_docs(self):
+        response, body = request('GET', '/docs/')
+        assert(response.status == 200)
+        assert(b'swagger.yml' in body)
+        response, body = request('GET', '/docs/../../etc/passwd')
+        assert(response.status == 404)
+
+
+class TestAsyncUtils:
+    def setup_method(self):
+        self.db = MagicMock()
+        self.pipe = self.db.pipeline.return_value
+        self.pipe.execute = CoroutineMock()
+
+    def test_submit_job(self):
+        message = {'service': 'test', 'command': {'arguments': []}}
+        job_id = asyncio.run(async_utils.submit_job(self.db, message))
+        assert(message['job_id'] == job_id)
+        self.pipe.lpush.assert_called_once()
+        assert(self.pipe.lpush.call_args[0][0] == 'docker')
+        self.pipe.execute.assert_called_once()
+
+    @mock.patch('flexes_build.server.utils.outputs_exist', return_value=True)
+    def test_submit_job_dedupe(self, mock_outputs):
+        pipe = MagicMock()
+        pipe.get = CoroutineMock(return_value=utils.dedupe_entry('earlier', time.time()))
+
+        async def transaction(func, *watches, **kwargs):
+            return await func(pipe)
+        self.db.transaction = transaction
+        self.db.hget = CoroutineMock(return_value='complete')
+        message = {'service': 'test', 'dedupe': 60, 'command': {'arguments': []}}
+        assert(asyncio.run(async_utils.submit_job(self.db, message)) == 'earlier')
+        mock_outputs.assert_called_once()
+        self.db.hget.return_value = 'failed'
+        job_id = asyncio.run(async_utils.submit_job(self.db, message))
+        assert(job_id == message['job_id'])
+        key, entry = pipe.set.call_args[0]
+        assert(key == async_utils.dedupe_key(message))
+        assert(async_utils.dedupe_candidate(entry, message) == job_id)
+        # An earlier job outside the message's own window is not reused
+        pipe.get.return_value = utils.dedupe_entry('earlier', time.time() - 61)
+        self.db.hget.return_value = 'complete'
+        assert(asyncio.run(async_utils.submit_job(self.db, message)) != 'earlier')
+        assert(mock_outputs.call_count == 1)
+
+    def test_query_job_status(self):
+        self.db.hget = CoroutineMock(return_value='running')
+        status = asyncio.run(async_utils.query_job_status(self.db, 'abc'))
+        assert(status == {'job_id': 'abc', 'status': 'running'})
+
+    @mock.patch('flexes_build.server.utils.archived_job', return_value={'job_id': 'abc', 'status': 'complete'})
+    def test_get_job_result_archived(self, mock_archived):
+        self.db.hgetall = CoroutineMock(return_value={})
+        result = asyncio.run(async_utils.get_job_result(self.db, 'abc'))
+        assert(result['status'] == 'complete')
+        mock_archived.assert_called_with('abc')
+
+    def test_batch_status(self):
+        self.db.smembers = CoroutineMock(return_value={'a', 'b'})
+        self.pipe.execute.return_value = ['complete', 'running']
+        status = asyncio.run(async_utils.batch_status(self.db, 'batch'))
+        assert(status['status'] == 'running')
+        assert(status['counts'] == {'complete': 1, 'running': 1})
+
+    def mock_pubsub(self, messages):
+        pubsub = self.db.pubsub.return_value
+        pubsub.subscribe = CoroutineMock()
+        pubsub.unsubscribe = CoroutineMock()
+        pubsub.close = CoroutineMock()
+
+        async def get_message(ignore_subscribe_messages, timeout):
+            await asyncio.sleep(0.05)
+            return messages.pop(0) if len(messages) > 0 else None
+        pubsub.get_message = get_message
+        return pubsub
+
+    def test_job_events(self):
+        event = {'event': 'status', 'job_id': 'abc', 'status': 'complete'}
+        pubsub = self.mock_pubsub([{'channel': 'events:abc', 'data': json.dumps(event)}])
+        self.db.hget = CoroutineMock(return_value='running')
+
+        async def collect():
+            events = async_utils.JobEvents(self.db)
+            try:
+                return [event async for event in async_utils.job_events(self.db, events, 'abc', keepalive=0.01)]
+            finally:
+                await events.close()
+        events = asyncio.run(collect())
+        assert(events[0] == {'event': 'status', 'job_id': 'abc', 'status': 'running'})
+        assert(None in events)
+        assert(events[-1] == event)
+        pubsub.subscribe.assert_called_once_with('events:abc')
+        pubsub.unsubscribe.assert_called_once_with('events:abc')
+        pubsub.close.assert_called_once()
+
+    def test_job_events_shared(self):
+        event = {'event': 'status', 'job_id': 'abc', 'status': 'complete'}
+        pubsub = self.mock_pubsub([{'channel': 'events:abc', 'data': json.dumps(event)}])
+        self.db.hget = CoroutineMock(return_value='running')
+
+        async def wait_twice():
+            events = async_utils.JobEvents(self.db)
+            try:
+                return await asyncio.gather(async_utils.wait_for_job(self.db, events, 'abc', 5),
+                                            async_utils.wait_for_job(self.db, events, 'abc', 5))
+            finally:
+                await events.close()
+        results = asyncio.run(wait_twice())
+        assert(results == [{'job_id': 'abc', 'status': 'complete'}] * 2)
+        # Both waiters share one subscription and one connection
+        pubsub.subscribe.assert_called_once_with('events:abc')
+        self.db.pubsub.assert_called_once()
+
+    def test_list_queues(self):
+        self.db.smembers = CoroutineMock(return_value={'docker', 'gpu'})
+        self.pipe.execute.return_value = [1, 2, 3, 4, 5]
+        page = asyncio.run(async_utils.list_queues(self.db, limit=1))
+        assert(page == {'queues': [{'name': 'docker', 'queued': 1, 'jobs': 2, 'running': 3,
+                                    'workers': 4, 'busy_workers': 5}],
+                        'next_cursor': 'docker'})
+
+    def test_list_jobs(self):
+        self.db.zrevrangebyscore = CoroutineMock(side_effect=[[('c', 3.0), ('b', 2.0)], []])
+        self.db.zrem = CoroutineMock()
+        self.pipe.execute.return_value = [['c', 'running', 'docker', 'test', '3.0'], [None] * 5]
+        page = asyncio.run(async_utils.list_jobs(self.db, limit=5))
+        assert([job['job_id'] for job in page['jobs']] == ['c'])
+        assert(page['next_cursor'] is None)
+        self.db.zrem.assert_called_once_with('jobs:index', 'b')
+
+    def test_list_workers(self):
+        self.db.smembers = CoroutineMock(return_value={'docker'})
+        self.db.srem = CoroutineMock()
+        self.pipe.execute.side_effect = [
+            [{'a', 'b'}, {'c'}],
+            [['idle', 'docker'] + [None] * 5, ['busy', 'docker'] + [None] * 5, [None] * 7]]
+        page = asyncio.run(async_utils.list_workers(self.db, status=['busy']))
+        assert(page == {'workers': [{'id': 'b', 'status': 'busy', 'queue': 'docker', 'worker_type': None,
+                                     'instance_type': None, 'concurrency': None, 'busy_slots': None,
+                                     'heartbeat': None}],
+                        'next_cursor': None})
+        self.db.srem.assert_called_once_with('workers:dead', 'c')
+
+    @mock.patch('flexes_build.server.utils.get_services', new_callable=CoroutineMock)
+    def test_list_services(self, mock_get_services):
+        utils.catalog.clear()
+        mock_get_services.return_value = [{'name': 'a', 'tags': ['latest', 'dev']}]
+        services = asyncio.run(async_utils.list_services(tags=['dev']))
+        assert(services == {'services': [{'name': 'a', 'tags': ['dev']}]})
+        assert(mock_get_services.call_args[0][0] is utils.catalog.responses)
+
+        async def stale():
+            utils.catalog.updated -= utils.catalog.ttl + 1
+            mock_get_services.return_value = [{'name': 'b', 'tags': ['latest']}]
+            # The stale catalog is served while it is refreshed on the loop
+            served = await async_utils.list_services()
+            await async_utils.refresh_catalog()
+            return served, await async_utils.list_services()
+        served, refreshed = asyncio.run(stale())
+        assert(served['services'][0]['name'] == 'a')
+        assert(refreshed['services'][0]['name'] == 'b')
+        assert(mock_get_services.call_count == 2)
+        utils.catalog.clear()
@@ -96,6 +96,78 @@ class TestDockerWorker:
         self.worker.client.images.pull.side_effect = ImageNotFound('image not found')
         assert(self.worker.image_exists('test') is False)
 
+    @mock.patch('shutil.rmtree')
+    @mock.patch('os.makedirs', return_value=None)
+    def test_launch_container_cached_image(self, mock_makedirs, mock_rmtree):
+        self.worker.localize_resource = mock.MagicMock(return_value='/path/to/resource.txt')
+        self.worker.persist_command = mock.MagicMock()
+        self.worker.image_cache.resolve = mock.MagicMock(return_value='sha256:local')
+        self.worker.client.containers.run.return_value.wait.return_value = {'Error': None, 'StatusCode': 0}
+        type(self.worker.client.containers.run.return_value).status = mock.PropertyMock(return_value='exited')
+        message = test_commands['basic_command']
+        self.worker.launch(message)
+        self.worker.launch(message)
+        self.worker.client.images.pull.assert_not_called()
+        self.worker.client.login.assert_not_called()
+        assert(self.worker.client.containers.run.call_args[0][0] == 'sha256:local')
+        self.worker.db.zincrby.assert_called_with('test:images', 1, 'hub.lanlytics.com/test:latest')
+
+    @mock.patch('shutil.rmtree')
+    @mock.patch('os.makedirs', return_value=None)
+    def test_launch_container_messages(self, mock_makedirs, mock_rmtree):
+        self.worker.localize_resource = mock.MagicMock(return_value='/path/to/resource.txt')
+        self.worker.persist_command = mock.MagicMock()
+        self.worker.update_job_messages = mock.MagicMock()
+        container = self.worker.client.containers.run.return_value
+        container.wait.return_value = {'Error': None, 'StatusCode': 0}
+        container.attach.return_value = iter([(None, b'step 1\nstep '), (b'out', None), (None, b'2\n')])
+        message = dict(test_commands['basic_command'], job_id='1234')
+        self.worker.launch(message)
+        container.attach.assert_called_once_with(stdout=True, stderr=True, stream=True, logs=True, demux=True)
+        container.logs.assert_not_called()
+        container.stats.assert_not_called()
+        container.reload.assert_not_called()
+        self.worker.update_job_messages.assert_called_with('1234', ['step 1', 'step 2'])
+
+    @mock.patch('shutil.rmtree')
+    @mock.patch('os.makedirs', return_value=None)
+    def test_launch_container_output_limit(self, mock_makedirs, mock_rmtree, tmp_path):
+        stderr_file = str(tmp_path / 'stderr.txt')
+        self.worker.config = dict(self.worker.config, OUTPUT_PIPE_LIMIT=4, OUTPUT_TAIL_BYTES=6)
+        self.worker.localize_resource = mock.MagicMock(return_value='/path/to/resource.txt')
+        self.worker.localize_output = mock.MagicMock(return_value=stderr_file)
+        container = self.worker.client.containers.run.return_value
+        container.wait.return_value = {'Error': None, 'StatusCode': 1}
+        container.attach.return_value = iter([(b'abc', None), (b'def', b'failed')])
+        message = test_commands['pipe_command']
+        status, result, stdout_data, stderr_data = self.worker.launch(message)
+        assert(status == config['STATUS_FAIL'])
+        assert(stdout_data.startswith('abcd\n[output truncated'))
+        assert(result == 'Job finished with exit code 1\nfailed')
+        assert(stderr_data == None)
+        assert(open(stderr_file, 'rb').read() == b'failed')
+
+    @mock.patch('shutil.rmtree')
+    @mock.patch('os.makedirs', return_value=None)
+    @mock.patch('builtins.open', new_callable=mock.mock_open())
+    def test_launch_container_stdin(self, mock_open, mock_makedirs, mock_rmtree):
+        self.worker.localize_resource = mock.MagicMock(return_value='/path/to/resource.txt')
+        self.worker.persist_command = mock.MagicMock()
+        self.worker.stream_stdin = mock.MagicMock()
+        container = self.worker.client.containers.run.return_value
+        container.wait.return_value = {'Error': None, 'StatusCode': 0}
+        socket = container.attach_socket.return_value
+        message = dict(test_commands['pipe_command'], job_id='1234')
+        self.worker.launch(message)
+        assert(container.attach_socket.called)
+        self.worker.stream_stdin.assert_called_once_with('some raw data', True, socket.fileno.return_value, '1234')
+        assert(socket.close.called)
+
+    def test_popular_images(self):
+        self.worker.db.zrevrange.return_value = ['hub.lanlytics.com/test:latest']
+        assert(self.worker.popular_images() == ['hub.lanlytics.com/test:latest'])
+        self.worker.db.zrevrange.assert_called_with('test:images', 0, config['IMAGE_PREPULL_COUNT'] - 1)
+
     def test_registry_auth(self):
         self.worker.config['AUTHENTICATE'] = {'REGISTRY_USERNAME': 'user', 'REGISTRY_PASSWORD': 'password'}
         self.worker.registry_login()
@@ -0,0 +1,112 @@
+import os, pytest, sys
+
+import docker
+import mock
+from flexes_build.worker.image_cache import ImageCache
+
+IMAGE = 'hub.lanlytics.com/test:latest'
+
+def local_image(image_id, digest, size=100):
+    image = mock.MagicMock()
+    image.id = image_id
+    image.attrs = {'RepoDigests': ['hub.lanlytics.com/test@{}'.format(digest)], 'Size': size}
+    return image
+
+class TestImageCache:
+    def setup_method(self, _):
+        self.client = mock.MagicMock()
+        self.cache = ImageCache(self.client, ttl=300)
+
+    def test_resolve_current(self):
+        self.client.images.get.return_value = local_image('sha256:local', 'sha256:abc')
+        self.client.images.get_registry_data.return_value.id = 'sha256:abc'
+        assert(self.cache.resolve(IMAGE) == 'sha256:local')
+        self.client.images.pull.assert_not_called()
+
+    def test_resolve_changed_digest(self):
+        self.client.images.get.return_value = local_image('sha256:old', 'sha256:abc')
+        self.client.images.get_registry_data.return_value.id = 'sha256:def'
+        self.client.images.pull.return_value = local_image('sha256:new', 'sha256:def')
+        assert(self.cache.resolve(IMAGE) == 'sha256:new')
+        self.client.images.pull.assert_called_once_with(IMAGE)
+
+    def test_resolve_missing(self):
+        self.client.images.get.side_effect = docker.errors.ImageNotFound('not found')
+        self.client.images.pull.return_value = local_image('sha256:new', 'sha256:def')
+        assert(self.cache.resolve(IMAGE) == 'sha256:new')
+        self.client.images.get_registry_data.assert_not_called()
+
+    def test_resolve_registry_unavailable(self):
+        self.client.images.get.return_value = local_image('sha256:local', 'sha256:abc')
+        self.client.images.get_registry_data.side_effect = docker.errors.APIError('unavailable')
+        assert(self.cache.resolve(IMAGE) == 'sha256:local')
+        self.client.images.pull.assert_not_called()
+
+    def test_resolve_ttl(self):
+        self.client.images.get.return_value = local_image('sha256:local', 'sha256:abc')
+        self.client.images.get_registry_data.return_value.id = 'sha256:abc'
+        self.cache.resolve(IMAGE)
+        self.cache.resolve(IMAGE)
+        self.client.images.get_registry_data.assert_called_once()
+        self.cache.ttl = 0
+        self.cache.resolve(IMAGE)
+        assert(self.client.images.get_registry_data.call_count == 2)
+
+    def test_pull_login(self):
+        login = mock.MagicMock()
+        cache = ImageCache(self.client, login=login)
+        self.client.images.pull.side_effect = [docker.errors.APIError('unauthorized'), 
+                                               local_image('sha256:new', 'sha256:def')]
+        assert(cache.pull(IMAGE).id == 'sha256:new')
+        login.assert_called_once()
+
+    def test_pull_not_found(self):
+        login = mock.MagicMock()
+        cache = ImageCache(self.client, login=login)
+        self.client.images.pull.side_effect = docker.errors.ImageNotFound('not found')
+        with pytest.raises(docker.errors.ImageNotFound):
+            cache.pull(IMAGE)
+        login.assert_not_called()
+
+    def test_prune(self):
+        self.cache.max_bytes = 250
+        self.client.images.get.side_effect = docker.errors.ImageNotFound('not found')
+        for name in ['a', 'b', 'c']:
+            self.client.images.pull.return_value = local_image('sha256:' + name, 'sha256:' + name)
+            self.cache.acquire(name)
+        self.cache.release('a')
+        self.cache.release('c')
+        # b is still in use so only a, the least recently used, is removed
+        self.client.images.remove.assert_called_once_with('sha256:a')
+        assert(self.cache.images() == ['c', 'b'])
+
+    def test_acquire_removed(self):
+        self.client.images.get.return_value = local_image('sha256:local', 'sha256:abc')
+        self.client.images.get_registry_data.return_value.id = 'sha256:abc'
+        assert(self.cache.acquire(IMAGE) == 'sha256:local')
+        self.cache.release(IMAGE)
+        # The image was removed outside the cache while its resolution is trusted
+        self.client.images.get.side_effect = docker.errors.ImageNotFound('not found')
+        self.client.images.pull.return_value = local_image('sha256:new', 'sha256:abc')
+        assert(self.cache.acquire(IMAGE) == 'sha256:new')
+        self.client.images.pull.assert_called_once_with(IMAGE)
+        assert(self.cache.in_use[IMAGE] == 1)
+
+    def test_acquire_protected_from_prune(self):
+        self.cache.max_bytes = 0
+        self.client.images.get.return_value = local_image('sha256:local', 'sha256:abc')
+        self.client.images.get_registry_data.return_value.id = 'sha256:abc'
+        # Prune runs between resolving the image and checking it exists
+        def get(name):
+            if name == 'sha256:local':
+                assert(self.cache.prune() == [])
+            return self.client.images.get.return_value
+        self.client.images.get.side_effect = get
+        assert(self.cache.acquire(IMAGE) == 'sha256:local')
+        self.client.images.remove.assert_not_called()
+        self.cache.release(IMAGE)
+        self.client.images.remove.assert_called_once_with('sha256:local')
+
+    def test_prune_no_budget(self):
+        assert(self.cache.prune() == [])
+        self.client.images.remove.assert_not_called()
@@ -0,0 +1,103 @@
+import os, pytest, sys
+
+import mock
+from flexes_build.worker import utils
+from flexes_build.worker.input_cache import InputCache
+
+def writer(data):
+    def download(path):
+        with open(path, 'w') as f:
+            f.write(data)
+    return mock.MagicMock(side_effect=download)
+
+class TestInputCache:
+    @pytest.fixture(autouse=True)
+    def setup_cache(self, tmp_path):
+        self.root = str(tmp_path / 'cache')
+        self.job_dir = tmp_path / 'job'
+        self.job_dir.mkdir()
+        self.cache = InputCache(self.root, 10)
+
+    def test_miss_then_hit(self):
+        download = writer('abcd')
+        local_file = str(self.job_dir / 'input.txt')
+        assert(self.cache.fetch('bucket', 'input.txt', '"etag"', 4, local_file, download) is False)
+        os.remove(local_file)
+        assert(self.cache.fetch('bucket', 'input.txt', '"etag"', 4, local_file, download) is True)
+        download.assert_called_once()
+        with open(local_file) as f:
+            assert(f.read() == 'abcd')
+        assert(self.cache.stats() == {'cache_hits': 1, 'cache_misses': 1, 
+                                      'cache_entries': 1, 'cache_bytes': 4})
+
+    def test_copy(self):
+        local_file = str(self.job_dir / 'input.txt')
+        self.cache.fetch('bucket', 'input.txt', '"etag"', 4, local_file, writer('abcd'))
+        path = self.cache.entry_path('bucket', 'input.txt', '"etag"')
+        assert(os.stat(path).st_ino != os.stat(local_file).st_ino)
+        # Jobs writing to their inputs leave the cached file untouched
+        with open(local_file, 'w') as f:
+            f.write('efgh')
+        with open(path) as f:
+            assert(f.read() == 'abcd')
+
+    def test_removed_from_outside(self):
+        download = writer('abcd')
+        local_file = str(self.job_dir / 'input.txt')
+        self.cache.fetch('bucket', 'input.txt', '"etag"', 4, local_file, download)
+        os.remove(self.cache.entry_path('bucket', 'input.txt', '"etag"'))
+        assert(self.cache.fetch('bucket', 'input.txt', '"etag"', 4, local_file, download) is False)
+        assert(download.call_count == 2)
+        with open(local_file) as f:
+            assert(f.read() == 'abcd')
+        assert(self.cache.stats() == {'cache_hits': 0, 'cache_misses': 2, 
+                                      'cache_entries': 1, 'cache_bytes': 4})
+
+    def test_changed_etag(self):
+        local_file = str(self.job_dir / 'input.txt')
+        self.cache.fetch('bucket', 'input.txt', '"v1"', 4, local_file, writer('abcd'))
+        download = writer('efgh')
+        assert(self.cache.fetch('bucket', 'input.txt', '"v2"', 4, local_file, download) is False)
+        with open(local_file) as f:
+            assert(f.read() == 'efgh')
+
+    def test_lru_eviction(self):
+        for name in ['a', 'b']:
+            self.cache.fetch('bucket', name, '"etag"', 4, str(self.job_dir / name), writer('1234'))
+        self.cache.fetch('bucket', 'a', '"etag"', 4, str(self.job_dir / 'a2'), writer('1234'))
+        self.cache.fetch('bucket', 'c', '"etag"', 4, str(self.job_dir / 'c'), writer('1234'))
+        assert(os.path.exists(self.cache.entry_path('bucket', 'a', '"etag"')))
+        assert(not os.path.exists(self.cache.entry_path('bucket', 'b', '"etag"')))
+        assert(self.cache.size == 8)
+        assert(os.path.exists(str(self.job_dir / 'b')))
+
+    def test_recent(self):
+        for name in ['a', 'b', 'c']:
+            self.cache.fetch('bucket', name, '"etag"', 3, str(self.job_dir / name), writer('123'))
+        self.cache.fetch('bucket', 'a', '"etag"', 3, str(self.job_dir / 'a2'), writer('123'))
+        self.cache.fetch('bucket', 'd', '"etag"', 3, str(self.job_dir / 'd'), writer('123'))
+        assert(self.cache.recent(2) == ['s3://bucket/d', 's3://bucket/a'])
+        assert(self.cache.recent(10) == ['s3://bucket/d', 's3://bucket/a', 's3://bucket/c'])
+
+    def test_too_large(self):
+        local_file = str(self.job_dir / 'big.txt')
+        assert(self.cache.fetch('bucket', 'big', '"etag"', 20, local_file, writer('x' * 20)) is False)
+        assert(os.path.exists(local_file))
+        assert(self.cache.stats()['cache_entries'] == 0)
+
+    def test_reload(self):
+        self.cache.fetch('bucket', 'a', '"etag"', 4, str(self.job_dir / 'a'), writer('1234'))
+        cache = InputCache(self.root, 10)
+        assert(cache.size == 4)
+        assert(cache.fetch('bucket', 'a', '"etag"', 4, str(self.job_dir / 'a'), writer('1234')) is True)
+
+    def test_get_s3_file_cached(self):
+        s3 = mock.MagicMock()
+        s3.get_paginator.return_value.paginate.return_value = [
+            {'Contents': [{'Key': 'path/to/file.txt', 'ETag': '"etag"', 'Size': 4}]}]
+        s3.download_file.side_effect = lambda bucket, key, path: writer('abcd')(path)
+        local_file = str(self.job_dir / 'file.txt')
+        utils.get_s3_file(s3, 's3://bucket/path/to/file.txt', local_file, cache=self.cache)
+        utils.get_s3_file(s3, 's3://bucket/path/to/file.txt', local_file, cache=self.cache)
+        s3.download_file.assert_called_once()
+        assert(self.cache.hits == 1)
@@ -1,24 +1,145 @@
 import os, pytest, sys
 
+import io
 import mock
+import time
 from flexes_build.worker.native_worker import NativeWorker
 from test_common import test_commands
 
 class TestNativeWorker:
+    @mock.patch('boto3.client')
     @mock.patch('flexes_build.worker.api_worker.StrictRedis')
     @mock.patch('boto3.resource')
-    def setup_method(self, _, mock_resource, mock_redis):
+    def setup_method(self, _, mock_resource, mock_redis, mock_client):
         self.message = {'job_id': '1234', 'service': 'worker'}
         self.worker = NativeWorker(queue='test', poll_frequency=1, cmd_prefix=['python', 'test.py'])
 
     @mock.patch('shutil.rmtree')
     @mock.patch('os.makedirs', return_value=None)
-    @mock.patch('subprocess.Popen', autospec=True)
+    @mock.patch('subprocess.Popen')
     def test_launch_native(self, mock_subprocess, mock_makedirs, mock_rmtree):
         self.worker.localize_resource = mock.MagicMock(return_value='/path/to/resource.txt')
         self.worker.persist_command = mock.MagicMock()
-        mock_subprocess.return_value.communicate.return_value = (b'test', b'test')
+        mock_subprocess.return_value.stdout = io.BytesIO(b'test')
+        mock_subprocess.return_value.stderr = io.BytesIO(b'test')
         mock_subprocess.return_value.returncode = 0
-        command = test_commands['basic_command']['command']
-        status, result, stdout_data, stderr_data = self.worker.launch(command)
+        message = test_commands['basic_command']
+        status, result, stdout_data, stderr_data = self.worker.launch(message)
         assert(mock_rmtree.called)
+
+    @mock.patch('shutil.rmtree')
+    def test_launch_native_stdin_pipe(self, mock_rmtree):
+        self.worker.cmd_prefix = [sys.executable, '-c', 'import sys; sys.stdout.write(sys.stdin.read().upper())']
+        self.worker.persist_command = mock.MagicMock()
+        message = {'service': 'test', 'job_id': '1234',
+                   'command': {'stdin': {'type': 'pipe', 'value': 'some raw data'}, 
+                               'stdout': {'type': 'pipe', 'value': None}, 'arguments': []}}
+        status, result, stdout_data, stderr_data = self.worker.launch(message)
+        assert(status == 'complete')
+        assert(stdout_data == 'SOME RAW DATA')
+        assert(stderr_data == None)
+
+    @mock.patch('shutil.rmtree')
+    def test_launch_native_stdin_file(self, mock_rmtree, tmp_path):
+        stdin_file = tmp_path / 'stdin.txt'
+        stdin_file.write_bytes(b'x' * 10000)
+        self.worker.config = dict(self.worker.config, STDIN_CHUNK_SIZE=1024)
+        self.worker.cmd_prefix = [sys.executable, '-c', 'import sys; print(len(sys.stdin.buffer.read()))']
+        self.worker.localize_resource = mock.MagicMock(return_value=str(stdin_file))
+        self.worker.persist_command = mock.MagicMock()
+        message = {'service': 'test', 'job_id': '1234',
+                   'command': {'stdin': {'type': 'uri', 'value': 's3://bucket/stdin.txt'}, 
+                               'stdout': {'type': 'pipe', 'value': None}, 'arguments': []}}
+        status, result, stdout_data, stderr_data = self.worker.launch(message)
+        assert(stdout_data.strip() == '10000')
+        job, stats = self.worker.db.hmset.call_args[0]
+        assert(job == 'job:1234')
+        assert(stats['stdin_bytes'] == 10000)
+
+    @mock.patch('shutil.rmtree')
+    def test_launch_native_messages(self, mock_rmtree):
+        self.worker.cmd_prefix = [sys.executable, '-c', 'import sys; [print(i, file=sys.stderr) for i in range(10)]']
+        self.worker.update_job_messages = mock.MagicMock()
+        self.worker.persist_command = mock.MagicMock()
+        message = {'service': 'test', 'job_id': '1234', 'command': {'arguments': []}}
+        status, result, stdout_data, stderr_data = self.worker.launch(message)
+        assert(status == 'complete')
+        self.worker.update_job_messages.assert_called_with('1234', ['5', '6', '7', '8', '9'])
+
+    @mock.patch('shutil.rmtree')
+    def test_launch_native_output_files(self, mock_rmtree, tmp_path):
+        stdout_file = str(tmp_path / 'stdout.txt')
+        self.worker.cmd_prefix = [sys.executable, '-c', 'print("x" * 100000)']
+        self.worker.localize_output = mock.MagicMock(return_value=stdout_file)
+        self.worker.persist_command = mock.MagicMock()
+        message = {'service': 'test', 'job_id': '1234', 
+                   'command': {'stdout': {'type': 'uri', 'value': 's3://bucket/stdout.txt'}, 'arguments': []}}
+        status, result, stdout_data, stderr_data = self.worker.launch(message)
+        assert(status == 'complete')
+        assert(stdout_data == None)
+        assert(os.path.getsize(stdout_file) == 100001)
+
+    @mock.patch('shutil.rmtree')
+    def test_launch_native_timeout(self, mock_rmtree):
+        self.worker.config = dict(self.worker.config, JOB_TIMEOUT=0.5)
+        self.worker.cmd_prefix = [sys.executable, '-c', 'import time; time.sleep(30)']
+        message = {'service': 'test', 'job_id': '1234', 'command': {'arguments': []}}
+        status, result, stdout_data, stderr_data = self.worker.launch(message)
+        assert(status == 'failed')
+        assert('Job exceeded time limit of 0.5 seconds' in result)
+
+    @mock.patch('shutil.rmtree')
+    def test_launch_native_output_limit(self, mock_rmtree):
+        self.worker.config = dict(self.worker.config, JOB_OUTPUT_LIMIT=1000)
+        self.worker.cmd_prefix = [sys.executable, '-c', 'import sys, time\nwhile True: sys.stdout.write("x" * 100); sys.stdout.flush(); time.sleep(0.001)']
+        message = {'service': 'test', 'job_id': '1234', 'command': {'arguments': []}}
+        status, result, stdout_data, stderr_data = self.worker.launch(message)
+        assert(status == 'failed')
+        assert('Job exceeded output limit of 1000 bytes' in result)
+
+    @mock.patch('shutil.rmtree')
+    def test_launch_native_timeout_kills_children(self, mock_rmtree):
+        self.worker.config = dict(self.worker.config, JOB_TIMEOUT=0.5)
+        child = 'import time; time.sleep(30)'
+        self.worker.cmd_prefix = [sys.executable, '-c', 
+                                  'import subprocess, sys, time; subprocess.Popen([sys.executable, "-c", {!r}]); time.sleep(30)'.format(child)]
+        message = {'service': 'test', 'job_id': '1234', 'command': {'arguments': []}}
+        start = time.monotonic()
+        status, result, stdout_data, stderr_data = self.worker.launch(message)
+        assert(time.monotonic() - start < 10)
+        assert(status == 'failed')
+        assert('Job exceeded time limit of 0.5 seconds' in result)
+
+    @mock.patch('shutil.rmtree')
+    def test_launch_native_background_process(self, mock_rmtree):
+        self.worker.config = dict(self.worker.config, OUTPUT_DRAIN_TIMEOUT=0.5)
+        child = 'import time; time.sleep(30)'
+        self.worker.cmd_prefix = [sys.executable, '-c', 
+                                  'import subprocess, sys; subprocess.Popen([sys.executable, "-c", {!r}]); print("done")'.format(child)]
+        self.worker.persist_command = mock.MagicMock()
+        message = {'service': 'test', 'job_id': '1234', 
+                   'command': {'stdout': {'type': 'pipe', 'value': None}, 'arguments': []}}
+        start = time.monotonic()
+        status, result, stdout_data, stderr_data = self.worker.launch(message)
+        assert(time.monotonic() - start < 10)
+        assert(status == 'complete')
+        assert(stdout_data.strip() == 'done')
+
+    @mock.patch('subprocess.Popen', side_effect=FileNotFoundError)
+    def test_launch_native_popen_error(self, mock_popen, tmp_path):
+        stdin_file = tmp_path / 'stdin.txt'
+        stdin_file.write_bytes(b'data')
+        self.worker.localize_resource = mock.MagicMock(return_value=str(stdin_file))
+        message = {'service': 'test', 'job_id': '1234',
+                   'command': {'stdin': {'type': 'uri', 'value': 's3://bucket/stdin.txt'}, 'arguments': []}}
+        pipes = []
+        os_pipe = os.pipe
+        def pipe():
+            pipes.extend(os_pipe())
+            return tuple(pipes)
+        with mock.patch('os.pipe', side_effect=pipe):
+            with pytest.raises(FileNotFoundError):
+                self.worker.launch(message)
+        for fd in pipes:
+            with pytest.raises(OSError):
+                os.fstat(fd)
@@ -0,0 +1,83 @@
+import os, pytest, sys
+
+import json
+import mock
+import time
+from flexes_build import scheduler
+from flexes_build.config import load_config
+from flexes_build.worker.reaper import Reaper
+
+config = load_config()
+
+class TestReaper:
+    @mock.patch('flexes_build.worker.reaper.StrictRedis')
+    def setup_method(self, _, mock_redis):
+        self.reaper = Reaper(queue='test')
+        self.pipe = mock.MagicMock()
+        self.reaper.db.transaction.side_effect = lambda func, *watches, **kwargs: func(self.pipe)
+
+    def test_is_dead_status(self):
+        self.reaper.db.hmget.return_value = ['dead', str(time.time())]
+        assert(self.reaper.is_dead('worker1'))
+
+    def test_is_dead_expired(self):
+        self.reaper.db.hmget.return_value = [None, None]
+        assert(self.reaper.is_dead('worker1'))
+
+    def test_is_dead_stale_heartbeat(self):
+        heartbeat = time.time() - config['WORKER_TIMEOUT'] - 1
+        self.reaper.db.hmget.return_value = ['busy', str(heartbeat)]
+        assert(self.reaper.is_dead('worker1'))
+
+    def test_is_alive(self):
+        self.reaper.db.hmget.return_value = ['busy', str(time.time())]
+        assert(self.reaper.is_dead('worker1') is False)
+
+    def test_requeue_message(self):
+        self.pipe.lindex.return_value = '{"job_id": "job1"}'
+        job_id = self.reaper.requeue_message('test:processing:worker1')
+        assert(job_id == 'job1')
+        self.pipe.rpop.assert_called_with('test:processing:worker1')
+        self.pipe.rpush.assert_called_with('test', json.dumps({'job_id': 'job1', 'retries': 1}))
+        self.pipe.srem.assert_called_with('test:jobs:running', 'job1')
+        self.pipe.lpush.assert_not_called()
+
+    def test_requeue_message_dead_letter(self):
+        message = {'job_id': 'job1', 'retries': config['MAX_RETRIES']}
+        self.pipe.lindex.return_value = json.dumps(message)
+        job_id = self.reaper.requeue_message('test:processing:worker1')
+        assert(job_id == 'job1')
+        self.pipe.rpush.assert_not_called()
+        args = self.pipe.lpush.call_args[0]
+        assert(args[0] == 'test:deadletter')
+        assert(json.loads(args[1])['retries'] == config['MAX_RETRIES'] + 1)
+        self.pipe.hmset.assert_called_with('job:job1', {'status': config['STATUS_FAIL'],
+                                                        'result': 'Job abandoned by worker too many times'})
+
+    def test_requeue_message_token(self):
+        self.pipe.lindex.return_value = scheduler.TOKEN
+        assert(self.reaper.requeue_message('test:processing:worker1') == scheduler.TOKEN)
+        self.pipe.rpush.assert_called_with('test', scheduler.TOKEN)
+        self.pipe.hmset.assert_not_called()
+
+    def test_requeue_message_empty(self):
+        self.pipe.lindex.return_value = None
+        assert(self.reaper.requeue_message('test:processing:worker1') is None)
+        self.pipe.multi.assert_not_called()
+
+    def test_reap(self):
+        self.reaper.db.smembers.return_value = {'worker1'}
+        self.reaper.db.hmget.return_value = [None, None]
+        self.pipe.lindex.side_effect = ['{"job_id": "job1"}', '{"job_id": "job2"}', None]
+        jobs = self.reaper.reap()
+        assert(jobs == ['job1', 'job2'])
+        self.reaper.db.smembers.assert_called_with('workers:dead')
+        self.pipe.rpop.assert_called_with('test:processing:worker1')
+        self.reaper.db.scan_iter.assert_not_called()
+
+    def test_reap_live_worker(self):
+        self.reaper.db.smembers.return_value = {'worker1'}
+        self.reaper.db.hmget.return_value = ['busy', str(time.time())]
+        assert(self.reaper.reap() == [])
+        self.reaper.db.transaction.assert_not_called()
+        self.reaper.db.pipeline.assert_not_called()
@@ -0,0 +1,187 @@
+import os, pytest, sys
+
+import fakeredis
+import json
+import mock
+import time
+from flexes_build import scheduler
+
+class TestScheduler:
+    def setup_method(self, _):
+        self.db = mock.MagicMock()
+        self.pipe = mock.MagicMock()
+        self.db.transaction.side_effect = lambda func, *watches, **kwargs: func(self.pipe)
+
+    def test_schedule(self):
+        messages = [{'job_id': 'a'}, {'job_id': 'b', 'tenant': 'alice', 'priority': 2}]
+        scheduler.schedule(self.pipe, 'docker', messages, 100.0)
+        self.pipe.zadd.assert_any_call('docker:tenant:default', {json.dumps(messages[0]): 100.0})
+        self.pipe.zadd.assert_any_call('docker:tenant:alice', {json.dumps(messages[1]): 100.0 + scheduler.SEQUENCE_STEP - 2 * scheduler.PRIORITY_SPAN})
+        self.pipe.zadd.assert_any_call('docker:tenants', {'alice': 0}, nx=True)
+        self.pipe.lpush.assert_called_with('docker', scheduler.TOKEN, scheduler.TOKEN)
+
+    def test_batch_order(self):
+        db = fakeredis.FakeStrictRedis(decode_responses=True)
+        messages = [{'job_id': 'alice{}'.format(i), 'priority': 9} for i in range(12)]
+        pipe = db.pipeline()
+        scheduler.schedule(pipe, 'docker', messages, time.time())
+        pipe.execute()
+        dispatched = [json.loads(scheduler.dispatch(db, 'docker'))['job_id'] for _ in messages]
+        assert(dispatched == [message['job_id'] for message in messages])
+
+    def test_next_tenant(self):
+        assert(scheduler.next_tenant([('a', 3.0), ('b', 2.0)], 2.0) == ('b', 2.0))
+        # Idle tenants join at the current pass instead of their old one
+        assert(scheduler.next_tenant([('a', 3.0), ('b', 0.0)], 2.5) == ('b', 2.5))
+
+    @mock.patch.dict(scheduler.config, {'TENANT_WEIGHTS': {'bob': 3}})
+    def test_stride(self):
+        passes = {'alice': 0.0, 'bob': 0.0}
+        current = 0.0
+        picks = []
+        for _ in range(8):
+            tenant, current = scheduler.next_tenant(passes.items(), current)
+            passes[tenant] = current + 1 / scheduler.weight(tenant)
+            picks.append(tenant)
+        assert(picks.count('bob') == 6)
+
+    def test_dispatch(self):
+        self.pipe.zrange.side_effect = [[('alice', 1.0), ('bob', 2.0)], [('{"job_id": "a"}', 100.0)]]
+        self.pipe.get.return_value = '1.0'
+        self.pipe.zcard.return_value = 2
+        raw = scheduler.dispatch(self.db, 'docker', 'docker:processing:worker1')
+        assert(raw == '{"job_id": "a"}')
+        self.pipe.watch.assert_called_with('docker:tenant:alice')
+        self.pipe.zrem.assert_called_with('docker:tenant:alice', raw)
+        self.pipe.zadd.assert_called_with('docker:tenants', {'alice': 2.0})
+        self.pipe.set.assert_called_with('docker:pass', 1.0)
+        self.pipe.lrem.assert_called_with('docker:processing:worker1', 1, scheduler.TOKEN)
+        self.pipe.lpush.assert_called_with('docker:processing:worker1', raw)
+
+    def test_dispatch_last_job(self):
+        self.pipe.zrange.side_effect = [[('alice', 1.0)], [('{"job_id": "a"}', 100.0)]]
+        self.pipe.get.return_value = None
+        self.pipe.zcard.return_value = 1
+        scheduler.dispatch(self.db, 'docker')
+        self.pipe.zrem.assert_called_with('docker:tenants', 'alice')
+        self.pipe.lpush.assert_not_called()
+
+    def test_dispatch_empty(self):
+        self.pipe.zrange.return_value = []
+        assert(scheduler.dispatch(self.db, 'docker') is None)
+
+    def test_dispatch_stale_tenant(self):
+        self.pipe.zrange.side_effect = [[('alice', 1.0)], [], []]
+        self.pipe.get.return_value = None
+        self.pipe.zcard.return_value = 0
+        assert(scheduler.dispatch(self.db, 'docker') is None)
+        self.pipe.zrem.assert_called_with('docker:tenants', 'alice')
+
+    def job(self, job_id, service, priority=0, inputs=(), submitted_at=100.0):
+        message = {'job_id': job_id, 'service': service, 'priority': priority,
+                   'command': {'arguments': [{'type': 'input', 'value': uri} for uri in inputs]}}
+        return json.dumps(message), submitted_at - priority * scheduler.PRIORITY_SPAN
+
+    def test_image(self):
+        assert(scheduler.image({'service': 'popecon'}).endswith('/popecon:latest'))
+        assert(scheduler.image({'service': 'popecon', 'tag': 'v2'}).endswith('/popecon:v2'))
+
+    def test_inputs(self):
+        command = {'input': ['s3://bucket/a', 'local'],
+                   'arguments': [{'type': 'input', 'value': 's3://bucket/b'},
+                                 {'type': 'parameter', 'value': 's3://bucket/c'}],
+                   'stdin': {'type': 'uri', 'value': 's3://bucket/d'}}
+        assert(scheduler.inputs({'command': command}) == {'s3://bucket/a', 's3://bucket/b', 's3://bucket/d'})
+
+    def test_inputs_test_message(self):
+        assert(scheduler.inputs({'service': 'popecon', 'test': True}) == set())
+
+    def test_pick_test_message(self):
+        jobs = [(json.dumps({'job_id': 'a', 'service': 'popecon', 'test': True}), 100.0)]
+        assert(scheduler.pick(jobs, set(), {'s3://b/x'}, set, 101.0) == jobs[0][0])
+
+    def test_pick_warm(self):
+        jobs = [self.job('a', 'popecon'), self.job('b', 'damage')]
+        images = {scheduler.image({'service': 'damage'})}
+        assert(scheduler.pick(jobs, images, set(), set, 101.0) == jobs[1][0])
+
+    def test_pick_held_for_warm_worker(self):
+        jobs = [self.job('a', 'popecon')]
+        elsewhere = {scheduler.image({'service': 'popecon'})}
+        assert(scheduler.pick(jobs, set(), set(), lambda: elsewhere, 101.0) is None)
+        # After waiting long enough any worker takes it
+        now = 100.0 + scheduler.config['AFFINITY_DELAY']
+        assert(scheduler.pick(jobs, set(), set(), lambda: elsewhere, now) == jobs[0][0])
+
+    def test_pick_cold(self):
+        # Jobs no idle worker has the image for go to the first worker that asks
+        jobs = [self.job('a', 'popecon'), self.job('b', 'damage')]
+        assert(scheduler.pick(jobs, set(), set(), set, 101.0) == jobs[0][0])
+
+    def test_pick_inputs(self):
+        jobs = [self.job('a', 'popecon', inputs=['s3://b/x']), self.job('b', 'popecon', inputs=['s3://b/y'])]
+        assert(scheduler.pick(jobs, set(), {'s3://b/y'}, set, 101.0) == jobs[1][0])
+
+    def test_pick_keeps_priority(self):
+        jobs = [self.job('a', 'popecon', priority=5), self.job('b', 'damage')]
+        images = {scheduler.image({'service': 'damage'})}
+        assert(scheduler.pick(jobs, images, set(), set, 101.0) == jobs[0][0])
+
+    def test_warm_elsewhere(self):
+        now = time.time()
+        self.db.smembers.return_value = {'worker1', 'worker2', 'worker3', 'worker4'}
+        self.db.pipeline.return_value.execute.return_value = [
+            ['idle', str(now), '["a"]'], ['busy', str(now), '["b"]'], ['idle', str(now - 3600), '["c"]']]
+        assert(scheduler.warm_elsewhere(self.db, 'docker', 'worker4', now) == {'a'})
+        assert(self.db.pipeline.return_value.hmget.call_count == 3)
+
+    @mock.patch('flexes_build.scheduler.warm_elsewhere', return_value={'hub/popecon:latest'})
+    @mock.patch.dict(scheduler.config, {'DOCKER_REGISTRY': 'hub'})
+    def test_dispatch_affinity_declined(self, mock_elsewhere):
+        self.pipe.zrange.side_effect = [[('alice', 1.0)], [self.job('a', 'popecon', submitted_at=time.time())]]
+        self.pipe.get.return_value = None
+        self.pipe.zcard.return_value = 1
+        raw = scheduler.dispatch(self.db, 'docker', 'docker:processing:worker1', worker='worker1', token=True)
+        assert(raw is None)
+        self.pipe.zrange.assert_called_with('docker:tenant:alice', 0, scheduler.config['AFFINITY_SCAN'] - 1, withscores=True)
+        self.pipe.zrem.assert_not_called()
+        self.pipe.lrem.assert_called_with('docker:processing:worker1', 1, scheduler.TOKEN)
+        self.pipe.lpush.assert_called_with('docker', scheduler.TOKEN)
+
+    @mock.patch('flexes_build.scheduler.warm_elsewhere', return_value={'hub/popecon:latest'})
+    @mock.patch.dict(scheduler.config, {'DOCKER_REGISTRY': 'hub'})
+    def test_dispatch_affinity_warm(self, mock_elsewhere):
+        jobs = [self.job('a', 'damage', submitted_at=time.time()), self.job('b', 'popecon')]
+        self.pipe.zrange.side_effect = [[('alice', 1.0)], jobs]
+        self.pipe.get.return_value = None
+        self.pipe.zcard.return_value = 2
+        raw = scheduler.dispatch(self.db, 'docker', worker='worker1', images=['hub/popecon:latest'])
+        assert(raw == jobs[1][0])
+        self.pipe.zrem.assert_called_with('docker:tenant:alice', raw)
+
+    @mock.patch('flexes_build.scheduler.warm_elsewhere')
+    @mock.patch.dict(scheduler.config, {'DOCKER_REGISTRY': 'hub'})
+    def test_dispatch_affinity_all_warm(self, mock_elsewhere):
+        jobs = [self.job('a', 'popecon', submitted_at=time.time())]
+        self.pipe.zrange.side_effect = [[('alice', 1.0)], jobs]
+        self.pipe.get.return_value = None
+        self.pipe.zcard.return_value = 1
+        assert(scheduler.dispatch(self.db, 'docker', worker='worker1', images=['hub/popecon:latest']) == jobs[0][0])
+        # The job's image is warm here, so the other workers are not read
+        mock_elsewhere.assert_not_called()
+
+    @mock.patch('flexes_build.scheduler.warm_elsewhere')
+    def test_dispatch_affinity_empty(self, mock_elsewhere):
+        self.pipe.zrange.return_value = []
+        assert(scheduler.dispatch(self.db, 'docker', worker='worker1', token=True) is None)
+        mock_elsewhere.assert_not_called()
+
+    def test_tenant_stats(self):
+        now = time.time()
+        self.db.zrange.return_value = [('alice', 1.0)]
+        head = json.dumps({'job_id': 'a', 'priority': 1})
+        self.db.pipeline.return_value.execute.return_value = [3, [(head, now - 10 - scheduler.PRIORITY_SPAN)]]
+        stats = scheduler.tenant_stats(self.db, 'docker')
+        assert(stats[0]['tenant'] == 'alice')
+        assert(stats[0]['queued'] == 3)
+        assert(9 < stats[0]['wait'] < 11)
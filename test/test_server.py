@@ -1,12 +1,22 @@
 import os, pytest, sys
 
+import asyncio
+import boto3
 import botocore
+import fakeredis
 import json
 import mock
+import time
 from asynctest import CoroutineMock
 from flask import url_for, jsonify
-from flexes_build.config import load_message_schema
+from flexes_build.config import load_message_schema, load_message_validator
 from flexes_build.server import app, utils
+from moto import mock_aws
+from yarl import URL
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
 
 def mock_download_fileobj(key, data):
     data.write(b'{"foo": "bar"}')
@@ -85,24 +95,139 @@ class TestEndpoints:
         resp = self.client.post(service_url, data=data, content_type='application/json')
         assert(resp.json == expected)
 
-    @mock.patch('boto3.resource')
-    @mock.patch('flexes_build.server.app.stream_from_s3', return_value={})
-    def test_service_info(self, mock_stream, mock_resource):
+    @mock.patch('flexes_build.server.app.submit_jobs', return_value=('batch_id', ['a', 'b']))
+    def test_batch_post(self, mock_submit):
+        messages = [{'service': 'test', 'command': {'arguments': []}}, 
+                    {'service': 'test', 'queue': 'other', 'command': {'arguments': []}}]
+        resp = self.client.post(url_for('submit_batch'), data=json.dumps(messages), content_type='application/json')
+        assert(resp.status_code == 202)
+        assert(resp.json['batch_id'] == 'batch_id')
+        assert(resp.json['job_ids'] == ['a', 'b'])
+        assert(resp.headers['Location'].endswith('/jobs/batch/batch_id'))
+        assert(mock_submit.call_args[0][1] == messages)
+
+    @mock.patch.dict('flexes_build.server.utils.config', {'TENANT_HEADER': 'X-Tenant'})
+    @mock.patch('flexes_build.server.app.submit_jobs', return_value=('batch_id', ['a', 'b']))
+    def test_batch_post_tenant_header(self, mock_submit):
+        messages = [{'service': 'test', 'tenant': 'alice', 'command': {'arguments': []}},
+                    {'service': 'test', 'command': {'arguments': []}}]
+        resp = self.client.post(url_for('submit_batch'), data=json.dumps(messages), 
+                                content_type='application/json', headers={'X-Tenant': 'bob'})
+        assert(resp.status_code == 202)
+        assert([message['tenant'] for message in mock_submit.call_args[0][1]] == ['bob', 'bob'])
+
+        self.client.post(url_for('submit_batch'), data=json.dumps(messages), content_type='application/json')
+        assert([message['tenant'] for message in mock_submit.call_args[0][1]] == ['default', 'default'])
+
+    @mock.patch('flexes_build.server.app.submit_jobs')
+    def test_batch_post_invalid(self, mock_submit):
+        messages = [{'service': 'test', 'command': {'arguments': []}}, {'foo': 'bar'}]
+        resp = self.client.post(url_for('submit_batch'), data=json.dumps(messages), content_type='application/json')
+        assert(resp.status_code == 400)
+        assert(resp.json['invalid'] == [1])
+        assert(not mock_submit.called)
+
+    def test_batch_post_empty(self):
+        resp = self.client.post(url_for('submit_batch'), data=json.dumps([]), content_type='application/json')
+        assert(resp.status_code == 400)
+
+    @mock.patch('flexes_build.server.app.batch_status', return_value={'batch_id': 'batch_id', 'status': 'running'})
+    def test_batch_status(self, mock_status):
+        resp = self.client.get(url_for('query_batch', batch_id='batch_id'))
+        assert(resp.json['status'] == 'running')
+
+    @mock.patch('flexes_build.server.app.batch_status', return_value=None)
+    def test_batch_status_missing(self, mock_status):
+        assert(self.client.get(url_for('query_batch', batch_id='foo')).status_code == 404)
+
+    @mock.patch('flexes_build.server.app.get_service_docs', return_value=({'name': 'popecon'}, '"abc"'))
+    def test_service_info(self, mock_docs):
         service_url = url_for('service_info', service_name='popecon')
-        assert(self.client.get(service_url).status_code == 200)
+        resp = self.client.get(service_url)
+        assert(resp.json == {'name': 'popecon'})
+        assert(resp.headers['ETag'] == '"abc"')
+        assert('max-age' in resp.headers['Cache-Control'])
+        mock_docs.assert_called_with('popecon', 'latest')
+        resp = self.client.get(service_url, headers={'If-None-Match': '"abc"'})
+        assert(resp.status_code == 304)
 
-    @mock.patch('boto3.resource')
-    @mock.patch('flexes_build.server.app.stream_from_s3', side_effect=botocore.exceptions.ClientError({'Error': {'Code': 404}}, 'test'))
-    def test_bad_service_info(self, mock_stream, mock_resource):
+    @mock.patch('flexes_build.server.app.get_service_docs', side_effect=botocore.exceptions.ClientError({'Error': {'Code': 404}}, 'test'))
+    def test_bad_service_info(self, mock_docs):
         service_url = url_for('service_info', service_name='foo')
         assert(self.client.get(service_url).status_code == 404)
 
-    @mock.patch('flexes_build.server.app.all_running_jobs', return_value=[{'job_id':i,'status':'running'} for i in range(4)])
-    @mock.patch('flexes_build.server.app.all_queues', return_value=[{'queue':i,'jobs':i} for i in range(4)])
-    @mock.patch('flexes_build.server.app.all_workers', return_value=[{'id':i,'queue':'foo'} for i in range(4)])
-    def test_dashboard(self, mock_all_workers, mock_all_queues, mock_all_running_jobs):
-        service_url = url_for('dashboard')
-        assert(self.client.get(service_url).status_code == 200)
+    @mock.patch('flexes_build.scheduler.tenant_stats', return_value=[{'tenant': 'alice', 'queued': 3}])
+    def test_queue_tenants(self, mock_stats):
+        resp = self.client.get(url_for('queue_tenants', queue='docker'))
+        assert(resp.json == {'queue': 'docker', 'tenants': [{'tenant': 'alice', 'queued': 3}]})
+
+    def test_metrics(self):
+        resp = self.client.get(url_for('server_metrics'))
+        assert(resp.mimetype == 'text/plain')
+        assert(b'flexes_job_cache_hit_ratio' in resp.data)
+
+    def test_dashboard(self):
+        resp = self.client.get(url_for('dashboard'))
+        assert(resp.status_code == 200)
+        assert(b'js/dashboard.js' in resp.data)
+
+    @mock.patch('flexes_build.server.app.query_job_status', return_value={'job_id': 'abc', 'status': 'running'})
+    def test_job_status(self, mock_status):
+        resp = self.client.get(url_for('query_job', job_id='abc'))
+        assert(resp.json == {'job_id': 'abc', 'status': 'running'})
+
+    @mock.patch('flexes_build.server.app.wait_for_job', return_value={'job_id': 'abc', 'status': 'complete'})
+    def test_job_status_wait(self, mock_wait):
+        resp = self.client.get(url_for('query_job', job_id='abc', wait=600))
+        assert(resp.json['status'] == 'complete')
+        mock_wait.assert_called_with(mock.ANY, 'abc', 60)
+        assert(self.client.get(url_for('query_job', job_id='abc', wait='soon')).status_code == 400)
+
+    @mock.patch('flexes_build.server.app.job_messages', return_value=['a', 'b'])
+    def test_job_messages(self, mock_messages):
+        resp = self.client.get(url_for('get_job_messages', job_id='abc'))
+        assert(resp.json == {'job_id': 'abc', 'messages': ['a', 'b']})
+
+    @mock.patch('flexes_build.server.app.job_events')
+    def test_job_events(self, mock_events):
+        mock_events.return_value = iter([{'event': 'status', 'job_id': 'abc', 'status': 'running'}, None, 
+                                         {'event': 'status', 'job_id': 'abc', 'status': 'complete'}])
+        resp = self.client.get(url_for('job_event_stream', job_id='abc'))
+        assert(resp.mimetype == 'text/event-stream')
+        assert(resp.headers['Cache-Control'] == 'no-cache')
+        events = resp.get_data(as_text=True).split('\n\n')
+        assert(events[0] == 'event: status\ndata: {"event": "status", "job_id": "abc", "status": "running"}')
+        assert(events[1] == ': keepalive')
+        assert('complete' in events[2])
+        # Streams are closed after MAX_WAIT so they do not hold a server thread indefinitely
+        mock_events.assert_called_with(mock.ANY, 'abc', timeout=app.config['MAX_WAIT'], 
+                                       keepalive=app.config['EVENTS_KEEPALIVE'])
+
+    @mock.patch('flexes_build.server.app.list_jobs', return_value={'jobs': [], 'next_cursor': None})
+    def test_jobs(self, mock_list_jobs):
+        resp = self.client.get(url_for('jobs', status='running,submitted', queue='docker', 
+                                       since='10', limit=5, cursor='1.5:abc'))
+        assert(resp.status_code == 200)
+        assert(resp.json == {'jobs': [], 'next_cursor': None})
+        mock_list_jobs.assert_called_with(mock.ANY, status=['running', 'submitted'], queue=['docker'], 
+                                          since=10.0, until=None, order='desc', limit=5, cursor='1.5:abc')
+
+    @pytest.mark.parametrize('args', [{'limit': 0}, {'limit': 100000}, {'order': 'up'}, {'since': 'yesterday'}])
+    def test_jobs_bad_args(self, args):
+        resp = self.client.get(url_for('jobs', **args))
+        assert(resp.status_code == 400)
+        assert(resp.json['status'] == 'error')
+
+    @mock.patch('flexes_build.server.app.list_queues', return_value={'queues': [], 'next_cursor': None})
+    def test_queues(self, mock_list_queues):
+        assert(self.client.get(url_for('queues', order='desc')).status_code == 200)
+        mock_list_queues.assert_called_with(mock.ANY, order='desc', limit=100, cursor=None)
+
+    @mock.patch('flexes_build.server.app.list_workers', return_value={'workers': [], 'next_cursor': None})
+    def test_workers(self, mock_list_workers):
+        assert(self.client.get(url_for('workers', worker_type='DockerWorker')).status_code == 200)
+        mock_list_workers.assert_called_with(mock.ANY, status=None, queue=None, worker_type=['DockerWorker'], 
+                                             order='asc', limit=100, cursor=None)
 
     @mock.patch('flexes_build.server.app.list_services')
     def test_services(self, mock_list_services):
@@ -114,6 +239,9 @@ class TestEndpoints:
 class TestUtils:
     def setup_method(self):
         self.db = mock.MagicMock()
+        utils.catalog.clear()
+        utils.job_cache.clear()
+        utils.dynamodb_client = None
 
     @mock.patch('flexes_build.server.utils.uuid4', return_value='test_job')
     def test_submit_job(self, mock_uuid):
@@ -121,59 +249,255 @@ class TestUtils:
         job_id = utils.submit_job(self.db, message)
         assert(job_id == 'test_job')
 
+    def test_job_entry(self):
+        entry = utils.job_entry({'service': 'test', 'test': True, 'priority': 2, 'tag': None,
+                                 'command': {'arguments': []}})
+        assert(entry == {'service': 'test', 'test': 'true', 'priority': 2, 'command': '{"arguments":[]}'})
+
+    def test_submit_trims_index(self):
+        db = fakeredis.FakeStrictRedis(decode_responses=True)
+        db.zadd(utils.config['JOBS_INDEX'], {'old': time.time() - utils.config['JOBS_INDEX_RETENTION'] - 1,
+                                             'recent': time.time() - 60})
+        job_id = utils.submit_job(db, {'service': 'test', 'command': {'arguments': []}})
+        assert(db.zrange(utils.config['JOBS_INDEX'], 0, -1) == ['recent', job_id])
+        assert(db.zrange(utils.queue_index('docker'), 0, -1) == [job_id])
+
+    def test_submit_test_message(self):
+        db = fakeredis.FakeStrictRedis(decode_responses=True)
+        job_id = utils.submit_job(db, {'service': 'test', 'test': True})
+        assert(db.hget('job:' + job_id, 'test') == 'true')
+        assert(db.hget('job:' + job_id, 'status') == 'submitted')
+
+    def test_submit_jobs(self):
+        messages = [{'service': 'test', 'command': {'arguments': []}} for _ in range(3)]
+        messages[1]['queue'] = 'other'
+        batch_id, job_ids = utils.submit_jobs(self.db, messages)
+        assert(len(job_ids) == 3)
+        assert(all(message['batch_id'] == batch_id for message in messages))
+        pipe = self.db.pipeline.return_value
+        assert(pipe.execute.call_count == 2)
+        assert(pipe.hmset.call_count == 3)
+        pipe.lpush.assert_any_call('other', mock.ANY)
+        pipe.sadd.assert_any_call('batch:' + batch_id, job_ids[0], job_ids[2])
+        assert(isinstance(pipe.hmset.call_args[0][1]['command'], str))
+
+    @mock.patch('boto3.client')
+    def test_batch_status(self, mock_client):
+        self.db.smembers.return_value = {'a', 'b', 'c', 'd'}
+        self.db.pipeline.return_value.execute.return_value = ['complete', 'running', None, None]
+        utils.job_cache.put('d', {'job_id': 'd', 'status': 'complete'})
+        mock_client.return_value.batch_get_item.return_value = {
+            'Responses': {'jobs': [{'job_id': {'S': 'c'}, 'status': {'S': 'failed'}}]}}
+        status = utils.batch_status(self.db, 'batch')
+        assert(status['total'] == 4)
+        assert(status['counts'] == {'complete': 2, 'running': 1, 'failed': 1})
+        assert(status['status'] == 'running')
+        keys = mock_client.return_value.batch_get_item.call_args[1]['RequestItems']['jobs']['Keys']
+        assert(keys == [{'job_id': {'S': 'c'}}])
+
+    def test_batch_status_complete(self):
+        self.db.smembers.return_value = {'a', 'b'}
+        self.db.pipeline.return_value.execute.return_value = ['complete', 'complete']
+        assert(utils.batch_status(self.db, 'batch')['status'] == 'complete')
+
+    def test_batch_status_missing(self):
+        self.db.smembers.return_value = set()
+        assert(utils.batch_status(self.db, 'batch') is None)
+
     def test_query_job(self):
         self.db.hget.return_value = 'test'
         expected = {'status': 'test', 'job_id': 'job_id'}
         query_result = utils.query_job_status(self.db, 'job_id')
         assert(query_result == expected)
 
-    @mock.patch('boto3.resource')
-    def test_query_job_old(self, mock_resource):
+    @mock.patch('boto3.client')
+    def test_query_job_old(self, mock_client):
         self.db.hget.return_value = None
         self.db.hgetall.return_value = {}
-        mock_resource.return_value.Table.return_value.get_item.return_value = {'Item': {'foo': 'bar'}}
+        mock_client.return_value.get_item.return_value = {'Item': {'foo': {'S': 'bar'}}}
         expected = {'foo': 'bar'}
         query_result = utils.query_job_status(self.db, 'job_id')
         assert(query_result == expected)
 
-    @mock.patch('boto3.resource')
-    def test_query_job_no_exist(self, mock_resource):
+    @mock.patch('boto3.client')
+    def test_query_job_no_exist(self, mock_client):
         self.db.hget.return_value = None
         self.db.hgetall.return_value = {}
-        mock_resource.return_value.Table.return_value.get_item.return_value = {}
+        mock_client.return_value.get_item.return_value = {}
         query_result = utils.query_job_status(self.db, 'job_id')
         assert(query_result['status'] == 'failed')
 
+    @mock.patch('boto3.client')
+    def test_get_job_result_cached(self, mock_client):
+        self.db.hgetall.return_value = {}
+        mock_client.return_value.get_item.return_value = {
+            'Item': {'job_id': {'S': 'job_id'}, 'status': {'S': 'complete'}, 'result': {'S': 'done'}}}
+        for _ in range(3):
+            result = utils.get_job_result(self.db, 'job_id')
+            assert(result == {'job_id': 'job_id', 'status': 'complete', 'result': 'done'})
+        assert(mock_client.return_value.get_item.call_count == 1)
+        assert(mock_client.call_count == 1)
+        assert(utils.job_cache.stats()['hit_ratio'] == 2 / 3)
+        assert('flexes_job_cache_hits_total 2\n' in utils.metrics())
+
+    @mock.patch('boto3.client')
+    def test_get_job_result_negative_cache(self, mock_client):
+        self.db.hgetall.return_value = {}
+        mock_client.return_value.get_item.return_value = {}
+        utils.get_job_result(self.db, 'job_id')
+        assert(utils.get_job_result(self.db, 'job_id')['status'] == 'failed')
+        assert(mock_client.return_value.get_item.call_count == 1)
+        utils.job_cache.entries['job_id'] = (None, time.time() - 1)
+        utils.get_job_result(self.db, 'job_id')
+        assert(mock_client.return_value.get_item.call_count == 2)
+
+    def test_job_cache(self):
+        cache = utils.JobCache(2, 30)
+        cache.put('running', {'job_id': 'running', 'status': 'running'})
+        assert(cache.lookup('running') == (False, None))
+        for job_id in ['a', 'b', 'c']:
+            cache.put(job_id, {'job_id': job_id, 'status': 'complete'})
+        assert(list(cache.entries) == ['b', 'c'])
+        cache.lookup('b')
+        cache.put('d', None)
+        assert(list(cache.entries) == ['b', 'd'])
+        assert(cache.lookup('d') == (True, None))
+
     def test_job_messages(self):
         self.db.get.return_value = '[1,2,3,4]'
         messages = utils.job_messages(self.db, 'test')
         assert(len(messages) == 4)
         self.db.get.assert_called_with('message:test')
 
-    def test_all_running_jobs(self):
-        return_keys = ['job_id', 'status', 'queue']
-        self.db.hmget.return_value = {key: 'test' for key in return_keys}
-        self.db.keys.return_value = ['foo', 'bar', 'baz']
-        jobs = utils.all_running_jobs(self.db)
-        assert(len(jobs) == 3)
-        self.db.hmget.assert_called_with('baz', return_keys)
-        assert(self.db.hmget.call_count == 3)
-
-    def test_all_queues(self):
-        queue_names = ['foo', 'bar', 'baz']
-        self.db.keys.return_value = queue_names
-        queues = utils.all_queues(self.db)
-        assert(len(queues) == 3)
-
-    def test_all_workers(self):
-        return_keys = ['status', 'queue']
-        self.db.hmget.return_value = {key: 'test' for key in return_keys}
-        self.db.keys.return_value = ['foo', 'bar', 'baz']
-        workers = utils.all_workers(self.db)
-        assert(len(workers) == 3)
-        self.db.hmget.assert_called_with('baz', return_keys)
-        assert(self.db.hmget.call_count == 3)
+    def test_job_events(self):
+        self.db.hget.return_value = 'running'
+        pubsub = self.db.pubsub.return_value
+        pubsub.get_message.side_effect = [
+            None,
+            {'data': '{"event": "messages", "job_id": "abc", "messages": ["step 1"]}'},
+            {'data': '{"event": "status", "job_id": "abc", "status": "complete"}'}]
+        events = list(utils.job_events(self.db, 'abc'))
+        assert([event['event'] for event in events] == ['status', 'messages', 'status'])
+        assert(events[-1]['status'] == 'complete')
+        pubsub.subscribe.assert_called_with('events:abc')
+        assert(pubsub.close.called)
+
+    def test_job_events_finished(self):
+        self.db.hget.return_value = 'complete'
+        events = list(utils.job_events(self.db, 'abc'))
+        assert(events == [{'event': 'status', 'job_id': 'abc', 'status': 'complete'}])
+        self.db.pubsub.return_value.get_message.assert_not_called()
+
+    def test_job_events_keepalive(self):
+        self.db.hget.return_value = 'running'
+        self.db.pubsub.return_value.get_message.return_value = None
+        events = utils.job_events(self.db, 'abc', keepalive=0)
+        assert(next(events)['status'] == 'running')
+        assert(next(events) is None)
+        events.close()
+        assert(self.db.pubsub.return_value.close.called)
+
+    def test_wait_for_job_timeout(self):
+        self.db.hget.return_value = 'running'
+        self.db.pubsub.return_value.get_message.return_value = None
+        assert(utils.wait_for_job(self.db, 'abc', 0.01) == {'job_id': 'abc', 'status': 'running'})
+
+    def test_list_jobs(self):
+        self.db.zrevrangebyscore.side_effect = [[('c', 3.0), ('b', 2.0), ('a', 2.0)], []]
+        self.db.pipeline.return_value.execute.return_value = [
+            ['c', 'running', 'docker', 'test', '3.0'], 
+            [None] * 5, 
+            ['a', 'complete', 'docker', 'test', '2.0']]
+        page = utils.list_jobs(self.db, limit=1)
+        assert([job['job_id'] for job in page['jobs']] == ['c'])
+        assert(page['next_cursor'] == '3.0:c')
+        self.db.zrem.assert_not_called()
+
+        self.db.zrevrangebyscore.side_effect = [[('b', 2.0), ('a', 2.0)], []]
+        self.db.pipeline.return_value.execute.return_value = [[None] * 5, ['a', 'complete', 'docker', 'test', '2.0']]
+        page = utils.list_jobs(self.db, status=['complete'], limit=10, cursor=page['next_cursor'])
+        assert([job['job_id'] for job in page['jobs']] == ['a'])
+        assert(page['next_cursor'] is None)
+        self.db.zrevrangebyscore.assert_called_with('jobs:index', 3.0, '-inf', start=2, num=100, withscores=True)
+        self.db.zrem.assert_called_once_with('jobs:index', 'b')
+        self.db.keys.assert_not_called()
+
+    def test_list_jobs_cursor_ties(self):
+        self.db.zrangebyscore.side_effect = [[('a', 2.0), ('b', 2.0), ('c', 2.0)], []]
+        self.db.pipeline.return_value.execute.return_value = [['c', 'running', 'docker', 'test', '2.0']]
+        page = utils.list_jobs(self.db, order='asc', since=1.0, cursor='2.0:b')
+        assert([job['job_id'] for job in page['jobs']] == ['c'])
+        self.db.pipeline.return_value.hmget.assert_called_once_with('job:c', mock.ANY)
+
+    def test_list_jobs_filtered(self):
+        db = fakeredis.FakeStrictRedis(decode_responses=True)
+        jobs = [('a', 'docker', 'complete'), ('b', 'gpu', 'running'), ('c', 'docker', 'submitted'),
+                ('d', 'other', 'running'), ('e', 'gpu', 'complete')]
+        for submitted_at, (job_id, queue, status) in enumerate(jobs):
+            db.hmset('job:' + job_id, {'job_id': job_id, 'queue': queue, 'status': status, 
+                                       'submitted_at': submitted_at})
+            db.zadd(utils.config['JOBS_INDEX'], {job_id: submitted_at})
+            db.zadd(utils.queue_index(queue), {job_id: submitted_at})
+            db.sadd(utils.config['QUEUES_KEY'], queue)
+            if status != 'complete':
+                db.sadd('{}:jobs'.format(queue), job_id)
+            if status == 'running':
+                db.sadd('{}:jobs:running'.format(queue), job_id)
+
+        # Queue filters walk only the indexes of those queues
+        with mock.patch.object(db, 'zrevrangebyscore', wraps=db.zrevrangebyscore) as fetch:
+            page = utils.list_jobs(db, queue=['gpu', 'docker'], limit=3)
+        assert([job['job_id'] for job in page['jobs']] == ['e', 'c', 'b'])
+        assert(set(call[0][0] for call in fetch.call_args_list) == {'docker:jobs:index', 'gpu:jobs:index'})
+        page = utils.list_jobs(db, queue=['gpu', 'docker'], limit=3, cursor=page['next_cursor'])
+        assert([job['job_id'] for job in page['jobs']] == ['a'])
+        assert(page['next_cursor'] is None)
+
+        # Unfinished jobs are read from the queue sets
+        with mock.patch.object(db, 'zrevrangebyscore') as fetch:
+            page = utils.list_jobs(db, status=['running'], limit=1)
+            assert([job['job_id'] for job in page['jobs']] == ['d'])
+            page = utils.list_jobs(db, status=['running'], limit=1, cursor=page['next_cursor'])
+            assert([job['job_id'] for job in page['jobs']] == ['b'])
+            page = utils.list_jobs(db, status=['running', 'submitted'], queue=['docker'], order='asc')
+            assert([job['job_id'] for job in page['jobs']] == ['c'])
+            fetch.assert_not_called()
 
+    def test_list_jobs_bad_cursor(self):
+        with pytest.raises(ValueError):
+            utils.list_jobs(self.db, cursor='abc')
+
+    def test_list_queues(self):
+        self.db.smembers.return_value = {'a', 'b', 'c'}
+        self.db.pipeline.return_value.execute.return_value = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+        page = utils.list_queues(self.db, limit=2)
+        assert(page['queues'][1] == {'name': 'b', 'queued': 6, 'jobs': 7, 'running': 8, 
+                                     'workers': 9, 'busy_workers': 10})
+        assert(page['next_cursor'] == 'b')
+        self.db.pipeline.return_value.execute.return_value = [1, 2, 3, 4, 5]
+        page = utils.list_queues(self.db, limit=2, cursor='b')
+        assert([queue['name'] for queue in page['queues']] == ['c'])
+        assert(page['next_cursor'] is None)
+
+    def test_list_workers(self):
+        self.db.smembers.return_value = {'docker'}
+        entry = lambda status, worker_type: [status, 'docker', worker_type, None, '1', '0', '1.0']
+        self.db.pipeline.return_value.execute.side_effect = [
+            [{'a', 'b', 'c'}, set()],
+            [entry('idle', 'DockerWorker'), entry('busy', 'NativeWorker'), entry('idle', 'DockerWorker')]]
+        page = utils.list_workers(self.db, worker_type=['DockerWorker'], order='desc', limit=1)
+        assert([worker['id'] for worker in page['workers']] == ['c'])
+        assert(page['next_cursor'] == 'c')
+
+    def test_list_workers_expired_dead(self):
+        self.db.smembers.return_value = {'docker'}
+        self.db.pipeline.return_value.execute.side_effect = [
+            [{'a'}, {'b', 'c'}],
+            [['idle', 'docker'] + [None] * 5, ['dead', 'docker'] + [None] * 5, [None] * 7]]
+        page = utils.list_workers(self.db)
+        assert([(worker['id'], worker['status']) for worker in page['workers']] == [('a', 'idle'), ('b', 'dead')])
+        self.db.srem.assert_called_once_with('workers:dead', 'c')
+        self.db.keys.assert_not_called()
 
     @mock.patch('flexes_build.server.utils.get_services', new_callable=CoroutineMock)
     def test_list_services(self, mock_get_services):
@@ -193,6 +517,48 @@ class TestUtils:
         services = utils.list_services(tags=['lanl'])
         assert(services == mock_responses['lanl'])
 
+    @mock.patch('flexes_build.server.utils.get_services', new_callable=CoroutineMock)
+    def test_list_services_cached(self, mock_get_services):
+        mock_get_services.return_value = [{'name': 'a', 'tags': ['latest', 'dev']}]
+        assert(utils.list_services(tags=['dev']) == {'services': [{'name': 'a', 'tags': ['dev']}]})
+        assert(utils.list_services() == {'services': [{'name': 'a', 'tags': ['latest', 'dev']}]})
+        assert(mock_get_services.call_count == 1)
+
+    @mock.patch('flexes_build.server.utils.get_services', new_callable=CoroutineMock)
+    def test_list_services_stale(self, mock_get_services):
+        mock_get_services.return_value = [{'name': 'a', 'tags': ['latest']}]
+        utils.list_services()
+        mock_get_services.return_value = [{'name': 'b', 'tags': ['latest']}]
+        utils.catalog.updated -= utils.catalog.ttl + 1
+        # The stale catalog is served while it is refreshed in the background
+        assert(utils.list_services()['services'][0]['name'] == 'a')
+        for _ in range(100):
+            if not utils.catalog.refreshing:
+                break
+            time.sleep(0.01)
+        assert(utils.list_services()['services'][0]['name'] == 'b')
+        utils.catalog.updated -= utils.catalog.max_stale + 1
+        mock_get_services.return_value = [{'name': 'c', 'tags': ['latest']}]
+        assert(utils.list_services()['services'][0]['name'] == 'c')
+
+    @mock.patch('flexes_build.server.utils.ClientSession')
+    def test_get_services_pages(self, mock_session):
+        registry = 'https://{}'.format(utils.config['DOCKER_REGISTRY'])
+        pages = {'/v2/_catalog?n=100': ({'repositories': ['a']}, '/v2/_catalog?last=a&n=100'),
+                 '/v2/_catalog?last=a&n=100': ({'repositories': ['b']}, None),
+                 '/v2/a/tags/list?n=100': ({'name': 'a', 'tags': ['latest']}, None),
+                 '/v2/b/tags/list?n=100': ({'name': 'b', 'tags': ['latest', 'dev']}, None)}
+        session = FakeRegistrySession(registry, pages)
+        mock_session.return_value = session
+        responses = {}
+        services = asyncio.run(utils.get_services(responses))
+        assert(services == [{'name': 'a', 'tags': ['latest']}, {'name': 'b', 'tags': ['latest', 'dev']}])
+        assert(len(responses) == 4)
+        # Unchanged pages are revalidated with their ETags
+        services = asyncio.run(utils.get_services(responses))
+        assert(services[1]['tags'] == ['latest', 'dev'])
+        assert(session.not_modified == 4)
+
     @mock.patch('boto3.resource')
     def test_stream_from_s3(self, mock_resource):
         mock_resource.Bucket.return_value.download_fileobj.side_effect = mock_download_fileobj
@@ -206,6 +572,206 @@ class TestUtils:
         assert(result == {'foo': 'bar'})
 
 
+class TestDeduplication:
+    def setup_method(self, _):
+        self.mock_aws = mock_aws()
+        self.mock_aws.start()
+        utils.s3_client = None
+        self.s3 = boto3.client('s3', region_name='us-east-1')
+        self.s3.create_bucket(Bucket='bucket')
+        self.db = mock.MagicMock()
+        self.pipe = mock.MagicMock()
+        self.db.transaction.side_effect = lambda func, *watches, **kwargs: func(self.pipe)
+        self.message = {'service': 'test', 'dedupe': 600,
+                        'command': {'arguments': [{'type': 'output', 'value': 's3://bucket/out'}]}}
+
+    def teardown_method(self, _):
+        self.mock_aws.stop()
+        utils.s3_client = None
+
+    def test_dedupe_key(self):
+        same = {'service': 'test', 'tag': 'latest', 'queue': 'docker', 'tenant': 'alice', 'priority': 3,
+                'dedupe': 60, 'command': {'arguments': [{'value': 's3://bucket/out', 'type': 'output'}]}}
+        assert(utils.dedupe_key(self.message) == utils.dedupe_key(same))
+        assert(utils.dedupe_key(self.message).startswith('dedupe:'))
+        assert(utils.dedupe_key(self.message) != utils.dedupe_key(dict(self.message, tag='v2')))
+
+    def test_output_uris(self):
+        command = {'output': ['s3://bucket/dir'],
+                   'arguments': [{'type': 'output', 'value': 's3://bucket/a'},
+                                 {'type': 'output', 'value': 'local'}],
+                   'stdout': {'type': 'uri', 'value': 's3://bucket/stdout'},
+                   'stderr': {'type': 'pipe'}}
+        assert(utils.output_uris(command) == ['s3://bucket/dir', 's3://bucket/a', 's3://bucket/stdout'])
+
+    def test_outputs_exist(self):
+        assert(utils.outputs_exist(self.message['command']) is False)
+        self.s3.put_object(Bucket='bucket', Key='out/part-0', Body=b'1')
+        assert(utils.outputs_exist(self.message['command']) is True)
+
+    def test_submit_new(self):
+        self.pipe.get.return_value = None
+        job_id = utils.submit_job(self.db, self.message)
+        assert(job_id == self.message['job_id'])
+        self.db.transaction.assert_called_with(mock.ANY, utils.dedupe_key(self.message), value_from_callable=True)
+        self.pipe.multi.assert_called_once()
+        key, entry = self.pipe.set.call_args[0]
+        assert(key == utils.dedupe_key(self.message))
+        assert(utils.dedupe_candidate(entry, self.message) == job_id)
+        assert(self.pipe.set.call_args[1] == {'ex': 600})
+
+    def test_submit_attached_to_running(self):
+        self.pipe.get.return_value = utils.dedupe_entry('earlier', time.time())
+        self.db.hget.return_value = 'running'
+        assert(utils.submit_job(self.db, self.message) == 'earlier')
+        self.pipe.multi.assert_not_called()
+
+    def test_submit_complete(self):
+        self.pipe.get.return_value = utils.dedupe_entry('earlier', time.time())
+        self.db.hget.return_value = 'complete'
+        # The earlier outputs are gone, so the job runs again
+        assert(utils.submit_job(self.db, self.message) != 'earlier')
+        self.s3.put_object(Bucket='bucket', Key='out', Body=b'1')
+        assert(utils.submit_job(self.db, self.message) == 'earlier')
+
+    def test_submit_complete_piped(self):
+        self.pipe.get.return_value = utils.dedupe_entry('earlier', time.time())
+        self.db.hget.return_value = 'complete'
+        self.s3.put_object(Bucket='bucket', Key='out', Body=b'1')
+        self.message['command']['stdout'] = {'type': 'pipe', 'value': None}
+        # The earlier job's STDOUT is gone once its entry expires
+        assert(utils.submit_job(self.db, self.message) != 'earlier')
+        self.db.hget.return_value = 'running'
+        assert(utils.submit_job(self.db, self.message) == 'earlier')
+
+    def test_dedupe_test_message(self):
+        validator = load_message_validator()
+        assert(validator.is_valid({'service': 'test', 'test': True}))
+        assert(not validator.is_valid({'service': 'test', 'test': True, 'dedupe': 60}))
+
+    def test_submit_failed(self):
+        self.pipe.get.return_value = utils.dedupe_entry('earlier', time.time())
+        self.db.hget.return_value = 'failed'
+        assert(utils.submit_job(self.db, self.message) != 'earlier')
+
+    def test_dedupe_candidate(self):
+        entry = utils.dedupe_entry('earlier', 1000.0)
+        assert(utils.dedupe_candidate(entry, self.message, now=1600.0) == 'earlier')
+        assert(utils.dedupe_candidate(entry, self.message, now=1600.5) is None)
+        assert(utils.dedupe_candidate(None, self.message) is None)
+
+    def test_submit_mismatched_windows(self):
+        db = fakeredis.FakeStrictRedis(decode_responses=True)
+        first = dict(self.message, dedupe=3600)
+        first_id = utils.submit_job(db, first)
+        db.hset('job:' + first_id, 'status', 'running')
+        later = time.time() + 2.1
+        with mock.patch('flexes_build.server.utils.time.time', return_value=later):
+            # Outside the later message's own window, though the key set by the 
+            # first message still exists
+            second_id = utils.submit_job(db, dict(self.message, dedupe=1))
+            assert(second_id != first_id)
+            assert(utils.submit_job(db, dict(self.message, dedupe=3600)) == second_id)
+        assert(utils.submit_job(db, dict(self.message, dedupe=3600)) == second_id)
+
+    def test_submit_without_dedupe(self):
+        del self.message['dedupe']
+        utils.submit_job(self.db, self.message)
+        self.db.transaction.assert_not_called()
+        self.db.pipeline.return_value.set.assert_not_called()
+
+
+class TestServiceDocs:
+    def setup_method(self, _):
+        self.mock_aws = mock_aws()
+        self.mock_aws.start()
+        utils.s3_client = None
+        utils.docs_cache.clear()
+        self.s3 = boto3.client('s3', region_name='us-east-1')
+        self.s3.create_bucket(Bucket=utils.config['DOCS_BUCKET'])
+        self.key = 'lanlytics-api/docs/test/latest/service_docs.json'
+        self.s3.put_object(Bucket=utils.config['DOCS_BUCKET'], Key=self.key, Body=b'{"name": "test"}')
+
+    def teardown_method(self, _):
+        self.mock_aws.stop()
+        utils.s3_client = None
+        utils.docs_cache.clear()
+
+    def test_get_service_docs(self):
+        docs, etag = utils.get_service_docs('test', 'latest')
+        assert(docs == {'name': 'test'})
+        self.s3.put_object(Bucket=utils.config['DOCS_BUCKET'], Key=self.key, Body=b'{"name": "new"}')
+        # Served from the cache until the entry is due for revalidation
+        assert(utils.get_service_docs('test', 'latest') == (docs, etag))
+        utils.docs_cache.entries[('test', 'latest')]['checked'] = 0
+        new_docs, new_etag = utils.get_service_docs('test', 'latest')
+        assert(new_docs == {'name': 'new'})
+        assert(new_etag != etag)
+
+    def test_get_service_docs_not_modified(self):
+        docs, etag = utils.get_service_docs('test', 'latest')
+        utils.docs_cache.entries[('test', 'latest')]['checked'] = 0
+        with mock.patch('flexes_build.server.utils.ujson.loads') as mock_loads:
+            assert(utils.get_service_docs('test', 'latest') == (docs, etag))
+            assert(not mock_loads.called)
+        assert(utils.docs_cache.entries[('test', 'latest')]['checked'] > 0)
+
+    def test_get_service_docs_missing(self):
+        with pytest.raises(botocore.exceptions.ClientError):
+            utils.get_service_docs('missing', 'latest')
+
+    def test_docs_cache_size(self):
+        utils.docs_cache.size = 1
+        try:
+            utils.get_service_docs('test', 'latest')
+            self.s3.put_object(Bucket=utils.config['DOCS_BUCKET'], 
+                               Key='lanlytics-api/docs/other/latest/service_docs.json', Body=b'{}')
+            utils.get_service_docs('other', 'latest')
+            assert(list(utils.docs_cache.entries) == [('other', 'latest')])
+        finally:
+            utils.docs_cache.size = utils.config['DOCS_CACHE_SIZE']
+
+
+class FakeRegistryResponse:
+    def __init__(self, url, body, next_path, not_modified):
+        self.url = URL(url)
+        self.status = 304 if not_modified else 200
+        self.headers = {'ETag': '"{}"'.format(url)}
+        self.links = {'next': {'url': URL(next_path)}} if next_path is not None else {}
+        self.body = body
+
+    def raise_for_status(self):
+        pass
+
+    async def json(self):
+        return self.body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeRegistrySession:
+    def __init__(self, registry, pages):
+        self.registry = registry
+        self.pages = pages
+        self.not_modified = 0
+
+    def get(self, url, headers={}):
+        body, next_path = self.pages[url[len(self.registry):]]
+        not_modified = headers.get('If-None-Match') == '"{}"'.format(url)
+        self.not_modified += not_modified
+        return FakeRegistryResponse(url, body, next_path, not_modified)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
 class TestSchema:
     def setup_method(self, _):
         self.input_schema = load_message_schema()